@@ -0,0 +1,230 @@
+import os
+import time
+import sqlite3
+import argparse
+import threading
+import numpy as np
+import pandas as pd
+from utils import Cache
+
+
+class AnalyticsIndex:
+    '''SQLite index of every analyzed video, to query sentiment across the whole cache
+    without loading each video. It has three tables:
+      - `videos`: the info of each video, as `YoutubeVideoInfoCleaner` returns it.
+      - `comments`: id, parent id, publication time (seconds since epoch, UTC) and sentiment
+        of every comment, with the sentiment as its position in `sentiments`.
+      - `daily_sentiments`: number of comments of each sentiment of a video in a UTC day.
+    Aggregate queries read `daily_sentiments`, which has a row per video and day
+    instead of one per comment, so they answer quickly over millions of comments.
+    Videos are indexed again as a whole when they are analyzed again.'''
+
+    sentiments = ('negative', 'neutral', 'positive')
+    # first day of the bin of `day` (days since epoch), 1970-01-01 was a Thursday
+    period_expressions = {
+        'day': "d.day",
+        'week': "d.day - (d.day + 3) % 7",
+        'month': "CAST(strftime('%s', d.day * 86400, 'unixepoch', 'start of month') AS INTEGER) / 86400",
+    }
+    # channels are grouped by id, as names are neither unique nor permanent
+    group_columns = {'channel': "v.channel_id", 'video': "d.video_id"}
+    # name shown for each group: the channel name of its most recently published video
+    group_names = {'channel': '''(SELECT channel_name FROM videos WHERE channel_id = "group"
+                                  ORDER BY published_at DESC LIMIT 1)'''}
+
+    def __init__(self, path: str = '.cache/analytics.sqlite') -> None:
+        self.path = path
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        # with WAL, commits stay atomic without waiting for the disk on each one
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS videos (
+                video_id TEXT PRIMARY KEY, channel_id TEXT, channel_name TEXT, video_title TEXT,
+                published_at INTEGER, views INTEGER, likes INTEGER, comments INTEGER,
+                thumbnail_url TEXT, indexed_at REAL NOT NULL);
+            CREATE INDEX IF NOT EXISTS videos_channel_id ON videos (channel_id);
+            CREATE TABLE IF NOT EXISTS comments (
+                video_id TEXT NOT NULL, comment_id TEXT, parent_id TEXT,
+                published_at INTEGER NOT NULL, sentiment INTEGER NOT NULL);
+            CREATE INDEX IF NOT EXISTS comments_video_id ON comments (video_id);
+            CREATE INDEX IF NOT EXISTS comments_published_at ON comments (published_at);
+            CREATE TABLE IF NOT EXISTS daily_sentiments (
+                video_id TEXT NOT NULL, day INTEGER NOT NULL,
+                negative INTEGER NOT NULL, neutral INTEGER NOT NULL, positive INTEGER NOT NULL,
+                PRIMARY KEY (video_id, day)) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS daily_sentiments_day ON daily_sentiments (day);
+        ''')
+        self.connection.commit()
+
+    @staticmethod
+    def to_epoch_seconds(dates) -> pd.Series:
+        '''Converts dates (datetimes or strings like the API ones) to seconds since epoch.'''
+        dates = pd.to_datetime(pd.Series(dates), utc=True)
+        return (dates - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(seconds=1)
+
+    @staticmethod
+    def to_integer(value) -> int | None:
+        # the API returns statistics as strings, and hides some of them
+        return None if value is None else int(value)
+
+    def is_indexed(self, video_id: str) -> bool:
+        with self._lock:
+            return self.connection.execute(
+                "SELECT 1 FROM daily_sentiments WHERE video_id = ? LIMIT 1", (video_id,)).fetchone() is not None
+
+    def index_video_info(self, video_id: str, video_info: dict) -> None:
+        '''Adds or updates the info of a video, as `YoutubeVideoInfoCleaner` returns it.'''
+        published_at = video_info.get('published_date')
+        row = (
+            video_id, video_info.get('channel_id'), video_info.get('channel_name'), video_info.get('video_title'),
+            int(self.to_epoch_seconds([published_at])[0]) if published_at else None,
+            self.to_integer(video_info.get('views')), self.to_integer(video_info.get('likes')),
+            self.to_integer(video_info.get('comments')), video_info.get('thumbnail_url'), time.time())
+
+        with self._lock:
+            self.connection.execute("INSERT OR REPLACE INTO videos VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
+            self.connection.commit()
+
+    def index_video(self, video_id: str, comments, video_info: dict | None = None) -> int:
+        '''Replaces the indexed comments of a video with `comments` (a DataFrame or a list
+        of records with `date` and `sentiment`, and optionally `id` and `parent_id`).
+        Comments without a sentiment are left out. Returns the number of indexed comments.'''
+
+        df = comments if isinstance(comments, pd.DataFrame) else pd.DataFrame(comments, columns=['id', 'parent_id', 'date', 'sentiment'])
+        codes = pd.Categorical(df['sentiment'].astype(object), categories=self.sentiments).codes
+        scored = codes >= 0
+
+        published_at = self.to_epoch_seconds(df['date'][scored]).to_numpy()
+        comments_count = len(published_at)
+        comment_ids = df['id'][scored].tolist() if 'id' in df.columns else [None] * comments_count
+        # top level comments have an empty parent id in the cache
+        parent_ids = [parent_id or None for parent_id in df['parent_id'][scored].fillna('').tolist()] \
+            if 'parent_id' in df.columns else [None] * comments_count
+        days, day_positions = np.unique(published_at // 86400, return_inverse=True)
+        daily_counts = np.zeros((len(days), len(self.sentiments)), dtype=np.int64)
+        np.add.at(daily_counts, (day_positions, codes[scored]), 1)
+
+        if video_info is not None:
+            self.index_video_info(video_id, video_info)
+
+        with self._lock:
+            with self.connection:
+                self.connection.execute("DELETE FROM comments WHERE video_id = ?", (video_id,))
+                self.connection.execute("DELETE FROM daily_sentiments WHERE video_id = ?", (video_id,))
+                self.connection.executemany("INSERT INTO comments VALUES (?, ?, ?, ?, ?)",
+                                            zip([video_id] * comments_count, comment_ids, parent_ids,
+                                                published_at.tolist(), codes[scored].tolist()))
+                self.connection.executemany("INSERT INTO daily_sentiments VALUES (?, ?, ?, ?, ?)",
+                                            [(video_id, day, *counts) for day, counts in zip(days.tolist(), daily_counts.tolist())])
+                # videos without info still get a row, so they can be grouped and filtered
+                self.connection.execute("INSERT OR IGNORE INTO videos (video_id, indexed_at) VALUES (?, ?)",
+                                        (video_id, time.time()))
+
+        return comments_count
+
+    def index_cached_video(self, cache: Cache, video_id: str, video_info: dict | None = None) -> int:
+        '''Indexes a video stored in the columnar store of `cache`.'''
+        meta = cache.store.read_meta(video_id)
+        columns = [column for column in ('id', 'parent_id', 'date', 'sentiment') if column in meta['columns']]
+        return self.index_video(video_id, cache.store.read(video_id, columns), video_info)
+
+    def index_cache(self, cache: Cache, only_missing: bool = True) -> int:
+        '''Indexes the videos of the cache (only the ones not indexed yet if `only_missing`).
+        Returns the number of indexed videos.'''
+        video_ids = [video_id for video_id in cache.store.video_ids()
+                     if not (only_missing and self.is_indexed(video_id))]
+        for video_id in video_ids:
+            self.index_cached_video(cache, video_id)
+        return len(video_ids)
+
+    def sentiment_counts(self, group_by: str | None = 'channel', time_bin: str = 'week',
+                         since: str | None = None, until: str | None = None,
+                         last_videos: int | None = None) -> pd.DataFrame:
+        '''Returns the number of comments of each sentiment and the share of each one,
+        by `group_by` (`channel`, `video` or None) and by `time_bin` (`day`, `week` or `month`,
+        with the UTC date its bin starts). Channels are grouped by `channel_id`, with their current
+        name in `channel`. Only comments published between `since` and `until`
+        (dates like `2024-01-31`) and of the `last_videos` most recently published videos are counted.'''
+
+        period = self.period_expressions[time_bin]
+        group = self.group_columns[group_by] if group_by is not None else "NULL"
+        group_name = f", {self.group_names[group_by]} AS group_name" if group_by in self.group_names else ""
+        conditions, parameters = [], []
+
+        if since is not None:
+            conditions.append("d.day >= ?")
+            parameters.append(int(self.to_epoch_seconds([since])[0]) // 86400)
+        if until is not None:
+            conditions.append("d.day < ?")
+            parameters.append(int(self.to_epoch_seconds([until])[0]) // 86400)
+        if last_videos is not None:
+            conditions.append("d.video_id IN (SELECT video_id FROM videos ORDER BY published_at DESC LIMIT ?)")
+            parameters.append(last_videos)
+
+        # periods are formatted as dates after grouping, so it is done once per result row
+        counts = ', '.join(f"SUM(d.{sentiment}) AS {sentiment}" for sentiment in self.sentiments)
+        query = f'''
+            SELECT "group"{group_name}, date(period * 86400, 'unixepoch') AS period, {', '.join(self.sentiments)},
+                   {' + '.join(self.sentiments)} AS comments
+            FROM (SELECT {group} AS "group", {period} AS period, {counts}
+                  FROM daily_sentiments AS d LEFT JOIN videos AS v ON v.video_id = d.video_id
+                  {"WHERE " + " AND ".join(conditions) if conditions else ""}
+                  GROUP BY 1, 2)
+            ORDER BY 1, 2'''
+
+        with self._lock:
+            result = pd.read_sql_query(query, self.connection, params=parameters)
+
+        if group_by is None:
+            result = result.drop(columns='group')
+        elif group_by in self.group_names:
+            result = result.rename(columns={'group': group_by + '_id', 'group_name': group_by})
+        else:
+            result = result.rename(columns={'group': group_by})
+
+        for sentiment in self.sentiments:
+            result[sentiment + '_share'] = result[sentiment] / result['comments']
+        return result
+
+    def query(self, sql: str, parameters: tuple = ()) -> pd.DataFrame:
+        '''Runs any read query over the index tables.'''
+        with self._lock:
+            return pd.read_sql_query(sql, self.connection, params=parameters)
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+def parse_arguments(arguments: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Query the sentiment of the comments of every analyzed video.")
+    parser.add_argument('--index-cache', action='store_true', help="index the cached videos that are not indexed yet")
+    parser.add_argument('--group-by', choices=['channel', 'video', 'none'], default='channel')
+    parser.add_argument('--time-bin', choices=list(AnalyticsIndex.period_expressions), default='week')
+    parser.add_argument('--since', help="first date of the comments, like 2024-01-31")
+    parser.add_argument('--until', help="date after the last one of the comments")
+    parser.add_argument('--last-videos', type=int, help="count only the most recently published videos")
+    parser.add_argument('--output', help="CSV file where the result is written (by default, it is printed)")
+    return parser.parse_args(arguments)
+
+
+if __name__ == '__main__':
+
+    arguments = parse_arguments()
+    analytics_index = AnalyticsIndex()
+
+    if arguments.index_cache:
+        print(f"Indexed {analytics_index.index_cache(Cache())} cached videos.")
+
+    start = time.perf_counter()
+    result = analytics_index.sentiment_counts(None if arguments.group_by == 'none' else arguments.group_by,
+                                              arguments.time_bin, arguments.since, arguments.until, arguments.last_videos)
+    print(f"Query answered in {(time.perf_counter() - start) * 1000:.0f} ms.")
+
+    if arguments.output:
+        result.to_csv(arguments.output, index=False)
+    else:
+        print(result.to_string(index=False))
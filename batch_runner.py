@@ -0,0 +1,319 @@
+import os
+import json
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import pandas as pd
+from conections import (YoutubeCommentsConnection, YoutubePlaylistConnection, YoutubeChannelConnection,
+                        YoutubeVideoCommentsDataCleaner, YoutubeVideoCommentsListLengthCleaner,
+                        YoutubeCommentsDuplicatesCleaner, SentimentAnalyzer, TwoTierSentimentAnalyzer, SentimentScoringPool,
+                        YoutubeVideosInfoBatchConnection, ApiScheduler, ModelRegistry)
+from utils import ReadApiKeys, Cache, SentimentMemoCache
+from analytics import AnalyticsIndex
+from instrumentation import metrics, SamplingProfiler
+
+
+class BatchCheckpoint:
+    '''Progress of a batch job, stored as a JSON file in `checkpoints_path`.
+    It keeps the list of videos of the job and the status of each one
+    (`pending`, `done` or `failed`), so a stopped job resumes with the videos left.
+    The progress inside a video (its next page token) is kept by the cache store.'''
+
+    checkpoints_path = '.cache/batch/'
+
+    def __init__(self, job_name: str, checkpoints_path: str | None = None) -> None:
+        self.checkpoints_path = checkpoints_path or self.checkpoints_path
+        self.path = os.path.join(self.checkpoints_path, job_name + '.json')
+        self._lock = threading.Lock()
+        os.makedirs(self.checkpoints_path, exist_ok=True)
+
+        try:
+            with open(self.path, "r") as file:
+                self.state = json.load(file)
+        except FileNotFoundError:
+            self.state = {'video_ids': [], 'videos': {}}
+
+    @property
+    def video_ids(self) -> list[str]:
+        return self.state['video_ids']
+
+    def set_video_ids(self, video_ids: list[str]) -> None:
+        with self._lock:
+            self.state['video_ids'] = list(dict.fromkeys(video_ids))
+            for video_id in self.state['video_ids']:
+                self.state['videos'].setdefault(video_id, {'status': 'pending'})
+            self.save()
+
+    def set_status(self, video_id: str, status: str, **details) -> None:
+        with self._lock:
+            self.state['videos'][video_id] = {'status': status, **details}
+            self.save()
+
+    def pending_video_ids(self) -> list[str]:
+        '''Returns the videos that are not done yet, including the failed ones.'''
+        return [video_id for video_id in self.video_ids if self.state['videos'][video_id]['status'] != 'done']
+
+    def summary(self) -> dict[str, int]:
+        statuses = [self.state['videos'][video_id]['status'] for video_id in self.video_ids]
+        return {status: statuses.count(status) for status in ('pending', 'done', 'failed')}
+
+    def save(self) -> None:
+        # replace the file atomically, so a killed run never leaves a broken checkpoint
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, "w") as file:
+            json.dump(self.state, file)
+        os.replace(temporary_path, self.path)
+
+
+class BatchRunner:
+    '''Headless analysis of many YouTube videos, for channels, playlists or lists of ids.
+    Up to `max_workers` videos are fetched at the same time, sharing a limit of
+    `requests_per_second` requests, or the given `scheduler` (to spread the requests
+    across several API keys). Every page is cleaned, scored and appended to the
+    cache store together with the token of the next page, so a crashed or killed run
+    resumes each video from its last stored page, and skips the videos already done.
+    If a `scoring_pool` is given, comments are scored in its processes. Otherwise
+    they are scored in this process, one page at a time, with the model `backend`.
+    Duplicated texts are scored once, and with `near_duplicates` so are the ones that differ slightly.
+    With a `prefilter_threshold`, the texts the saved prefilter is confident about skip the model.
+    Every analyzed video is added, with its info, to `analytics_index` if one is given.
+    Without a `job_name`, the runner keeps no job checkpoint, and only analyzes single videos.'''
+
+    def __init__(self, YOUTUBE_API_KEY: str, job_name: str | None, max_workers: int = 4, requests_per_second: float = 10,
+                 api_endpoint: str | None = None, batch_size: int = 32, full_corpus: bool = False,
+                 include_replies: bool = False, scoring_pool: SentimentScoringPool | None = None,
+                 memo_cache: SentimentMemoCache | None = None, cache: Cache | None = None,
+                 scheduler: ApiScheduler | None = None, backend: str | None = None,
+                 near_duplicates: bool = False, analytics_index: AnalyticsIndex | None = None,
+                 prefilter_threshold: float | None = None) -> None:
+        self.YOUTUBE_API_KEY = YOUTUBE_API_KEY
+        self.max_workers = max_workers
+        self.api_endpoint = api_endpoint
+        self.scheduler = scheduler or ApiScheduler(YOUTUBE_API_KEY, requests_per_second)
+        self.batch_size = batch_size
+        self.full_corpus = full_corpus
+        self.include_replies = include_replies
+        self.scoring_pool = scoring_pool
+        duplicates_cleaner = YoutubeCommentsDuplicatesCleaner(near_duplicates)
+        if prefilter_threshold is None:
+            self.sentiment_analyzer = SentimentAnalyzer(memo_cache, backend, duplicates_cleaner)
+        else:
+            self.sentiment_analyzer = TwoTierSentimentAnalyzer(threshold=prefilter_threshold, memo_cache=memo_cache,
+                                                               backend=backend, duplicates_cleaner=duplicates_cleaner)
+        self.cache = cache or Cache()
+        self.checkpoint = BatchCheckpoint(job_name) if job_name is not None else None
+        self.analytics_index = analytics_index
+
+        # the in process model is shared by every worker thread, so it scores one page at a time
+        self._scoring_lock = threading.Lock()
+
+    def resolve_video_ids(self, channel_id: str | None = None, playlist_id: str | None = None,
+                          video_ids_file: str | None = None) -> list[str]:
+        '''Returns the ids of the videos of a channel, a playlist or a file with one id per line.'''
+
+        if video_ids_file is not None:
+            with open(video_ids_file, "r") as file:
+                return [line.strip() for line in file if line.strip() and not line.startswith('#')]
+
+        if channel_id is not None:
+            playlist_id = YoutubeChannelConnection(self.YOUTUBE_API_KEY, channel_id, self.api_endpoint, self.scheduler).uploads_playlist_id()
+
+        if playlist_id is None:
+            raise ValueError("A channel id, a playlist id or a file of video ids is needed.")
+
+        playlist_connection = YoutubePlaylistConnection(self.YOUTUBE_API_KEY, playlist_id,
+                                                        api_endpoint=self.api_endpoint, scheduler=self.scheduler)
+        return list(playlist_connection.iter_video_ids())
+
+    def score_comments(self, comments: list[dict[str, str]], known_labels: dict[str, str] | None = None) -> list[dict[str, str]]:
+        '''Adds the sentiment to every comment. Texts in `known_labels` (labels by
+        normalized text, shared by the pages of a video) are not scored again.'''
+        texts = [comment['text'] for comment in comments]
+
+        if self.scoring_pool is not None:
+            def score(new_texts: list[str]) -> list[str]:
+                return [comment['sentiment'] for comment in self.scoring_pool.score_comments({'text': text} for text in new_texts)]
+            sentiments = score(texts) if known_labels is None else SentimentAnalyzer.apply_known_labels(texts, known_labels, score)
+
+        else:
+            with self._scoring_lock, metrics.timer('score_comments') as details:
+                details['items'] = len(texts)
+                sentiments = self.sentiment_analyzer.apply_model_to_batch(texts, batch_size=self.batch_size,
+                                                                          show_progress=False, known_labels=known_labels)
+
+        for comment, sentiment in zip(comments, sentiments):
+            comment['sentiment'] = sentiment
+        return comments
+
+    def analyze_video(self, video_id: str, store_id: str | None = None) -> int:
+        '''Analyzes the comments of a video and stores them page by page in the cache,
+        resuming from the last stored page if the video was partially analyzed.
+        The comments are stored as `store_id` if given (by default, the video id).
+        Returns the number of stored comments.'''
+
+        store = self.cache.store
+        store_id = store_id or video_id
+        columns = ['id', 'parent_id', 'text', 'date', 'sentiment', 'reply_count'] if self.include_replies else ['id', 'text', 'date', 'sentiment']
+
+        page_checkpoint = store.read_checkpoint(store_id)
+        if page_checkpoint is None:
+            # start over, as anything stored before may come from another run or settings
+            store.delete(store_id)
+            page_token, comments_count = '', 0
+        else:
+            page_token, comments_count = page_checkpoint['next_page_token'], store.read_meta(store_id)['rows']
+
+        max_comments = None if self.full_corpus else YoutubeVideoCommentsListLengthCleaner.max_comments
+        comments_cleaner = YoutubeVideoCommentsDataCleaner(self.full_corpus, self.include_replies)
+        connection = YoutubeCommentsConnection(self.YOUTUBE_API_KEY, video_id,
+                                               api_endpoint=self.api_endpoint, scheduler=self.scheduler)
+
+        pages = connection.iter_comment_pages(include_replies=self.include_replies, page_token=page_token)
+        # texts repeated in several pages of the video are scored once
+        known_labels = {}
+        try:
+            for page in pages:
+                page_comments = comments_cleaner.clean_page(page)
+                if max_comments is not None:
+                    page_comments = page_comments[:max_comments - comments_count]
+
+                next_page_token = page.get('nextPageToken')
+                if max_comments is not None and comments_count + len(page_comments) >= max_comments:
+                    next_page_token = None
+
+                # the rows of the page and the token of the next one are stored at once
+                scored_comments = pd.DataFrame(self.score_comments(page_comments, known_labels), columns=columns)
+                store.append(store_id, scored_comments,
+                             checkpoint={'next_page_token': next_page_token} if next_page_token else None)
+                comments_count += len(page_comments)
+
+                if not next_page_token:
+                    break
+        finally:
+            pages.close()
+
+        return comments_count
+
+    def fetch_videos_info(self, video_ids: list[str]) -> dict[str, dict]:
+        '''Returns the info of the videos for the analytics index, or no info if it can not be fetched.'''
+        connection = YoutubeVideosInfoBatchConnection(self.YOUTUBE_API_KEY, scheduler=self.scheduler,
+                                                      **({'api_endpoint': self.api_endpoint} if self.api_endpoint else {}))
+        try:
+            return connection.fetch_videos_info(video_ids)
+        except Exception as error:
+            # the comments are worth analyzing anyway, and are indexed without the video info
+            print(f"Could not fetch the info of the videos: {error!r}")
+            return {}
+
+    def run(self, video_ids: list[str] | None = None) -> dict[str, int]:
+        '''Analyzes every video of the job that is not done yet.
+        `video_ids` are added to the job the first time, and ignored when resuming it.
+        Returns the number of videos of the job by status.'''
+
+        if self.checkpoint is None:
+            raise ValueError("A batch job needs a job name to keep its checkpoint.")
+
+        if not self.checkpoint.video_ids:
+            self.checkpoint.set_video_ids(video_ids or [])
+
+        pending_video_ids = self.checkpoint.pending_video_ids()
+        print(f"{len(pending_video_ids)} of {len(self.checkpoint.video_ids)} videos left to analyze.")
+        videos_info = self.fetch_videos_info(pending_video_ids) if self.analytics_index is not None else {}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self.analyze_video, video_id): video_id for video_id in pending_video_ids}
+
+            for future in as_completed(futures):
+                video_id = futures[future]
+                try:
+                    comments_count = future.result()
+                except Exception as error:
+                    # the video keeps its stored pages, and is retried by the next run
+                    print(f"Analysis of {video_id} failed: {error!r}")
+                    self.checkpoint.set_status(video_id, 'failed', error=repr(error))
+                    metrics.increment('videos', status='failed')
+                else:
+                    print(f"Analyzed {comments_count} comments of {video_id}.")
+                    self.checkpoint.set_status(video_id, 'done', comments=comments_count)
+                    metrics.increment('videos', status='done')
+                    if self.analytics_index is not None:
+                        self.analytics_index.index_cached_video(self.cache, video_id, videos_info.get(video_id))
+
+        return self.checkpoint.summary()
+
+
+def parse_arguments(arguments: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Analyze the comments of many YouTube videos without a display.")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--channel', help="id of a channel, to analyze all its uploads")
+    source.add_argument('--playlist', help="id of a playlist, to analyze all its videos")
+    source.add_argument('--video-ids-file', help="file with one video id per line")
+    parser.add_argument('--job', help="name of the job, used to resume it (by default, the channel, playlist or file name)")
+    parser.add_argument('--workers', type=int, default=4, help="videos fetched at the same time")
+    parser.add_argument('--requests-per-second', type=float, default=10, help="limit of requests to the YouTube API")
+    parser.add_argument('--scoring-workers', type=int, default=0, help="processes that score comments (0 scores in this process)")
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--backend', choices=ModelRegistry.backends, default='pytorch', help="way the sentiment model runs")
+    parser.add_argument('--full-corpus', action='store_true', help="analyze every comment, with no length or count limit")
+    parser.add_argument('--include-replies', action='store_true', help="analyze the replies of the comments too")
+    parser.add_argument('--memo-cache', action='store_true', help="reuse the sentiments of texts analyzed before")
+    parser.add_argument('--near-duplicates', action='store_true', help="score only once the texts that are almost the same")
+    parser.add_argument('--prefilter-threshold', type=float, help="label the texts the prefilter (see train_prefilter.py) is this confident about without the model")
+    parser.add_argument('--api-endpoint', help="address of the YouTube Data API (for example, a local fake server)")
+    parser.add_argument('--api-key', action='append', help="YouTube API key, can be given several times to spread the quota (by default, the ones in .dev/keys.json)")
+    parser.add_argument('--no-analytics-index', action='store_true', help="do not add the analyzed videos to the analytics index")
+    parser.add_argument('--metrics', help="file where the metrics are written in the Prometheus text format at the end")
+    parser.add_argument('--metrics-log', help="file where every measured step is logged as a JSON line")
+    parser.add_argument('--profile', help="file where sampled call stacks are written as folded stacks, for flame graphs")
+    parsed_arguments = parser.parse_args(arguments)
+
+    if parsed_arguments.job is None:
+        if parsed_arguments.video_ids_file is not None:
+            parsed_arguments.job = os.path.splitext(os.path.basename(parsed_arguments.video_ids_file))[0]
+        else:
+            parsed_arguments.job = parsed_arguments.channel or parsed_arguments.playlist
+
+    if parsed_arguments.job is None:
+        parser.error("a source (--channel, --playlist or --video-ids-file) or the --job to resume is needed")
+
+    return parsed_arguments
+
+
+if __name__ == '__main__':
+
+    arguments = parse_arguments()
+    if arguments.metrics_log:
+        metrics.enable_structured_logs(arguments.metrics_log)
+    profiler = SamplingProfiler(arguments.profile) if arguments.profile else None
+
+    api_keys = arguments.api_key or ReadApiKeys().youtube_api_keys()
+    scheduler = ApiScheduler(api_keys, arguments.requests_per_second)
+    memo_cache = SentimentMemoCache() if arguments.memo_cache else None
+    scoring_pool = SentimentScoringPool(workers=arguments.scoring_workers, batch_size=arguments.batch_size,
+                                        memo_cache_path=memo_cache.path if memo_cache else None,
+                                        backend=arguments.backend, prefilter_threshold=arguments.prefilter_threshold) if arguments.scoring_workers else None
+
+    runner = BatchRunner(api_keys[0], arguments.job, scheduler=scheduler, max_workers=arguments.workers,
+                         requests_per_second=arguments.requests_per_second, api_endpoint=arguments.api_endpoint,
+                         batch_size=arguments.batch_size, full_corpus=arguments.full_corpus,
+                         include_replies=arguments.include_replies, scoring_pool=scoring_pool, memo_cache=memo_cache,
+                         backend=arguments.backend, near_duplicates=arguments.near_duplicates,
+                         analytics_index=None if arguments.no_analytics_index else AnalyticsIndex(),
+                         prefilter_threshold=arguments.prefilter_threshold)
+
+    video_ids = None
+    if not runner.checkpoint.video_ids:
+        video_ids = runner.resolve_video_ids(arguments.channel, arguments.playlist, arguments.video_ids_file)
+
+    if profiler is not None:
+        profiler.start()
+    try:
+        print(runner.run(video_ids))
+        print(f"Quota used by key: {scheduler.quota_usage()}")
+    finally:
+        if profiler is not None:
+            profiler.stop()
+        if arguments.metrics:
+            metrics.write_prometheus(arguments.metrics)
+        if scoring_pool is not None:
+            scoring_pool.close()
@@ -0,0 +1,290 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import threading
+import datetime
+from typing import Callable, Iterable
+import numpy as np
+from fake_youtube import FakeYoutubeServer
+from conections import (YoutubeCommentsConnection, YoutubeVideosInfoBatchConnection, YoutubeVideoCommentsDataCleaner,
+                        SentimentAnalyzer, ApiScheduler, ModelRegistry)
+from data_transformation import DataTransformations, IncrementalAggregator
+from utils import ColumnarStore, HttpCache
+
+
+def current_rss_mb() -> float:
+    '''Returns the resident memory of the process in MB (only on Linux, 0 elsewhere).'''
+    try:
+        with open('/proc/self/statm', "r") as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        return 0.0
+
+
+class PeakMemorySampler:
+    '''Samples the resident memory of the process in a background thread while it is used
+    as a context manager, and keeps the peak in `peak_rss_mb`.
+    The process memory includes everything allocated before (like the model, or the outputs of
+    previous stages), so `rss_growth_mb` is how much the peak grew over the memory at the start.'''
+
+    def __init__(self, interval: float = 0.01) -> None:
+        self.interval = interval
+        self.start_rss_mb = 0.0
+        self.peak_rss_mb = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def rss_growth_mb(self) -> float:
+        return self.peak_rss_mb - self.start_rss_mb
+
+    def __enter__(self) -> 'PeakMemorySampler':
+        self.start_rss_mb = self.peak_rss_mb = current_rss_mb()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.peak_rss_mb = max(self.peak_rss_mb, current_rss_mb())
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.peak_rss_mb = max(self.peak_rss_mb, current_rss_mb())
+
+
+class BenchmarkSuite:
+    '''Benchmarks of the analysis hot paths, run against a local `FakeYoutubeServer`.
+    For every size (number of comments of the video), the stages run one after the other
+    over the output of the previous one, and each one is measured separately:
+      - `fetch`: paging through `commentThreads.list`.
+      - `video_info`: `videos.list` requests for one video id every 100 comments.
+      - `clean`: cleaning the comment pages.
+      - `score`: scoring the comments of each page with the sentiment model.
+      - `aggregate`: updating the plot aggregates with each page.
+      - `cache_write`: appending each page to the columnar cache store.
+    Each stage reports its throughput (items per second), the p50 and p95 latency of its
+    units of work (pages, or requests for `video_info`) and how much the stage grew the resident memory.
+    With `unique_texts`, no two comments are the same, so duplicates do not hide the scoring cost.
+    With `recordings_path`, the videos recorded there are replayed instead of the synthetic sizes.'''
+
+    stages = ('fetch', 'video_info', 'clean', 'score', 'aggregate', 'cache_write')
+
+    def __init__(self, sizes: Iterable[int] = (1000, 10000, 100000), stages: Iterable[str] | None = None,
+                 batch_size: int = 32, backend: str = 'pytorch', latency: float = 0.0, unique_texts: bool = True,
+                 recordings_path: str | None = None) -> None:
+        self.sizes = list(sizes)
+        self.selected_stages = list(stages or self.stages)
+        unknown_stages = set(self.selected_stages) - set(self.stages)
+        if unknown_stages:
+            raise ValueError(f"Unknown stages {sorted(unknown_stages)}. They must be some of {list(self.stages)}.")
+
+        self.batch_size = batch_size
+        self.backend = backend
+        self.latency = latency
+        self.unique_texts = unique_texts
+        self.recordings_path = recordings_path
+
+    def run(self) -> dict:
+        '''Runs every selected stage at every size, and returns the results with the environment they ran in.'''
+
+        if 'score' in self.selected_stages:
+            # loading the model is not part of the scoring time
+            SentimentAnalyzer.warm_up(self.backend)
+
+        results = {}
+        if self.recordings_path is not None:
+            for file_name in sorted(os.listdir(self.recordings_path)):
+                if file_name.endswith('.json'):
+                    video_id = file_name.removesuffix('.json')
+                    results.update(self.run_video(video_id, video_id))
+        else:
+            for size in self.sizes:
+                results.update(self.run_video(f"bench{size}", str(size), size))
+
+        return {
+            'created_at': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+            'environment': {
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'backend': self.backend,
+                'batch_size': self.batch_size,
+            },
+            'results': results,
+        }
+
+    def run_video(self, video_id: str, label: str, size: int = 0) -> dict[str, dict]:
+        '''Runs the stages over the comments of a video of the fake server, with `size` comments
+        if it is not recorded. Results are keyed by `<stage>@<label>`.'''
+        results = {}
+
+        with FakeYoutubeServer(comments_per_video=size, latency=self.latency, unique_texts=self.unique_texts,
+                               recordings_path=self.recordings_path) as server, tempfile.TemporaryDirectory() as directory:
+            scheduler = ApiScheduler('benchmark')
+
+            # every stage after fetch needs the pages, so they are always fetched
+            connection = YoutubeCommentsConnection('benchmark', video_id, api_endpoint=server.url, scheduler=scheduler)
+            pages, results[f'fetch@{label}'] = self.measure(
+                connection.iter_comment_pages(), count=lambda pages: sum(len(page['items']) for page in pages))
+
+            if 'video_info' in self.selected_stages:
+                videos_connection = YoutubeVideosInfoBatchConnection('benchmark', http_cache=HttpCache(os.path.join(directory, 'http')),
+                                                                     api_endpoint=server.url, scheduler=scheduler)
+                video_ids = [f"{video_id}_{index}" for index in range(max(1, results[f'fetch@{label}']['items'] // 100))]
+                groups = [video_ids[start:start + videos_connection.max_ids_per_request]
+                          for start in range(0, len(video_ids), videos_connection.max_ids_per_request)]
+                _, results[f'video_info@{label}'] = self.measure(
+                    (videos_connection.fetch_data(group) for group in groups), count=lambda responses: len(video_ids))
+
+            cleaner = YoutubeVideoCommentsDataCleaner(full_corpus=True)
+            cleaned_pages, results[f'clean@{label}'] = self.measure(
+                (cleaner.clean_page(page) for page in pages), count=self.count_comments)
+
+            if any(stage in self.selected_stages for stage in ('score', 'aggregate', 'cache_write')):
+                scored_pages, results[f'score@{label}'] = self.measure(
+                    self.iter_scored_pages(cleaned_pages), count=self.count_comments)
+            else:
+                scored_pages = []
+
+            if 'aggregate' in self.selected_stages:
+                _, results[f'aggregate@{label}'] = self.measure(self.iter_aggregated_pages(scored_pages),
+                                                               count=lambda _: sum(map(len, scored_pages)))
+
+            if 'cache_write' in self.selected_stages:
+                store = ColumnarStore(os.path.join(directory, 'store'))
+                _, results[f'cache_write@{label}'] = self.measure(
+                    (store.append(video_id, page) for page in scored_pages), count=lambda _: sum(map(len, scored_pages)))
+
+        return {key: result for key, result in results.items() if key.split('@')[0] in self.selected_stages}
+
+    def iter_scored_pages(self, cleaned_pages: list[list[dict[str, str]]]):
+        analyzer = SentimentAnalyzer(backend=self.backend)
+        for page_comments in cleaned_pages:
+            sentiments = analyzer.apply_model_to_batch([comment['text'] for comment in page_comments],
+                                                       batch_size=self.batch_size, show_progress=False)
+            yield [{**comment, 'sentiment': sentiment} for comment, sentiment in zip(page_comments, sentiments)]
+
+    def iter_aggregated_pages(self, scored_pages: list[list[dict[str, str]]]):
+        aggregator = IncrementalAggregator()
+        for page_comments in scored_pages:
+            aggregator.update(page_comments)
+            yield aggregator.count_sentiments()
+
+        # the aggregates of the whole video at once, like the GUI computes them from the cache
+        yield DataTransformations([comment for page_comments in scored_pages for comment in page_comments]).count_sentiments()
+
+    @staticmethod
+    def count_comments(pages: list[list]) -> int:
+        return sum(len(page) for page in pages)
+
+    @staticmethod
+    def measure(units: Iterable, count: Callable[[list], int]) -> tuple[list, dict]:
+        '''Consumes `units`, an iterable that does one unit of work on every step, and measures it.
+        Returns the outputs of the units, and their statistics (with `count(outputs)` as the number of items).'''
+
+        outputs, latencies = [], []
+        with PeakMemorySampler() as memory:
+            start = last_time = time.perf_counter()
+            for output in units:
+                now = time.perf_counter()
+                latencies.append(now - last_time)
+                outputs.append(output)
+                last_time = now
+            seconds = time.perf_counter() - start
+
+        items = count(outputs)
+        return outputs, {
+            'items': items,
+            'seconds': seconds,
+            'throughput': items / seconds if seconds else float('inf'),
+            'p50_ms': float(np.percentile(latencies, 50) * 1000) if latencies else 0.0,
+            'p95_ms': float(np.percentile(latencies, 95) * 1000) if latencies else 0.0,
+            'peak_rss_mb': memory.peak_rss_mb,
+            'rss_growth_mb': memory.rss_growth_mb,
+        }
+
+
+def compare_with_baseline(results: dict, baseline: dict, tolerance: float = 0.2, min_latency_ms: float = 1.0,
+                          min_memory_mb: float = 5.0) -> list[str]:
+    '''Returns a description of every regression of `results` against `baseline`: a throughput
+    lower, or a p95 latency or a memory growth higher, than the baseline by more than `tolerance`.
+    Latencies and memory growths are only compared when they differ by more than `min_latency_ms`
+    and `min_memory_mb`, to ignore noise.'''
+
+    regressions = []
+    for key, result in results['results'].items():
+        reference = baseline['results'].get(key)
+        if reference is None:
+            continue
+
+        if result['throughput'] < reference['throughput'] * (1 - tolerance):
+            regressions.append(f"{key}: throughput {result['throughput']:.0f}/s, baseline {reference['throughput']:.0f}/s")
+
+        if (result['p95_ms'] > reference['p95_ms'] * (1 + tolerance)
+                and result['p95_ms'] - reference['p95_ms'] > min_latency_ms):
+            regressions.append(f"{key}: p95 {result['p95_ms']:.1f} ms, baseline {reference['p95_ms']:.1f} ms")
+
+        # baselines saved before the memory growth was measured are not compared
+        reference_growth = reference.get('rss_growth_mb')
+        if (reference_growth is not None and result['rss_growth_mb'] > reference_growth * (1 + tolerance)
+                and result['rss_growth_mb'] - reference_growth > min_memory_mb):
+            regressions.append(f"{key}: memory growth {result['rss_growth_mb']:.0f} MB, baseline {reference_growth:.0f} MB")
+
+    return regressions
+
+
+def print_results(results: dict) -> None:
+    print(f"{'stage':<24}{'items':>10}{'seconds':>10}{'items/s':>12}{'p50 ms':>10}{'p95 ms':>10}{'+MB':>8}{'peak MB':>10}")
+    for key, result in results['results'].items():
+        print(f"{key:<24}{result['items']:>10}{result['seconds']:>10.2f}{result['throughput']:>12.0f}"
+              f"{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}{result['rss_growth_mb']:>8.0f}{result['peak_rss_mb']:>10.0f}")
+
+
+def parse_arguments(arguments: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the analysis stages against a local fake YouTube API.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help="comments of the benchmarked videos")
+    parser.add_argument('--stages', nargs='+', choices=BenchmarkSuite.stages, help="stages to measure (all by default)")
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--backend', choices=ModelRegistry.backends, default='pytorch', help="way the sentiment model runs")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds the fake API waits before each answer")
+    parser.add_argument('--duplicated-texts', action='store_true', help="repeat the comment texts, like real videos do")
+    parser.add_argument('--recordings', help="directory of videos saved with fake_youtube.record_video, to replay them")
+    parser.add_argument('--output', help="file to write the results to, as JSON")
+    parser.add_argument('--baseline', default='.cache/benchmarks/baseline.json', help="results to compare with")
+    parser.add_argument('--save-baseline', action='store_true', help="store the results as the new baseline")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="relative change allowed before reporting a regression")
+    return parser.parse_args(arguments)
+
+
+if __name__ == '__main__':
+
+    arguments = parse_arguments()
+    suite = BenchmarkSuite(arguments.sizes, arguments.stages, arguments.batch_size, arguments.backend,
+                           arguments.latency, not arguments.duplicated_texts, arguments.recordings)
+    results = suite.run()
+    print_results(results)
+
+    if arguments.output:
+        with open(arguments.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if arguments.save_baseline:
+        os.makedirs(os.path.dirname(arguments.baseline) or '.', exist_ok=True)
+        with open(arguments.baseline, "w") as file:
+            json.dump(results, file, indent=2)
+        print(f"Saved the baseline in {arguments.baseline}")
+
+    elif os.path.exists(arguments.baseline):
+        with open(arguments.baseline, "r") as file:
+            regressions = compare_with_baseline(results, json.load(file), arguments.tolerance)
+
+        for regression in regressions:
+            print(f"Regression in {regression}")
+        print(f"{len(regressions)} regressions against {arguments.baseline}")
+        sys.exit(1 if regressions else 0)
@@ -1,17 +1,158 @@
 import os
+import re
+import gc
+import html
+import json
+import zlib
+import time
+import random
+import datetime
+import threading
+import multiprocessing
+from collections import deque, Counter, defaultdict
+from contextlib import contextmanager
+from queue import Queue, Empty
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import numpy as np
 import googleapiclient.discovery
 import requests
-from transformers import pipeline, Pipeline
 from tqdm import tqdm
-from utils import ReadApiKeys, Cache # just for debug things
+from utils import ReadApiKeys, Cache, SentimentMemoCache, HttpCache
+from instrumentation import metrics
+from analytics import AnalyticsIndex
 from abc import ABC
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+if TYPE_CHECKING:
+    from transformers import Pipeline
 
 os.environ["OAUTHLIB_INSECURE_TRANSPORT"] = "1"
 
+class ModelRegistry:
+    '''Process wide registry of pipeline models.
+    Each model is loaded the first time it is requested and then shared by 
+    every analyzer of the process, until it is unloaded.
+    A model can be loaded with one of these `backends`:
+      - `pytorch`: the full precision PyTorch model.
+      - `quantized`: the PyTorch model with its linear layers quantized to int8 on the fly.
+      - `onnx`: the model exported to ONNX and run by ONNX Runtime.
+      - `onnx-int8`: the ONNX model with its weights quantized to int8.
+    ONNX models are exported once to `onnx_path`, and need `optimum[onnxruntime]`.'''
+
+    backends = ('pytorch', 'quantized', 'onnx', 'onnx-int8')
+    onnx_path = '.cache/onnx/'
+
+    _models: dict[tuple[str, str], 'Pipeline'] = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def get_model(cls, model_name: str, backend: str = 'pytorch', **pipeline_kwargs) -> 'Pipeline':
+        '''Returns the pipeline of `model_name` for `backend`, loading it if it is not loaded yet.
+        `pipeline_kwargs` are only used when the model is loaded.'''
+
+        model = cls._models.get((model_name, backend))
+        if model is not None:
+            return model
+
+        if backend not in cls.backends:
+            raise ValueError(f"Unknown backend {backend}. It must be one of {list(cls.backends)}.")
+
+        with cls._lock:
+            # another thread may have loaded the model while waiting for the lock
+            if (model_name, backend) not in cls._models:
+                print(f"Loading {model_name} model ({backend}).")
+                if backend.startswith('onnx'):
+                    cls._models[(model_name, backend)] = cls.load_onnx_model(model_name, backend == 'onnx-int8', **pipeline_kwargs)
+                else:
+                    cls._models[(model_name, backend)] = cls.load_pytorch_model(model_name, backend == 'quantized', **pipeline_kwargs)
+
+            return cls._models[(model_name, backend)]
+
+    @classmethod
+    def load_pytorch_model(cls, model_name: str, quantize: bool = False, **pipeline_kwargs) -> 'Pipeline':
+        # transformers is imported here, so importing this module stays cheap
+        from transformers import pipeline
+
+        model = pipeline(model=model_name, **pipeline_kwargs)
+        if quantize:
+            import torch
+            model.model = torch.quantization.quantize_dynamic(model.model, {torch.nn.Linear}, dtype=torch.qint8)
+
+        return model
+
+    @classmethod
+    def load_onnx_model(cls, model_name: str, quantize: bool = False, revision: str = 'main', **pipeline_kwargs) -> 'Pipeline':
+        try:
+            import onnxruntime
+            from optimum.onnxruntime import ORTModelForSequenceClassification, ORTQuantizer
+            from optimum.onnxruntime.configuration import AutoQuantizationConfig
+        except ImportError as error:
+            raise ImportError("The ONNX backends need optimum with ONNX Runtime: pip install optimum[onnxruntime]") from error
+        from transformers import AutoTokenizer, pipeline
+
+        # export the model only the first time, keeping one export per model revision
+        export_path = os.path.join(cls.onnx_path, model_name.replace('/', '--'), revision)
+        if not os.path.exists(os.path.join(export_path, 'model.onnx')):
+            print(f"Exporting {model_name} model to ONNX.")
+            ORTModelForSequenceClassification.from_pretrained(model_name, revision=revision, export=True).save_pretrained(export_path)
+            AutoTokenizer.from_pretrained(model_name, revision=revision).save_pretrained(export_path)
+
+        file_name = 'model.onnx'
+        if quantize:
+            file_name = 'model_quantized.onnx'
+            if not os.path.exists(os.path.join(export_path, file_name)):
+                print(f"Quantizing {model_name} ONNX model.")
+                quantizer = ORTQuantizer.from_pretrained(export_path)
+                quantizer.quantize(save_dir=export_path, quantization_config=AutoQuantizationConfig.avx2(is_static=False, per_channel=False))
+
+        # ONNX Runtime does not read OMP_NUM_THREADS, so scoring processes pass their limit here
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = int(os.environ.get("OMP_NUM_THREADS", 0))
+
+        model = ORTModelForSequenceClassification.from_pretrained(export_path, file_name=file_name, session_options=session_options)
+        return pipeline('text-classification', model=model, tokenizer=AutoTokenizer.from_pretrained(export_path), **pipeline_kwargs)
+
+    @classmethod
+    def is_loaded(cls, model_name: str, backend: str = 'pytorch') -> bool:
+        return (model_name, backend) in cls._models
+
+    @classmethod
+    def unload(cls, model_name: str | None = None) -> None:
+        '''Unloads every backend of `model_name`, or every loaded model if no name is given.'''
+
+        with cls._lock:
+            for loaded_model_name, backend in list(cls._models):
+                if model_name is None or loaded_model_name == model_name:
+                    del cls._models[(loaded_model_name, backend)]
+
+        gc.collect()
+
+
+
 class PipelineAnalyzer(ABC):
-    '''Class for analyzing data using a pipeline model.'''
+    '''Class for analyzing data using a pipeline model.
+    `backend` is the way the model runs (see `ModelRegistry.backends`), and it can 
+    be changed for each analyzer.'''
+
+    model_name: str
+    pipeline_kwargs: dict = {}
+    backend = 'pytorch'
+
+    @property
+    def model(self) -> 'Pipeline':
+        '''The shared pipeline of the analyzer. It is loaded on first use.'''
+        return ModelRegistry.get_model(self.model_name, self.backend, **self.pipeline_kwargs)
+
+    @classmethod
+    def warm_up(cls, backend: str | None = None) -> None:
+        '''Loads the model of the analyzer ahead of its first use.'''
+        ModelRegistry.get_model(cls.model_name, backend or cls.backend, **cls.pipeline_kwargs)
 
-    model: Pipeline
+    @classmethod
+    def unload(cls) -> None:
+        '''Releases the model of the analyzer. It will be loaded again if it is used.'''
+        ModelRegistry.unload(cls.model_name)
 
     def apply_model_to_data(self, data):
         pass
@@ -19,10 +160,21 @@ class PipelineAnalyzer(ABC):
 class SentimentAnalyzer(PipelineAnalyzer):
     '''Class for analyzing the sentiment of text using a pipeline model.'''
 
-    model = pipeline(
-        model="lxyuan/distilbert-base-multilingual-cased-sentiments-student", 
-        top_k=1
-        )
+    model_name = "lxyuan/distilbert-base-multilingual-cased-sentiments-student"
+    model_revision = "main"
+    pipeline_kwargs = {'top_k': 1, 'revision': model_revision}
+
+    def __init__(self, memo_cache: SentimentMemoCache | None = None, backend: str | None = None,
+                 duplicates_cleaner: 'YoutubeCommentsDuplicatesCleaner | None' = None) -> None:
+        self.memo_cache = memo_cache
+        if backend is not None:
+            self.backend = backend
+        self.duplicates_cleaner = duplicates_cleaner or YoutubeCommentsDuplicatesCleaner()
+
+    @property
+    def memo_revision(self) -> str:
+        # other backends may give slightly different labels, so they are memoized apart
+        return self.model_revision if self.backend == 'pytorch' else f"{self.model_revision}+{self.backend}"
 
     def apply_model_to_data(self, text: str) -> str:
         '''Uses lxyuan/distilbert-base-multilingual-cased-sentiments-student 
@@ -35,9 +187,386 @@ class SentimentAnalyzer(PipelineAnalyzer):
 
         # return the label of the top 1 sentiment
         return response[0][0]['label']
+
+    # number of tokens shared by consecutive windows of a long text
+    window_overlap = 64
+
+    def count_tokens(self, texts: list[str]) -> list[int]:
+        '''Returns the number of tokens the model tokenizer produces for each text.'''
+        with metrics.timer('tokenize', backend=self.backend) as details:
+            tokens_count = [len(input_ids) for input_ids in self.model.tokenizer(texts, truncation=False)['input_ids']]
+            details['items'] = len(texts)
+
+        metrics.increment('tokens', sum(tokens_count), backend=self.backend)
+        return tokens_count
+
+    def apply_model_to_long_text(self, text: str, batch_size: int = 32) -> str:
+        '''Gets the principal sentiment label of a text longer than the model input.
+        The text is split in overlapping token windows that fit in the model, 
+        and the scores of every window are averaged, weighted by their length.'''
+
+        tokenizer = self.model.tokenizer
+        window_size = tokenizer.model_max_length - 2  # leave room for the special tokens
+        input_ids = tokenizer(text, add_special_tokens=False, truncation=False)['input_ids']
+
+        overlap = min(self.window_overlap, window_size // 2)
+        windows = [input_ids[start:start + window_size]
+                   for start in range(0, max(1, len(input_ids) - overlap), window_size - overlap)]
+        with metrics.timer('model_forward', backend=self.backend, kind='long_text') as details:
+            responses = self.model([tokenizer.decode(window) for window in windows], 
+                                   batch_size=batch_size, truncation=True, top_k=None)
+            details['batch_size'] = len(windows)
+
+        scores: dict[str, float] = {}
+        for window, response in zip(windows, responses):
+            for label_score in response:
+                scores[label_score['label']] = scores.get(label_score['label'], 0) + label_score['score'] * len(window)
+
+        return max(scores, key=scores.get)
+
+    @staticmethod
+    def apply_known_labels(texts: list[str], known_labels: dict[str, str],
+                           score: Callable[[list[str]], list[str]]) -> list[str]:
+        '''Returns the labels of `texts`, taking them from `known_labels` (labels by normalized text)
+        when the text was seen before, and from `score(new_texts)` otherwise.
+        The labels of the new texts are added to `known_labels`.'''
+
+        normalized_texts = [SentimentMemoCache.normalize_text(text) for text in texts]
+        new_positions = [position for position, text in enumerate(normalized_texts) if text not in known_labels]
+        metrics.increment('known_texts', len(texts) - len(new_positions))
+
+        if new_positions:
+            new_labels = score([texts[position] for position in new_positions])
+            for position, label in zip(new_positions, new_labels):
+                known_labels[normalized_texts[position]] = label
+
+        return [known_labels[text] for text in normalized_texts]
+
+    def apply_model_to_batch(self, texts: list[str], batch_size: int = 32, show_progress: bool = True,
+                             known_labels: dict[str, str] | None = None) -> list[str]:
+        '''Gets the principal sentiment label of every text in `texts`.
+        Duplicated texts are found by the analyzer `duplicates_cleaner`, so only one text 
+        of each group is scored, and its label is given to all the texts of the group.
+        To find duplicates across batches too (like the pages of a video), pass the same
+        `known_labels` dict to every call: texts labeled before are not scored again.
+        Returns the labels in the same order as `texts`.'''
+
+        if known_labels is not None:
+            return self.apply_known_labels(
+                texts, known_labels, lambda new_texts: self.apply_model_to_batch(new_texts, batch_size, show_progress))
+
+        unique_texts, positions = self.duplicates_cleaner.group_texts(texts)
+        metrics.increment('texts', len(texts))
+        metrics.increment('duplicated_texts', len(texts) - len(unique_texts))
+        labels = self.apply_model_to_unique_texts(unique_texts, batch_size, show_progress)
+
+        return [labels[position] for position in positions]
+
+    def apply_model_to_unique_texts(self, texts: list[str], batch_size: int = 32, show_progress: bool = True) -> list[str]:
+        '''Gets the principal sentiment label of every text in `texts`.
+        If the analyzer has a `memo_cache`, only the texts that are not memoized yet 
+        go through the model, and their labels are memoized.'''
+
+        if self.memo_cache is None:
+            return self.infer_labels(texts, batch_size, show_progress)
+
+        keys = [self.memo_cache.key(text, self.model_name, self.memo_revision) for text in texts]
+        labels = self.memo_cache.get_many(keys)
+        metrics.increment('memo_cache_lookups', len(labels), result='hit')
+        metrics.increment('memo_cache_lookups', len(keys) - len(labels), result='miss')
+
+        missing_texts = {key: text for key, text in zip(keys, texts) if key not in labels}
+        inferred_labels = dict(zip(missing_texts, self.infer_labels(list(missing_texts.values()), batch_size, show_progress)))
+        self.memo_cache.put_many(inferred_labels)
+        labels.update(inferred_labels)
+
+        return [labels[key] for key in keys]
+
+    def infer_labels(self, texts: list[str], batch_size: int = 32, show_progress: bool = True) -> list[str]:
+        '''Runs every text of `texts` through the model and returns their labels, in the same order.
+        Texts are sorted by token length before being grouped in batches of
+        `batch_size`, so each batch is padded only up to similar lengths.'''
+
+        # sort the text positions by token length, to keep padding low inside each batch
+        tokens_count = self.count_tokens(texts) if texts else []
+        order = sorted(range(len(texts)), key=lambda index: tokens_count[index])
+
+        labels: list[str] = [''] * len(texts)
+
+        # texts longer than the model input are scored by windows instead of being truncated
+        max_tokens = self.model.tokenizer.model_max_length
+        while order and tokens_count[order[-1]] > max_tokens:
+            index = order.pop()
+            labels[index] = self.apply_model_to_long_text(texts[index], batch_size)
+
+        # long texts are already scored, so only the batches of the other ones are left
+        batches_count = -(-len(order) // batch_size)
+        for batch in tqdm(self.iter_batches(order, batch_size), total=batches_count, disable=not show_progress):
+            with metrics.timer('model_forward', backend=self.backend, kind='batch') as details:
+                responses = self.model([texts[index] for index in batch], batch_size=batch_size, truncation=True)
+                details['batch_size'] = len(batch)
+            metrics.observe('model_batch_size', len(batch), backend=self.backend)
+
+            # write each label back to the original position of its text
+            for index, response in zip(batch, responses):
+                labels[index] = response[0]['label']
+
+        return labels
+
+    @classmethod
+    def check_backend_parity(cls, texts: list[str], backend: str, reference_backend: str = 'pytorch',
+                             batch_size: int = 32, min_agreement: float = 0.98) -> dict:
+        '''Scores `texts` with `backend` and with `reference_backend`, and compares them.
+        Returns the share of texts with the same label (`agreement`), whether it reaches 
+        `min_agreement`, the seconds each backend took, and a few texts where they disagree.'''
+
+        results = {}
+        for checked_backend in (reference_backend, backend):
+            analyzer = cls(backend=checked_backend)
+            analyzer.warm_up(checked_backend)
+
+            start = time.perf_counter()
+            labels = analyzer.infer_labels(texts, batch_size, show_progress=False)
+            results[checked_backend] = (labels, time.perf_counter() - start)
+
+        (reference_labels, reference_seconds), (labels, seconds) = results[reference_backend], results[backend]
+        disagreements = [(text, reference_label, label)
+                         for text, reference_label, label in zip(texts, reference_labels, labels) if reference_label != label]
+        agreement = 1 - len(disagreements) / len(texts) if texts else 1.0
+
+        return {
+            'backend': backend,
+            'reference_backend': reference_backend,
+            'texts': len(texts),
+            'agreement': agreement,
+            'passed': agreement >= min_agreement,
+            'reference_seconds': reference_seconds,
+            'backend_seconds': seconds,
+            'speedup': reference_seconds / seconds if seconds else float('inf'),
+            'disagreements': disagreements[:20],
+        }
+
+    @staticmethod
+    def iter_batches(items: list, batch_size: int):
+        '''Yields consecutive slices of `items` with at most `batch_size` elements.'''
+        for start in range(0, len(items), batch_size):
+            yield items[start:start + batch_size]
     
 
 
+class SentimentPrefilter:
+    '''Cheap sentiment classifier to label the easy texts without the transformer.
+    It is a naive Bayes model over hashed features (lowercase words, word pairs, emoji and
+    other symbols, links, mentions and the number of words), trained on the labels the
+    full model gave to other texts, so it learns the emoji, slang and short praise of the
+    comments. `predict` returns a label and a confidence (the probability of the label,
+    calibrated on held out texts) for each text. An empty prefilter has no confidence in any label.'''
+
+    labels = ('negative', 'neutral', 'positive')
+    prefilter_path = '.cache/prefilter/'
+    token_pattern = re.compile(r'https?://\S+|@\w+|\w+|[^\w\s]', re.UNICODE)
+
+    def __init__(self, n_features: int = 2 ** 18, alpha: float = 0.5) -> None:
+        self.n_features = n_features
+        self.alpha = alpha
+        self.log_priors = None
+        self.log_likelihoods = None
+        self.temperature = 1.0
+        self.trained_texts = 0
+
+    @property
+    def is_fitted(self) -> bool:
+        return self.log_likelihoods is not None
+
+    def tokenize(self, text: str) -> list[str]:
+        words, tokens = [], []
+        for token in self.token_pattern.findall(text.lower()):
+            if token.startswith('http'):
+                tokens.append('<url>')
+            elif token.startswith('@'):
+                tokens.append('<mention>')
+            elif token[0].isalnum() or token[0] == '_':
+                words.append(token)
+            else:
+                tokens.append(token)
+
+        tokens += words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+        # every text has at least this feature, and very short texts are often easy to label
+        tokens.append(f"<words:{min(len(words), 5)}>")
+        return tokens
+
+    def hash_tokens(self, text: str) -> np.ndarray:
+        # crc32 gives the same buckets in every process, unlike hash()
+        return np.unique([zlib.crc32(token.encode('utf-8')) % self.n_features for token in self.tokenize(text)])
+
+    def fit(self, texts: list[str], labels: list[str], validation_share: float = 0.1, seed: int = 1) -> 'SentimentPrefilter':
+        '''Trains the prefilter on `texts` labeled by the full model. A `validation_share` of
+        them is held out to calibrate the confidences before training on every text.'''
+
+        label_codes = np.array([self.labels.index(label) for label in labels])
+        buckets = [self.hash_tokens(text) for text in texts]
+
+        validation = np.random.default_rng(seed).random(len(texts)) < validation_share
+        if validation.any() and not validation.all():
+            self._fit_counts([bucket for bucket, held_out in zip(buckets, validation) if not held_out], label_codes[~validation])
+            scores = self._scores([bucket for bucket, held_out in zip(buckets, validation) if held_out])
+            self.temperature = self._calibrate_temperature(scores, label_codes[validation])
+
+        self._fit_counts(buckets, label_codes)
+        self.trained_texts = len(texts)
+        return self
+
+    def predict(self, texts: list[str]) -> tuple[list[str], list[float]]:
+        '''Returns the most likely label of every text and its probability.'''
+        if not self.is_fitted or not texts:
+            return [''] * len(texts), [0.0] * len(texts)
+
+        probabilities = self._softmax(self._scores([self.hash_tokens(text) for text in texts]) / self.temperature)
+        codes = probabilities.argmax(axis=1)
+        return [self.labels[code] for code in codes], probabilities.max(axis=1).tolist()
+
+    def _fit_counts(self, buckets: list[np.ndarray], label_codes: np.ndarray) -> None:
+        counts = np.zeros((len(self.labels), self.n_features))
+        np.add.at(counts, (np.repeat(label_codes, [len(bucket) for bucket in buckets]), np.concatenate(buckets)), 1)
+
+        self.log_likelihoods = np.log((counts + self.alpha) /
+                                      (counts.sum(axis=1, keepdims=True) + self.alpha * self.n_features)).astype(np.float32)
+        label_counts = np.bincount(label_codes, minlength=len(self.labels)) + 1
+        self.log_priors = np.log(label_counts / label_counts.sum())
+
+    def _scores(self, buckets: list[np.ndarray]) -> np.ndarray:
+        # sum the log likelihoods of the features of each text at once
+        offsets = np.cumsum([0] + [len(bucket) for bucket in buckets[:-1]])
+        feature_scores = np.add.reduceat(self.log_likelihoods[:, np.concatenate(buckets)], offsets, axis=1)
+        return feature_scores.T + self.log_priors
+
+    @classmethod
+    def _calibrate_temperature(cls, scores: np.ndarray, label_codes: np.ndarray) -> float:
+        # naive Bayes is overconfident, so its scores are softened by the temperature
+        # that gives the held out labels the highest likelihood
+        temperatures = np.geomspace(0.5, 100, 60)
+        losses = [-np.log(cls._softmax(scores / temperature)[np.arange(len(label_codes)), label_codes] + 1e-12).mean()
+                  for temperature in temperatures]
+        return float(temperatures[int(np.argmin(losses))])
+
+    @staticmethod
+    def _softmax(scores: np.ndarray) -> np.ndarray:
+        exponentials = np.exp(scores - scores.max(axis=1, keepdims=True))
+        return exponentials / exponentials.sum(axis=1, keepdims=True)
+
+    @classmethod
+    def default_path(cls, model_name: str) -> str:
+        return os.path.join(cls.prefilter_path, model_name.replace('/', '--') + '.npz')
+
+    def save(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        np.savez_compressed(path, log_priors=self.log_priors, log_likelihoods=self.log_likelihoods,
+                            temperature=self.temperature, alpha=self.alpha, trained_texts=self.trained_texts)
+
+    @classmethod
+    def load(cls, path: str) -> 'SentimentPrefilter':
+        '''Loads a saved prefilter, or returns an empty one if there is none in `path`.'''
+        if not os.path.exists(path):
+            print(f"No sentiment prefilter in {path}, every text goes through the model.")
+            return cls()
+
+        with np.load(path) as saved:
+            prefilter = cls(n_features=saved['log_likelihoods'].shape[1], alpha=float(saved['alpha']))
+            prefilter.log_priors = saved['log_priors']
+            prefilter.log_likelihoods = saved['log_likelihoods']
+            prefilter.temperature = float(saved['temperature'])
+            prefilter.trained_texts = int(saved['trained_texts'])
+        return prefilter
+
+
+
+class TwoTierSentimentAnalyzer(SentimentAnalyzer):
+    '''Sentiment analyzer that labels the texts its `prefilter` is confident about
+    (with a probability of at least `threshold`) and escalates the rest to the model.
+    A higher `threshold` escalates more texts, which is slower and closer to the full model.
+    Use `check_prefilter_agreement` to choose it. The prefilter labels are memoized with the
+    `prefilter` source, so they are never taken for labels of the model (to train the prefilter, for example).'''
+
+    def __init__(self, prefilter: SentimentPrefilter | None = None, threshold: float = 0.9,
+                 memo_cache: SentimentMemoCache | None = None, backend: str | None = None,
+                 duplicates_cleaner: 'YoutubeCommentsDuplicatesCleaner | None' = None) -> None:
+        super().__init__(memo_cache, backend, duplicates_cleaner)
+        self.prefilter = prefilter or SentimentPrefilter.load(SentimentPrefilter.default_path(self.model_name))
+        self.threshold = threshold
+
+    def apply_model_to_unique_texts(self, texts: list[str], batch_size: int = 32, show_progress: bool = True) -> list[str]:
+        '''Gets the principal sentiment label of every text in `texts`, from the prefilter
+        when it is confident enough, and from the model (or its memo) otherwise.'''
+
+        with metrics.timer('prefilter') as details:
+            labels, confidences = self.prefilter.predict(texts)
+            details['items'] = len(texts)
+
+        escalated = [index for index, confidence in enumerate(confidences) if confidence < self.threshold]
+        metrics.increment('prefilter_texts', len(texts) - len(escalated), result='labeled')
+        metrics.increment('prefilter_texts', len(escalated), result='escalated')
+
+        if self.memo_cache is not None:
+            escalated_indexes = set(escalated)
+            self.memo_cache.put_many({self.memo_cache.key(text, self.model_name, self.memo_revision): label
+                                      for index, (text, label) in enumerate(zip(texts, labels))
+                                      if index not in escalated_indexes}, source='prefilter')
+
+        if escalated:
+            escalated_labels = super().apply_model_to_unique_texts([texts[index] for index in escalated], batch_size, show_progress)
+            for index, label in zip(escalated, escalated_labels):
+                labels[index] = label
+
+        return labels
+
+    def check_prefilter_agreement(self, texts: list[str], reference_labels: list[str] | None = None,
+                                  thresholds: Iterable[float] = (0.6, 0.7, 0.8, 0.9, 0.95, 0.99),
+                                  batch_size: int = 32, min_agreement: float = 0.98) -> dict:
+        '''Compares the labels of the two tiers with the ones of the full model for each threshold.
+        `reference_labels` are the full model labels of `texts` (they are inferred if not given).
+        For each threshold, it returns the share of texts the prefilter labels (`coverage`,
+        the forward passes saved), how many of those agree with the full model, and the
+        agreement of every label. The lowest threshold whose agreement reaches `min_agreement`
+        is returned as `recommended_threshold` (None if no threshold reaches it).'''
+
+        model_seconds = None
+        if reference_labels is None:
+            start = time.perf_counter()
+            reference_labels = self.infer_labels(texts, batch_size, show_progress=False)
+            model_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        labels, confidences = self.prefilter.predict(texts)
+        prefilter_seconds = time.perf_counter() - start
+
+        reference = np.array(reference_labels, dtype=object)
+        predicted = np.array(labels, dtype=object)
+        confidences = np.array(confidences)
+        matches = predicted == reference
+
+        thresholds_report = []
+        for threshold in sorted(thresholds):
+            labeled = confidences >= threshold
+            thresholds_report.append({
+                'threshold': threshold,
+                'coverage': float(labeled.mean()) if len(texts) else 0.0,
+                'labeled_agreement': float(matches[labeled].mean()) if labeled.any() else 1.0,
+                # escalated texts get the full model label, so only the labeled ones can disagree
+                'agreement': float(1 - (labeled & ~matches).mean()) if len(texts) else 1.0,
+            })
+
+        passing = [report for report in thresholds_report if report['agreement'] >= min_agreement]
+        return {
+            'texts': len(texts),
+            'trained_texts': self.prefilter.trained_texts,
+            'model_seconds': model_seconds,
+            'prefilter_seconds': prefilter_seconds,
+            'thresholds': thresholds_report,
+            'recommended_threshold': passing[0]['threshold'] if passing else None,
+        }
+
+
+
 class Response(ABC):
     '''Abstract base class for handling responses.'''
     
@@ -84,10 +613,40 @@ class Connection(ABC):
 class YoutubeConnection(Connection): 
     '''Class for establishing a connection with YouTube.'''
 
+    # googleapiclient clients are not thread safe, so a client is lent to one thread at a time.
+    # Idle clients are kept by key and endpoint, and reused (with their keep-alive connections)
+    # by any thread, so the short lived threads that fetch each video do not build new ones
+    _idle_clients = defaultdict(list)
+    _clients_lock = threading.Lock()
+
+    api_endpoint = None
+
     def __init__(self, YOUTUBE_API_KEY: str, video_id: str) -> None:
         self.YOUTUBE_API_KEY = YOUTUBE_API_KEY
         self.video_id = video_id
 
+    @contextmanager
+    def youtube_client(self, api_key: str | None = None):
+        '''Lends an idle YouTube client for `api_key` (the connection key by default),
+        building a new one only when every client is in use by other threads.'''
+
+        api_key = api_key or self.YOUTUBE_API_KEY
+        client_key = (api_key, self.api_endpoint)
+        with self._clients_lock:
+            client = self._idle_clients[client_key].pop() if self._idle_clients[client_key] else None
+
+        if client is None:
+            client_options = {'api_endpoint': self.api_endpoint} if self.api_endpoint else None
+            with metrics.timer('youtube_client_build'):
+                client = googleapiclient.discovery.build(
+                    'youtube', 'v3', developerKey=api_key, client_options=client_options)
+
+        try:
+            yield client
+        finally:
+            with self._clients_lock:
+                self._idle_clients[client_key].append(client)
+
     def __build_connection(self):
         pass
     
@@ -96,18 +655,218 @@ class YoutubeConnection(Connection):
         
 
 
+class RateLimiter:
+    '''Thread safe token bucket that allows `requests_per_second` requests on average,
+    and bursts of up to `burst` requests after being idle.
+    A single instance can be shared by several connections to get a global limit.'''
+
+    def __init__(self, requests_per_second: float, burst: int = 1) -> None:
+        self.requests_per_second = requests_per_second
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        '''Blocks until the next request is allowed.'''
+
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.requests_per_second)
+            self.updated_at = now
+
+            # the token is taken right away, so waiting requests are served in order
+            self.tokens -= 1
+            wait_time = -self.tokens / self.requests_per_second if self.tokens < 0 else 0
+
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+
+class QuotaExceededError(Exception):
+    '''Raised when every API key ran out of its daily quota.'''
+
+
+
+class ApiScheduler:
+    '''Schedules the requests to the YouTube Data API of one or several API keys.
+    Every call type costs its `quota_costs` units of the `daily_quota` of a key, and each request 
+    goes to the key with the most quota left. A key that runs out of quota is put aside until 
+    the quota resets (midnight in Pacific time), and its request is sent again with another key.
+    Requests are paced by a token bucket of `requests_per_second` (unlimited if None), and
+    transient errors (5xx, 429, rate limit errors and network errors) are retried up to 
+    `max_retries` times, waiting an exponential backoff with full jitter.
+    A single scheduler can be shared by every connection and thread.'''
+
+    quota_costs = {
+        'commentThreads.list': 1,
+        'comments.list': 1,
+        'videos.list': 1,
+        'playlistItems.list': 1,
+        'channels.list': 1,
+        'search.list': 100,
+    }
+    quota_reasons = {'quotaExceeded', 'dailyLimitExceeded'}
+    rate_limit_reasons = {'rateLimitExceeded', 'userRateLimitExceeded'}
+    transient_statuses = {429, 500, 502, 503, 504}
+
+    try:
+        quota_timezone = ZoneInfo('America/Los_Angeles')
+    except ZoneInfoNotFoundError:
+        quota_timezone = datetime.timezone(datetime.timedelta(hours=-8))
+
+    def __init__(self, api_keys: str | list[str], requests_per_second: float | None = None, burst: int = 1,
+                 daily_quota: int = 10000, max_retries: int = 5, base_backoff: float = 1.0,
+                 max_backoff: float = 64.0, rate_limiter: RateLimiter | None = None) -> None:
+        self.api_keys = [api_keys] if isinstance(api_keys, str) else list(api_keys)
+        if not self.api_keys:
+            raise ValueError("At least one API key is needed.")
+
+        self.rate_limiter = rate_limiter or (RateLimiter(requests_per_second, burst) if requests_per_second else None)
+        self.daily_quota = daily_quota
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+
+        self.quota_day = self.current_quota_day()
+        self.quota_used = {api_key: 0 for api_key in self.api_keys}
+        self.exhausted_keys = set()
+        self.calls = Counter()
+        self.retries = Counter()
+        self._lock = threading.Lock()
+
+    def current_quota_day(self) -> datetime.date:
+        return datetime.datetime.now(self.quota_timezone).date()
+
+    def select_key(self, cost: int) -> str:
+        '''Returns the key with the most quota left, and charges `cost` units to it.'''
+
+        with self._lock:
+            # quotas reset every day
+            if self.current_quota_day() != self.quota_day:
+                self.quota_day = self.current_quota_day()
+                self.quota_used = {api_key: 0 for api_key in self.api_keys}
+                self.exhausted_keys.clear()
+
+            available_keys = [api_key for api_key in self.api_keys
+                              if api_key not in self.exhausted_keys and self.quota_used[api_key] + cost <= self.daily_quota]
+            if not available_keys:
+                raise QuotaExceededError(f"The {len(self.api_keys)} API keys ran out of quota for {self.quota_day}.")
+
+            api_key = min(available_keys, key=self.quota_used.get)
+            self.quota_used[api_key] += cost
+            return api_key
+
+    def execute(self, call_type: str, request: Callable[[str], dict]) -> dict:
+        '''Returns the result of `request(api_key)`, choosing the key, pacing the request
+        and retrying it as needed. The last error is raised when it can not be retried.'''
+
+        cost = self.quota_costs.get(call_type, 1)
+        attempt = 0
+
+        while True:
+            api_key = self.select_key(cost)
+            metrics.increment('api_quota_units', cost, call_type=call_type)
+            if self.rate_limiter is not None:
+                with metrics.timer('api_rate_limit_wait', call_type=call_type):
+                    self.rate_limiter.acquire()
+
+            try:
+                with metrics.timer('api_request', call_type=call_type):
+                    response = request(api_key)
+
+            except Exception as error:
+                status, reason = self.error_status(error)
+                metrics.increment('api_errors', call_type=call_type, status=status or type(error).__name__)
+
+                if reason in self.quota_reasons:
+                    # this key is done for today, so the request goes to another one
+                    print(f"API key ...{api_key[-4:]} ran out of quota.")
+                    with self._lock:
+                        self.exhausted_keys.add(api_key)
+                    continue
+
+                if attempt >= self.max_retries or not self.is_transient(error, status, reason):
+                    raise
+
+                wait_time = random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** attempt))
+                attempt += 1
+                with self._lock:
+                    self.retries[call_type] += 1
+                metrics.increment('api_retries', call_type=call_type)
+                print(f"Retrying {call_type} in {wait_time:.1f} seconds after error {status or repr(error)} ({attempt}/{self.max_retries}).")
+                time.sleep(wait_time)
+
+            else:
+                with self._lock:
+                    self.calls[call_type] += 1
+                metrics.increment('api_requests', call_type=call_type)
+                return response
+
+    def is_transient(self, error: Exception, status: int | None, reason: str | None) -> bool:
+        if status is not None:
+            return status in self.transient_statuses or reason in self.rate_limit_reasons
+
+        # connection resets, timeouts and other network errors
+        return isinstance(error, OSError)
+
+    @staticmethod
+    def error_status(error: Exception) -> tuple[int | None, str | None]:
+        '''Returns the HTTP status and the YouTube error reason of an error, if it has them.'''
+
+        if isinstance(error, googleapiclient.discovery.HttpError):
+            status, content = error.resp.status, error.content
+        elif isinstance(error, requests.HTTPError) and error.response is not None:
+            status, content = error.response.status_code, error.response.content
+        else:
+            return None, None
+
+        try:
+            reason = json.loads(content)['error']['errors'][0]['reason']
+        except (ValueError, KeyError, IndexError, TypeError):
+            reason = None
+
+        return int(status), reason
+
+    def quota_usage(self) -> dict[str, int]:
+        '''Returns the quota units used today by each key (only the last characters of the keys are shown).'''
+        with self._lock:
+            return {f"...{api_key[-4:]}": used for api_key, used in self.quota_used.items()}
+
+
+
+class CommentsFetchError(Exception):
+    '''Raised when fetching the comments of a video fails halfway.
+    Keeps the `pages` fetched before the error, and `next_page_token` 
+    is the page that failed, to resume from it.'''
+
+    def __init__(self, video_id: str, pages: list[dict], error: Exception) -> None:
+        super().__init__(f"Fetching the comments of {video_id} failed after {len(pages)} pages: {error!r}")
+        self.video_id = video_id
+        self.pages = pages
+        self.error = error
+
+    @property
+    def next_page_token(self) -> str:
+        return self.pages[-1].get('nextPageToken', '') if self.pages else ''
+
+
+
 class YoutubeCommentsConnection(YoutubeConnection):
     '''Class for establishing a connection with YouTube to fetch video comments.
-    Requires a Youtube API key to work.'''
+    Requires a Youtube API key to work.
+    `api_endpoint` replaces the YouTube Data API address (useful to test against 
+    a local fake server), and `scheduler` paces, retries and spreads the requests 
+    across API keys (by default, only `YOUTUBE_API_KEY` is used).'''
 
-    def __init__(self, YOUTUBE_API_KEY: str, video_id: str) -> None:
+    def __init__(self, YOUTUBE_API_KEY: str, video_id: str, api_endpoint: str | None = None,
+                 scheduler: ApiScheduler | None = None) -> None:
         super().__init__(YOUTUBE_API_KEY, video_id)
+        self.api_endpoint = api_endpoint
+        self.scheduler = scheduler or ApiScheduler(YOUTUBE_API_KEY)
 
-    def __build_connection(self, page_token: str = ''):
-        # build the youtube connection
-        youtube_connection = googleapiclient.discovery.build(
-            'youtube', 'v3', developerKey=self.YOUTUBE_API_KEY)
-        
+    def __build_connection(self, youtube_connection, page_token: str = ''):
         request = youtube_connection.commentThreads().list(
                 part="snippet,replies",
                 videoId=self.video_id,
@@ -123,75 +882,318 @@ class YoutubeCommentsConnection(YoutubeConnection):
         to fetch only a comments page from the whole comments available in the video.
         '''
 
-        request = self.__build_connection(page_token=page_token)
-            
+        def request(api_key: str) -> dict:
+            with self.youtube_client(api_key) as youtube_connection:
+                return self.__build_connection(youtube_connection, page_token).execute()
+
         # trying request and handling with possible errors
         try:
-            response = request.execute()
+            response = self.scheduler.execute('commentThreads.list', request)
             
         except googleapiclient.discovery.HttpError as error:
             print(f"Error in YouTube connection.")
             print(f"Reason: {error.reason}")
-            raise googleapiclient.discovery.HttpError
+            raise
 
         else:
-            print(f"Request id {response['etag']} was executed successfully.")
+            metrics.increment('comment_threads_fetched', len(response['items']))
             return response
 
-    def fetch_all_youtube_video_comments(self) -> YoutubeVideoCommentsResponse:
-        '''Retrieves a JSON with all the comments page from a video using fetch_youtube_video_comments function.'''
-        responses = []
+    def fetch_replies(self, parent_id: str, page_token: str = '') -> dict:
+        '''Fetches a page of replies of the comment `parent_id` using googleapiclient.'''
+
+        def request(api_key: str) -> dict:
+            with self.youtube_client(api_key) as youtube:
+                return youtube.comments().list(
+                    part="snippet",
+                    parentId=parent_id,
+                    maxResults=100,
+                    pageToken=page_token
+                ).execute()
+
+        return self.scheduler.execute('comments.list', request)
+
+    def fetch_all_replies(self, parent_id: str) -> list[dict]:
+        '''Fetches every reply of the comment `parent_id`, following all its pages.'''
+
+        response = self.fetch_replies(parent_id)
+        replies = response['items']
+
+        while 'nextPageToken' in response.keys():
+            response = self.fetch_replies(parent_id, page_token=response['nextPageToken'])
+            replies += response['items']
+
+        return replies
+
+    def complete_page_replies(self, response: dict, executor: ThreadPoolExecutor) -> dict:
+        '''Replaces the inlined replies of the page threads by all their replies.
+        Only the threads with more replies than the inlined ones are fetched again,
+        and all of them are fetched at the same time in `executor`.'''
+
+        incomplete_threads = [
+            thread for thread in response['items']
+            if thread['snippet'].get('totalReplyCount', 0) > len(thread.get('replies', {}).get('comments', []))]
+
+        futures = [executor.submit(self.fetch_all_replies, thread['id']) for thread in incomplete_threads]
+        for thread, future in zip(incomplete_threads, futures):
+            thread['replies'] = {'comments': future.result()}
+
+        return response
+
+    def iter_comment_pages(self, queue_size: int = 4, include_replies: bool = False,
+                           replies_workers: int = 8, page_token: str = '') -> Iterator[dict]:
+        '''Yields the comments pages of the video as they arrive.
+        Pages are fetched in a background thread and kept in a queue of at most
+        `queue_size` pages, so the next pages are downloaded while the caller 
+        cleans and scores the previous ones.
+        With `include_replies`, every thread of a page comes with all its replies,
+        fetching the ones that are not inlined in `replies_workers` threads.
+        `page_token` is the page to start from (the first page by default).'''
+
+        pages = Queue(maxsize=queue_size)
+        stop_fetching = threading.Event()
+
+        def fetch_pages() -> None:
+            replies_executor = ThreadPoolExecutor(max_workers=replies_workers) if include_replies else None
+
+            def fetch_page(page_token: str = '') -> dict:
+                response = self.fetch_data(page_token=page_token)
+                if replies_executor is not None:
+                    response = self.complete_page_replies(response, replies_executor)
+                return response
+
+            try:
+                response = fetch_page(page_token=page_token)
+                pages.put(response)
+
+                while 'nextPageToken' in response.keys() and not stop_fetching.is_set():
+                    response = fetch_page(page_token=response['nextPageToken'])
+                    pages.put(response)
+
+                pages.put(None)
+
+            except Exception as error:
+                pages.put(error)
+
+            finally:
+                if replies_executor is not None:
+                    replies_executor.shutdown()
+
+        producer = threading.Thread(target=fetch_pages, daemon=True)
+        producer.start()
+
         try:
-            print(f"Trying to get all comments from {self.video_id} video.")
-            response = self.fetch_data()
-            responses.append(response)
+            while True:
+                page = pages.get()
 
-            while 'nextPageToken' in response.keys():
-                next_page_token = response['nextPageToken']
-                response = self.fetch_data(page_token=next_page_token)
-                responses.append(response)
+                if page is None:
+                    break
 
-            return YoutubeVideoCommentsResponse(responses)
-        
-        except googleapiclient.discovery.HttpError as error:
-            error_reason = error.error_details
-            print(f"Error in YouTube connection.")
-            print(f"Reason: {error_reason}")
-            raise
+                if isinstance(page, Exception):
+                    raise page
+
+                yield page
 
+        finally:
+            # if the caller stops early, let the producer finish its current page and exit
+            stop_fetching.set()
+            while producer.is_alive():
+                try:
+                    pages.get_nowait()
+                except Empty:
+                    producer.join(timeout=0.1)
+
+    def fetch_all_youtube_video_comments(self) -> YoutubeVideoCommentsResponse:
+        '''Retrieves a JSON with all the comments page from a video using fetch_youtube_video_comments function.
+        If fetching fails halfway, the pages fetched before the error are kept in the raised `CommentsFetchError`.'''
+        print(f"Trying to get all comments from {self.video_id} video.")
+        pages = []
+        try:
+            for page in self.iter_comment_pages():
+                pages.append(page)
+        
         except Exception as error:
-            print(f"An error occurred: {error}")
-            raise
+            print(f"An error occurred after {len(pages)} pages: {error!r}")
+            raise CommentsFetchError(self.video_id, pages, error) from error
+
+        return YoutubeVideoCommentsResponse(pages)
+
+
+
+class ConcurrentCommentsFetcher:
+    '''Fetches the comments of several videos at the same time.
+    Every video is fetched in one of `max_workers` threads, and all of them 
+    share a global limit of `requests_per_second` requests, or the given `scheduler`.'''
+
+    def __init__(self, YOUTUBE_API_KEY: str, max_workers: int = 4, requests_per_second: float = 10,
+                 api_endpoint: str | None = None, scheduler: ApiScheduler | None = None) -> None:
+        self.YOUTUBE_API_KEY = YOUTUBE_API_KEY
+        self.max_workers = max_workers
+        self.api_endpoint = api_endpoint
+        self.scheduler = scheduler or ApiScheduler(YOUTUBE_API_KEY, requests_per_second)
+
+    def build_connection(self, video_id: str) -> YoutubeCommentsConnection:
+        return YoutubeCommentsConnection(self.YOUTUBE_API_KEY, video_id,
+                                         api_endpoint=self.api_endpoint, scheduler=self.scheduler)
+
+    def fetch_videos_comments(self, video_ids: Iterable[str]) -> Iterator[tuple[str, YoutubeVideoCommentsResponse]]:
+        '''Yields `(video_id, comments)` for every video, in the order they finish.'''
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {
+                executor.submit(self.build_connection(video_id).fetch_all_youtube_video_comments): video_id
+                for video_id in video_ids
+            }
+
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+
+
+
+class YoutubePlaylistConnection(YoutubeConnection):
+    '''Class for listing the videos of a YouTube playlist.
+    Requires a Youtube API key to work.'''
+
+    def __init__(self, YOUTUBE_API_KEY: str, playlist_id: str, api_endpoint: str | None = None,
+                 scheduler: ApiScheduler | None = None) -> None:
+        self.YOUTUBE_API_KEY = YOUTUBE_API_KEY
+        self.playlist_id = playlist_id
+        self.api_endpoint = api_endpoint
+        self.scheduler = scheduler or ApiScheduler(YOUTUBE_API_KEY)
+
+    def fetch_data(self, page_token: str = '') -> dict:
+        '''Fetches a page of the playlist items using googleapiclient.'''
+
+        def request(api_key: str) -> dict:
+            with self.youtube_client(api_key) as youtube:
+                return youtube.playlistItems().list(
+                    part="contentDetails",
+                    playlistId=self.playlist_id,
+                    maxResults=50,
+                    pageToken=page_token
+                ).execute()
+
+        return self.scheduler.execute('playlistItems.list', request)
+
+    def iter_video_ids(self) -> Iterator[str]:
+        '''Yields the id of every video of the playlist, following all its pages.'''
+
+        response = self.fetch_data()
+        yield from (item['contentDetails']['videoId'] for item in response['items'])
+
+        while 'nextPageToken' in response.keys():
+            response = self.fetch_data(page_token=response['nextPageToken'])
+            yield from (item['contentDetails']['videoId'] for item in response['items'])
+
+
+
+class YoutubeChannelConnection(YoutubeConnection):
+    '''Class for fetching the details of a YouTube channel.
+    Requires a Youtube API key to work.'''
+
+    def __init__(self, YOUTUBE_API_KEY: str, channel_id: str, api_endpoint: str | None = None,
+                 scheduler: ApiScheduler | None = None) -> None:
+        self.YOUTUBE_API_KEY = YOUTUBE_API_KEY
+        self.channel_id = channel_id
+        self.api_endpoint = api_endpoint
+        self.scheduler = scheduler or ApiScheduler(YOUTUBE_API_KEY)
+
+    def fetch_data(self) -> dict:
+        '''Fetches the content details of the channel using googleapiclient.'''
+
+        def request(api_key: str) -> dict:
+            with self.youtube_client(api_key) as youtube:
+                return youtube.channels().list(part="contentDetails", id=self.channel_id).execute()
+
+        return self.scheduler.execute('channels.list', request)
+
+    def uploads_playlist_id(self) -> str:
+        '''Returns the id of the playlist with every video uploaded by the channel.'''
+
+        response = self.fetch_data()
+        if not response.get('items'):
+            raise ValueError(f"Channel {self.channel_id} was not found.")
+
+        return response['items'][0]['contentDetails']['relatedPlaylists']['uploads']
 
 
 
 class YoutubeVideoInfoConnection(YoutubeConnection):
     '''Class for establishing a connection with YouTube to fetch video information.
-    Requires a Youtube API key to work.'''
+    Requires a Youtube API key to work.
+    Responses are kept in `http_cache`, and reused without any request for 
+    `statistics_ttl` seconds, so the video statistics are not too old.
+    Requests go through `scheduler` (by default, one that only uses `YOUTUBE_API_KEY`),
+    and fresh cached responses are returned before it, so they cost no quota.'''
+
+    statistics_ttl = 600
      
-    def __init__(self, YOUTUBE_API_KEY: str, video_id: str) -> None:
+    def __init__(self, YOUTUBE_API_KEY: str, video_id: str, http_cache: HttpCache | None = None,
+                 scheduler: ApiScheduler | None = None) -> None:
         super().__init__(YOUTUBE_API_KEY, video_id)
+        self.http_cache = http_cache or HttpCache()
+        self.scheduler = scheduler or ApiScheduler(YOUTUBE_API_KEY)
 
-    def __build_connection(self):
-        return f"https://youtube.googleapis.com/youtube/v3/videos?part=snippet%2CcontentDetails%2Cstatistics&id={self.video_ID}&key={self.YOUTUBE_API_KEY}"
+    def __build_connection(self, api_key: str):
+        return f"https://youtube.googleapis.com/youtube/v3/videos?part=snippet%2CcontentDetails%2Cstatistics&id={self.video_id}&key={api_key}"
 
     def fetch_data(self) -> dict:
         '''Get the JSON with the video info using a HTTPS request.'''
-        request_url = self.__build_connection()
         try:
-            response = requests.get(request_url)
-            if response.status_code == 200:
-                return YoutubeVideoInfoResponse(response.json())
-            
-            else:
-                raise requests.HTTPError
+            response = self.http_cache.get_fresh(self.__build_connection(self.YOUTUBE_API_KEY), self.statistics_ttl)
+            if response is None:
+                response = self.scheduler.execute(
+                    'videos.list', lambda api_key: self.http_cache.get(self.__build_connection(api_key), ttl=self.statistics_ttl))
+            return YoutubeVideoInfoResponse(json.loads(response))
             
         except requests.HTTPError as error:
-            print(f"Failed to get YouTube video information: {error.strerror}")
-            raise requests.HTTPError
-        
-        except Exception as error:
-            print(f"An error occurred: {error}")
+            print(f"Failed to get YouTube video information: {error}")
+            raise
+
+
+
+class YoutubeVideosInfoBatchConnection(Connection):
+    '''Class for fetching the information of many YouTube videos with few requests.
+    Video ids are grouped in requests of up to 50 ids (the most `videos.list` accepts),
+    and `max_workers` of those requests run at the same time through `scheduler`.
+    Requires a Youtube API key to work.'''
+
+    max_ids_per_request = 50
+    statistics_ttl = 600
+
+    def __init__(self, YOUTUBE_API_KEY: str, max_workers: int = 4, http_cache: HttpCache | None = None,
+                 api_endpoint: str = "https://youtube.googleapis.com/", scheduler: ApiScheduler | None = None) -> None:
+        self.YOUTUBE_API_KEY = YOUTUBE_API_KEY
+        self.max_workers = max_workers
+        self.http_cache = http_cache or HttpCache()
+        self.api_endpoint = api_endpoint
+        self.scheduler = scheduler or ApiScheduler(YOUTUBE_API_KEY)
+
+    def __build_connection(self, video_ids: list[str], api_key: str) -> str:
+        return f"{self.api_endpoint.rstrip('/')}/youtube/v3/videos?part=snippet%2CcontentDetails%2Cstatistics&id={'%2C'.join(video_ids)}&key={api_key}"
+
+    def fetch_data(self, video_ids: list[str]) -> dict:
+        '''Get the JSON with the info of up to 50 videos using a HTTPS request.'''
+        response = self.http_cache.get_fresh(self.__build_connection(video_ids, self.YOUTUBE_API_KEY), self.statistics_ttl)
+        if response is None:
+            response = self.scheduler.execute(
+                'videos.list', lambda api_key: self.http_cache.get(self.__build_connection(video_ids, api_key), ttl=self.statistics_ttl))
+        return json.loads(response)
+
+    def fetch_videos_info(self, video_ids: Iterable[str]) -> dict[str, dict]:
+        '''Returns the cleaned info of every video, keyed by video id.
+        Videos that do not exist (or are private) are not included.'''
+        video_ids = list(dict.fromkeys(video_ids))
+        groups = [video_ids[start:start + self.max_ids_per_request]
+                  for start in range(0, len(video_ids), self.max_ids_per_request)]
+
+        cleaner = YoutubeVideoInfoCleaner()
+        videos_info = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for response in executor.map(self.fetch_data, groups):
+                videos_info.update(cleaner.clean_items(response))
+
+        return videos_info
 
 
 
@@ -210,50 +1212,237 @@ class YoutubeVideoCommentsListLengthCleaner(Cleaner):
     '''Class for cleaning the response containing YouTube video comments. 
     Filters out comments that exceed a certain length.'''
 
+    max_comments = 10000
+
     def check_if_clean_is_needed(self, comments_data: list[dict[str, str]]) -> bool:
-        return True if len(comments_data) >= 10000 else False
+        return True if len(comments_data) >= self.max_comments else False
     
     def clean_data(self, comments_data: list[dict[str, str]]) -> list[dict[str, str]]:
-        return comments_data[:10000] if self.check_if_clean_is_needed(comments_data) else comments_data
+        return comments_data[:self.max_comments] if self.check_if_clean_is_needed(comments_data) else comments_data
         
 
     
 class YoutubeVideoCommentLengthCleaner(Cleaner):
     '''Class for cleaning individual YouTube video comments. 
     Filters out comments that exceed a certain length.'''
+
+    max_length = 512
     
     def check_if_clean_is_needed(self, comment: str) -> bool:
-        return True if len(comment) >= 512 else False
+        return True if len(comment) >= self.max_length else False
     
     def clean_data(self):
         raise NotImplementedError
     
 
     
+class YoutubeCommentTextCleaner(Cleaner):
+    '''Class for cleaning the text of individual YouTube video comments.
+    `textDisplay` comes as HTML: line breaks and links are tags, and some characters
+    are escaped as entities. Tags are removed (keeping the text of links), entities 
+    are unescaped and whitespace is collapsed, so the model only gets the plain text.
+    Block tags like line breaks separate words, so they become a space, while inline
+    tags like bold may split a word, so they are removed without leaving a space.'''
+
+    tag_pattern = re.compile(r'<[^>]*>')
+    block_tag_pattern = re.compile(r'<\s*/?\s*(?:br|p|div|li|ul|ol|h[1-6])\b[^>]*>', re.IGNORECASE)
+    whitespace_pattern = re.compile(r'\s+')
+    # any whitespace that is not a single space between words
+    irregular_whitespace_pattern = re.compile(r'[^\S ]|  |^ | $')
+
+    def check_if_clean_is_needed(self, comment: str) -> bool:
+        return '<' in comment or '&' in comment or self.irregular_whitespace_pattern.search(comment) is not None
+
+    def clean_data(self, comment: str) -> str:
+        if not self.check_if_clean_is_needed(comment):
+            return comment
+
+        # tags go first, so unescaped text like "<3" is not taken for a tag
+        comment = html.unescape(self.tag_pattern.sub('', self.block_tag_pattern.sub(' ', comment)))
+        return self.whitespace_pattern.sub(' ', comment).strip()
+
+
+
+class YoutubeCommentsDuplicatesCleaner(Cleaner):
+    '''Class for finding duplicated comment texts, so each distinct text is scored only once.
+    Exact duplicates are found by hashing the texts. With `near_duplicates`, texts that 
+    differ only slightly (spam and copypasta variations) are grouped too: every text gets
+    a MinHash signature of its character shingles, and texts that share a band of their
+    signatures are grouped if their estimated Jaccard similarity reaches `similarity`.
+    `texts_count` and `unique_texts_count` count the texts seen by `group_texts`.'''
+
+    shingle_size = 5
+    permutations = 64
+    bands = 16
+    # smallest prime above 2**32, so the permuted shingle hashes fit in 64 bits
+    prime = 4294967311
+
+    def __init__(self, near_duplicates: bool = False, similarity: float = 0.8, seed: int = 1) -> None:
+        self.near_duplicates = near_duplicates
+        self.similarity = similarity
+        self.texts_count = 0
+        self.unique_texts_count = 0
+
+        random_generator = np.random.default_rng(seed)
+        self.coefficients = random_generator.integers(1, 2 ** 32, self.permutations, dtype=np.uint64)
+        self.offsets = random_generator.integers(0, 2 ** 32, self.permutations, dtype=np.uint64)
+
+    def check_if_clean_is_needed(self, texts: list[str]) -> bool:
+        return len(set(texts)) < len(texts)
+
+    def clean_data(self, texts: list[str]) -> list[str]:
+        '''Returns one text of each group of duplicated texts.'''
+        return self.group_texts(texts)[0]
+
+    def group_texts(self, texts: list[str]) -> tuple[list[str], list[int]]:
+        '''Groups the duplicated texts of `texts`.
+        Returns the text of each group, and the group of every text in `texts`.'''
+
+        groups: dict[str, int] = {}
+        positions = [groups.setdefault(text, len(groups)) for text in texts]
+        unique_texts = list(groups)
+
+        if self.near_duplicates and len(unique_texts) > 1:
+            representatives = self.find_near_duplicates(unique_texts)
+
+            # renumber the groups, keeping only the representative texts
+            group_of_representative: dict[int, int] = {}
+            for representative in representatives:
+                group_of_representative.setdefault(representative, len(group_of_representative))
+
+            positions = [group_of_representative[representatives[position]] for position in positions]
+            unique_texts = [unique_texts[representative] for representative in group_of_representative]
+
+        self.texts_count += len(texts)
+        self.unique_texts_count += len(unique_texts)
+        return unique_texts, positions
+
+    def signature(self, text: str) -> np.ndarray:
+        '''Returns the MinHash signature of the character shingles of a text.'''
+        text = text.casefold()
+        shingles = {text[start:start + self.shingle_size] for start in range(max(1, len(text) - self.shingle_size + 1))}
+        hashes = np.fromiter((zlib.crc32(shingle.encode('utf-8')) for shingle in shingles), dtype=np.uint64, count=len(shingles))
+
+        return ((np.outer(self.coefficients, hashes) + self.offsets[:, None]) % self.prime).min(axis=1)
+
+    def find_near_duplicates(self, texts: list[str]) -> list[int]:
+        '''Returns the position of the representative text of every text: the first
+        text it is similar to, or itself.'''
+
+        rows = self.permutations // self.bands
+        signatures = [self.signature(text) for text in texts]
+        representatives = list(range(len(texts)))
+        band_buckets: dict[tuple[int, bytes], int] = {}
+
+        for position, signature in enumerate(signatures):
+            for band in range(self.bands):
+                bucket = (band, signature[band * rows:(band + 1) * rows].tobytes())
+                candidate = band_buckets.setdefault(bucket, position)
+
+                # the fraction of equal MinHash values estimates the Jaccard similarity
+                if candidate != position and np.mean(signatures[candidate] == signature) >= self.similarity:
+                    representatives[position] = representatives[candidate]
+                    break
+
+        return representatives
+
+    def stats(self) -> dict[str, float]:
+        return {
+            'texts': self.texts_count,
+            'unique_texts': self.unique_texts_count,
+            'duplication_rate': 1 - self.unique_texts_count / self.texts_count if self.texts_count else 0.0,
+        }
+
+
+
 class YoutubeVideoCommentsDataCleaner(Cleaner):
     '''Class for cleaning the response containing YouTube video comments. 
-    Filters out comments that exceed a certain length and/or a certain number of comments.'''
+    Filters out comments that exceed a certain length and/or a certain number of comments.
+    The HTML of the comment texts is turned into plain text before anything else.
+    With `full_corpus`, every comment is kept, no matter its length or the number of comments.
+    With `include_replies`, the replies of each thread are kept after their parent comment, 
+    and every comment records the id of its parent in `parent_id` (empty for top level comments).
+    Top level comments also record the number of replies of their thread in `reply_count` (empty for replies).'''
+
+    def __init__(self, full_corpus: bool = False, include_replies: bool = False) -> None:
+        self.full_corpus = full_corpus
+        self.include_replies = include_replies
 
     def check_if_clean_is_needed(self, data):
         raise NotImplementedError
     
     def clean_data(self, youtube_comments: YoutubeVideoCommentsResponse) -> YoutubeVideoCommentsResponse:
-        comments_length_cleaner = YoutubeVideoCommentLengthCleaner()
-        list_length_cleaner = YoutubeVideoCommentsListLengthCleaner()
-
         '''This method clean the Youtube Response JSON data, and leaves only the "text" and the "date" from the original response, to be used to analyze sentiments.'''
         cleaned_comments_list: list[dict[str, str]] = [
-            {
-                'text': comment['snippet']['topLevelComment']['snippet']['textDisplay'], 
-                'date': comment['snippet']['topLevelComment']['snippet']['updatedAt']
-            } 
-            for response in youtube_comments.data for comment in response['items']
-            if not comments_length_cleaner.check_if_clean_is_needed(comment['snippet']['topLevelComment']['snippet']['textDisplay'])]
-        
-        cleaned_comments_list = list_length_cleaner.clean_data(cleaned_comments_list)
+            comment for page_comments in self.iter_clean_pages(youtube_comments.data) for comment in page_comments]
         
         return YoutubeVideoCommentsResponse(cleaned_comments_list)
 
+    def clean_page(self, response: dict) -> list[dict[str, str]]:
+        '''Cleans a single comments page of the Youtube Response JSON data.'''
+        comments_length_cleaner = YoutubeVideoCommentLengthCleaner()
+
+        with metrics.timer('clean_page') as details:
+            comments = self.extract_comments(response)
+            cleaned_comments = [comment for comment in comments
+                                if self.full_corpus or not comments_length_cleaner.check_if_clean_is_needed(comment['text'])]
+            details['items'] = len(cleaned_comments)
+
+        metrics.increment('comments_cleaned', len(cleaned_comments))
+        metrics.increment('comments_dropped', len(comments) - len(cleaned_comments))
+        return cleaned_comments
+
+    def extract_comments(self, response: dict) -> list[dict[str, str]]:
+        '''Extracts the id, plain text and date of every comment of a page, and the parent id of replies.'''
+        text_cleaner = YoutubeCommentTextCleaner()
+
+        if not self.include_replies:
+            return [
+                {
+                    'id': comment['snippet']['topLevelComment']['id'],
+                    'text': text_cleaner.clean_data(comment['snippet']['topLevelComment']['snippet']['textDisplay']), 
+                    'date': comment['snippet']['topLevelComment']['snippet']['updatedAt']
+                } 
+                for comment in response['items']]
+
+        # top level comment of each thread, followed by its replies
+        thread_comments = [
+            (comment['snippet']['topLevelComment'], '', comment['snippet'].get('totalReplyCount', 0))
+            if 'topLevelComment' in comment['snippet'] 
+            else (comment, comment['snippet']['parentId'], None)
+            for thread in response['items'] for comment in [thread] + thread.get('replies', {}).get('comments', [])]
+
+        return [
+            {
+                'id': comment['id'],
+                'parent_id': parent_id,
+                'text': text_cleaner.clean_data(comment['snippet']['textDisplay']),
+                'date': comment['snippet']['updatedAt'],
+                'reply_count': reply_count
+            }
+            for comment, parent_id, reply_count in thread_comments]
+
+    def iter_clean_pages(self, responses: Iterable[dict]) -> Iterator[list[dict[str, str]]]:
+        '''Yields the cleaned comments of each page of `responses`, as they arrive.
+        Stops reading pages once the comments list reaches its maximum length.'''
+        max_comments = None if self.full_corpus else YoutubeVideoCommentsListLengthCleaner.max_comments
+        comments_count = 0
+
+        responses = iter(responses)
+        for response in responses:
+            page_comments = self.clean_page(response)
+            if max_comments is not None:
+                page_comments = page_comments[:max_comments - comments_count]
+
+            comments_count += len(page_comments)
+            yield page_comments
+
+            if max_comments is not None and comments_count >= max_comments:
+                # stop fetching the pages that would be discarded anyway
+                if hasattr(responses, 'close'):
+                    responses.close()
+                break
+
 
 
 class YoutubeVideoInfoCleaner(Cleaner):
@@ -264,34 +1453,174 @@ class YoutubeVideoInfoCleaner(Cleaner):
         raise NotImplementedError
     
     def clean_data(self, video_info):
+        return self.clean_item(video_info['items'][0])
+
+    def clean_item(self, item: dict) -> dict:
+        '''Cleans the info of a single video of a `videos.list` response.'''
         video_info = {
-            'thumbnail_url': video_info['items'][0]['snippet']['thumbnails']['high']['url'],
-            'video_title': video_info['items'][0]['snippet']['title'],
-            'channel_name': video_info['items'][0]['snippet']['channelTitle'],
-            'video_url': "youtu.be/"+video_info['items'][0]["id"],
-            'views': video_info['items'][0]['statistics']['viewCount'],
-            'likes': video_info['items'][0]['statistics']['likeCount'],
-            'published_date': video_info['items'][0]['snippet']['publishedAt'] 
+            'thumbnail_url': item['snippet']['thumbnails']['high']['url'],
+            'video_title': item['snippet']['title'],
+            'channel_name': item['snippet']['channelTitle'],
+            'channel_id': item['snippet'].get('channelId'),
+            'video_url': "youtu.be/"+item["id"],
+            'views': item['statistics']['viewCount'],
+            'likes': item['statistics'].get('likeCount'),
+            'comments': item['statistics'].get('commentCount'),
+            'published_date': item['snippet']['publishedAt'] 
         }     
 
         return video_info
 
+    def clean_items(self, video_info) -> dict[str, dict]:
+        '''Cleans the info of every video of a `videos.list` response, keyed by video id.'''
+        return {item['id']: self.clean_item(item) for item in video_info['items']}
+
+
+
+# sentiment analyzer of the current scoring process
+_worker_sentiment_analyzer = None
+
+
+def _init_scoring_worker(threads_per_worker: int, memo_cache_path: str | None = None, backend: str = 'pytorch',
+                         prefilter_threshold: float | None = None) -> None:
+    '''Prepares a scoring process: pins its torch threads and loads the model once.'''
+    global _worker_sentiment_analyzer
+
+    # limit the threads before torch is imported, so OpenMP picks the value up
+    os.environ["OMP_NUM_THREADS"] = str(threads_per_worker)
+    os.environ["MKL_NUM_THREADS"] = str(threads_per_worker)
+
+    import torch
+    torch.set_num_threads(threads_per_worker)
+    torch.set_num_interop_threads(1)
+
+    SentimentAnalyzer.warm_up(backend)
+    memo_cache = SentimentMemoCache(memo_cache_path) if memo_cache_path else None
+    if prefilter_threshold is None:
+        _worker_sentiment_analyzer = SentimentAnalyzer(memo_cache, backend)
+    else:
+        _worker_sentiment_analyzer = TwoTierSentimentAnalyzer(threshold=prefilter_threshold, memo_cache=memo_cache, backend=backend)
+
+
+def _score_comments_chunk(comments_chunk: list[dict[str, str]], batch_size: int) -> list[dict[str, str]]:
+    '''Adds the sentiment to a chunk of comments inside a scoring process.'''
+
+    texts = [comment['text'] for comment in comments_chunk]
+    sentiments = _worker_sentiment_analyzer.apply_model_to_batch(texts, batch_size=batch_size, show_progress=False)
+
+    return [{**comment, 'sentiment': sentiment} for comment, sentiment in zip(comments_chunk, sentiments)]
+
+
+
+class SentimentScoringPool:
+    '''Pool of processes for scoring comments in several CPU cores at once.
+    Every process loads its own model once, and uses `threads_per_worker` torch threads.
+    By default, it starts as many processes as fit in the CPU cores.
+    If `memo_cache_path` is given, every process uses the sentiment memo in that file.
+    `backend` is the way the model runs in the processes (see `ModelRegistry.backends`).
+    With a `prefilter_threshold`, the processes use a `TwoTierSentimentAnalyzer` with the saved prefilter.'''
+
+    def __init__(self, workers: int | None = None, threads_per_worker: int = 1,
+                 chunk_size: int = 256, batch_size: int = 32, memo_cache_path: str | None = None,
+                 backend: str = 'pytorch', prefilter_threshold: float | None = None) -> None:
+        self.memo_cache_path = memo_cache_path
+        self.backend = backend
+        self.prefilter_threshold = prefilter_threshold
+        self.threads_per_worker = max(1, threads_per_worker)
+        self.workers = workers or max(1, (os.cpu_count() or 1) // self.threads_per_worker)
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+        self.executor = None
+
+    def __enter__(self) -> 'SentimentScoringPool':
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def start(self) -> None:
+        '''Starts the scoring processes, if they are not running yet.'''
+
+        if self.executor is None:
+            # spawn avoids forking a parent that may already have torch threads running
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_scoring_worker,
+                initargs=(self.threads_per_worker, self.memo_cache_path, self.backend, self.prefilter_threshold)
+            )
+
+    def close(self) -> None:
+        '''Stops the scoring processes.'''
+
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def score_comments(self, comments_data: Iterable[dict[str, str]]) -> Iterator[dict[str, str]]:
+        '''Yields every comment of `comments_data` with its sentiment, in the same order.
+        Comments are sent to the processes in chunks of `chunk_size`, and only a few 
+        chunks per process are pending at a time, so results start streaming right away.'''
+
+        self.start()
+        pending = deque()
+
+        for chunk in self._iter_chunks(comments_data):
+            pending.append(self.executor.submit(_score_comments_chunk, chunk, self.batch_size))
+            metrics.increment('scoring_pool_chunks')
+
+            # wait for the oldest chunk when every process has enough work queued
+            if len(pending) >= self.workers * 2:
+                yield from pending.popleft().result()
+
+        while pending:
+            yield from pending.popleft().result()
+
+    def _iter_chunks(self, comments_data: Iterable[dict[str, str]]) -> Iterator[list[dict[str, str]]]:
+        chunk = []
+        for comment in comments_data:
+            chunk.append(comment)
+            if len(chunk) == self.chunk_size:
+                yield chunk
+                chunk = []
+
+        if chunk:
+            yield chunk
+
 
 
 class CommentAnalyzer:
-    '''Class for analyzing comments data of a YouTube video.'''
+    '''Class for analyzing comments data of a YouTube video.
+    If a `scoring_pool` is given, comments are scored in its processes.
+    If a `memo_cache` is given, texts analyzed before are not scored again.'''
 
     processed = False
 
-    def __init__(self, comments_data: YoutubeVideoCommentsResponse) -> None:
+    def __init__(self, comments_data: YoutubeVideoCommentsResponse, batch_size: int = 32,
+                 scoring_pool: SentimentScoringPool | None = None, memo_cache: SentimentMemoCache | None = None) -> None:
         self.comments_data = comments_data.data     
-        self.sentiment_analyzer = SentimentAnalyzer()
+        self.sentiment_analyzer = SentimentAnalyzer(memo_cache)
+        self.batch_size = batch_size
+        self.scoring_pool = scoring_pool
 
     def add_emotions_to_comments_data(self) -> None:
-        '''Adds sentiment analysis to each comment in the data.'''
-        
-        for comment in tqdm(range(0, len(self.comments_data))):
-            self.comments_data[comment]['sentiment'] = self.sentiment_analyzer.apply_model_to_data(self.comments_data[comment]['text'])
+        '''Adds sentiment analysis to each comment in the data.
+        Comments are scored in batches of `batch_size` instead of one by one.'''
+
+        with metrics.timer('score_comments') as details:
+            if self.scoring_pool is not None:
+                scored_comments = self.scoring_pool.score_comments(self.comments_data)
+                self.comments_data = list(tqdm(scored_comments, total=len(self.comments_data)))
+
+            else:
+                texts = [comment['text'] for comment in self.comments_data]
+                sentiments = self.sentiment_analyzer.apply_model_to_batch(texts, batch_size=self.batch_size)
+
+                for comment, sentiment in zip(self.comments_data, sentiments):
+                    comment['sentiment'] = sentiment
+
+            details['items'] = len(self.comments_data)
     
         self.processed = True
     
@@ -302,29 +1631,63 @@ class CommentAnalyzer:
             return self.comments_data
         else:
             self.add_emotions_to_comments_data()
-            self.get_comments_with_sentiment()
+            return self.get_comments_with_sentiment()
         
 class CommentsOfVideoSentimentAnalyzer:
-    '''Class for analyzing sentiments of comments from a YouTube video.'''
+    '''Class for analyzing sentiments of comments from a YouTube video.
+    With `full_corpus`, every comment is analyzed instead of only the first 10000 
+    comments shorter than 512 characters.
+    With `include_replies`, the replies of each comment are analyzed too.'''
 
-    sentiment_analyzer = SentimentAnalyzer()
-    comments_cleaner = YoutubeVideoCommentsDataCleaner()
     processed = False
 
-    def __init__(self, youtube_connection: YoutubeCommentsConnection) -> None:
+    def __init__(self, youtube_connection: YoutubeCommentsConnection, batch_size: int = 32,
+                 scoring_pool: SentimentScoringPool | None = None, memo_cache: SentimentMemoCache | None = None,
+                 full_corpus: bool = False, include_replies: bool = False) -> None:
         self.youtube_connection = youtube_connection
+        self.include_replies = include_replies
+        self.comments_cleaner = YoutubeVideoCommentsDataCleaner(full_corpus, include_replies)
+        self.sentiment_analyzer = SentimentAnalyzer(memo_cache)
+        self.batch_size = batch_size
+        self.scoring_pool = scoring_pool
 
-    def fetch_youtube_video_comments_with_sentiments(self):
-        '''Fetches YouTube video comments with sentiment analysis.'''
-        # Fetching all comments from a video.
-        self.comments_data = self.youtube_connection.fetch_all_youtube_video_comments()
+    def iter_cleaned_pages(self) -> Iterator[list[dict[str, str]]]:
+        '''Yields the cleaned comments of each page of the video, as they are fetched.'''
+
+        # Fetching the comments pages in the background.
+        pages = self.youtube_connection.iter_comment_pages(include_replies=self.include_replies)
+
+        # Extracting only comment id, text and date (and cleaning comments if list is longer than 10000 comments or if comments are longer than 512 characters.)
+        return self.comments_cleaner.iter_clean_pages(pages)
+
+    def iter_comments_with_sentiments(self) -> Iterator[dict[str, str]]:
+        '''Yields YouTube video comments with sentiment analysis, as their pages arrive.
+        Each page is cleaned and scored while the next ones are fetched, and its raw
+        data is dropped right away, so memory does not grow with the number of comments.'''
+
+        cleaned_pages = self.iter_cleaned_pages()
 
-        # Extracting only comment text and date (and cleaning comments if list is longer than 10000 comments or if comments are longer than 512 characters.)
-        self.comments_data = self.comments_cleaner.clean_data(self.comments_data)
-        
         # Adding sentiments to each comment registry.
-        comments_analyzer = CommentAnalyzer(self.comments_data)
-        self.comments_data = comments_analyzer.get_comments_with_sentiment()
+        if self.scoring_pool is not None:
+            yield from self.scoring_pool.score_comments(
+                comment for page_comments in cleaned_pages for comment in page_comments)
+
+        else:
+            # texts repeated in several pages are scored once per video
+            known_labels = {}
+            for page_comments in cleaned_pages:
+                texts = [comment['text'] for comment in page_comments]
+                sentiments = self.sentiment_analyzer.apply_model_to_batch(texts, batch_size=self.batch_size,
+                                                                          show_progress=False, known_labels=known_labels)
+
+                for comment, sentiment in zip(page_comments, sentiments):
+                    comment['sentiment'] = sentiment
+                    yield comment
+
+    def fetch_youtube_video_comments_with_sentiments(self):
+        '''Fetches YouTube video comments with sentiment analysis.'''
+        print(f"Trying to get all comments from {self.youtube_connection.video_id} video.")
+        self.comments_data = list(tqdm(self.iter_comments_with_sentiments()))
 
         self.processed = True
 
@@ -334,15 +1697,157 @@ class CommentsOfVideoSentimentAnalyzer:
             return self.comments_data
         else:
             self.fetch_youtube_video_comments_with_sentiments()
-            self.get_comments_data()
+            return self.get_comments_data()
+
+    def save_comments_with_sentiments(self, cache: Cache, chunk_size: int = 10000) -> int:
+        '''Analyzes the video comments and stores them in `cache` in chunks of `chunk_size`
+        comments, as they are scored, so memory stays flat even for the largest videos.
+        Returns the number of stored comments.'''
+        video_id = self.youtube_connection.video_id
+        print(f"Trying to get all comments from {video_id} video.")
+        cache.store.delete(video_id)
+
+        comments_count = 0
+        chunk = []
+        for comment in tqdm(self.iter_comments_with_sentiments()):
+            chunk.append(comment)
+            if len(chunk) == chunk_size:
+                cache.append_to_cache_file(chunk, video_id)
+                comments_count += len(chunk)
+                chunk = []
+
+        if chunk or not comments_count:
+            cache.append_to_cache_file(chunk, video_id)
+            comments_count += len(chunk)
+
+        print(f"Stored {comments_count} comments in {cache.store.video_path(video_id)}")
+        return comments_count
+
+class IncrementalCommentsSentimentAnalyzer(CommentsOfVideoSentimentAnalyzer):
+    '''Class for updating the sentiments of a video analyzed before.
+    Only the comments that are new or were edited since `previous_comments` 
+    are fetched and scored, and then they are merged into the previous result.
+    Comment pages are returned from newest to oldest, so paging stops at the 
+    first comment that is already known and was not edited.
+    With `include_replies`, replies can be added to old threads, so every page is fetched,
+    but replies are only fetched for the threads that are new, were edited, or whose
+    number of replies changed since `previous_comments` (the rest are dropped before).'''
+
+    def __init__(self, youtube_connection: YoutubeCommentsConnection, previous_comments: list[dict[str, str]],
+                 batch_size: int = 32, scoring_pool: SentimentScoringPool | None = None,
+                 memo_cache: SentimentMemoCache | None = None, full_corpus: bool = False,
+                 include_replies: bool = False) -> None:
+        super().__init__(youtube_connection, batch_size, scoring_pool, memo_cache, full_corpus, include_replies)
+        self.previous_comments = previous_comments
+        self.previous_dates = {comment['id']: comment['date'] for comment in previous_comments}
+        self.previous_reply_counts = self.count_previous_replies(previous_comments)
+
+    @staticmethod
+    def count_previous_replies(previous_comments: list[dict[str, str]]) -> dict[str, int]:
+        '''Returns the number of replies of each known thread, by the id of its top level comment.
+        The `reply_count` stored with the comment is used, or the known replies are counted if there is none.'''
+
+        known_replies = Counter(comment.get('parent_id') for comment in previous_comments if comment.get('parent_id'))
+        reply_counts = {}
+        for comment in previous_comments:
+            if not comment.get('parent_id'):
+                reply_count = comment.get('reply_count')
+                # cached counts are read back as strings, and are missing in older caches
+                has_count = reply_count is not None and reply_count == reply_count and reply_count != ''
+                reply_counts[comment['id']] = int(float(reply_count)) if has_count else known_replies[comment['id']]
+
+        return reply_counts
+
+    def is_known_thread(self, thread: dict) -> bool:
+        '''Whether the top level comment of `thread` is known and was not edited
+        (and, with `include_replies`, its thread has the same number of replies).'''
+        top_level_comment = thread['snippet']['topLevelComment']
+        if self.previous_dates.get(top_level_comment['id']) != top_level_comment['snippet']['updatedAt']:
+            return False
+        return not self.include_replies or \
+            self.previous_reply_counts.get(top_level_comment['id']) == thread['snippet'].get('totalReplyCount', 0)
+
+    def split_new_threads(self, threads: list[dict]) -> tuple[list[dict], bool]:
+        '''Returns the threads that changed since the previous comments, and whether a known one was reached.
+        Without `include_replies`, the threads after the first known one are dropped too.'''
+
+        changed_threads = []
+        for thread in threads:
+            if not self.is_known_thread(thread):
+                changed_threads.append(thread)
+            elif not self.include_replies:
+                return changed_threads, True
+
+        return changed_threads, len(changed_threads) < len(threads)
+
+    def iter_cleaned_pages(self, replies_workers: int = 8) -> Iterator[list[dict[str, str]]]:
+        '''Yields the new or edited comments of each page, until a known comment is reached.'''
+
+        # replies are fetched here, after dropping the known threads, instead of with the pages
+        pages = self.youtube_connection.iter_comment_pages()
+        replies_executor = ThreadPoolExecutor(max_workers=replies_workers) if self.include_replies else None
+
+        def iter_new_pages() -> Iterator[dict]:
+            for page in pages:
+                new_threads, reached_known_comments = self.split_new_threads(page['items'])
+                page = {**page, 'items': new_threads}
+                if replies_executor is not None:
+                    page = self.youtube_connection.complete_page_replies(page, replies_executor)
+                yield page
+
+                if reached_known_comments and not self.include_replies:
+                    # the remaining pages only have comments that were already analyzed
+                    break
+
+        try:
+            for page_comments in self.comments_cleaner.iter_clean_pages(iter_new_pages()):
+                # the known replies of changed threads are skipped too, but a known top level
+                # comment is kept when its number of replies changed, to store the new number
+                yield [comment for comment in page_comments
+                       if self.previous_dates.get(comment['id']) != comment['date']
+                       or (not comment.get('parent_id') and 'reply_count' in comment
+                           and self.previous_reply_counts.get(comment['id']) != comment['reply_count'])]
+
+        finally:
+            pages.close()
+            if replies_executor is not None:
+                replies_executor.shutdown()
+
+    def fetch_youtube_video_comments_with_sentiments(self):
+        '''Fetches the new YouTube video comments with sentiment analysis, and merges them with the previous ones.'''
+        print(f"Trying to get new comments from {self.youtube_connection.video_id} video.")
+        new_comments = list(tqdm(self.iter_comments_with_sentiments()))
+        new_comments_by_id = {comment['id']: comment for comment in new_comments}
+
+        # new comments go first, and edited comments replace their previous version
+        self.comments_data = [comment for comment in new_comments if comment['id'] not in self.previous_dates]
+        self.comments_data += [new_comments_by_id.get(comment['id'], comment) for comment in self.previous_comments]
+        print(f"{len(new_comments)} new or edited comments were analyzed.")
+
+        self.processed = True
+
+    def save_comments_with_sentiments(self, cache: Cache, chunk_size: int = 10000) -> int:
+        '''Stores the previous comments merged with the new ones in `cache`.
+        Returns the number of stored comments.'''
+        comments_data = self.get_comments_data()
+        cache.create_cache_file(comments_data, self.youtube_connection.video_id)
+        return len(comments_data)
+
+
 
 if __name__ == '__main__':
 
     YOUTUBE_API_KEY = ReadApiKeys().youtube_api_key()
     video_ID = "ZbwV_W9HjnY"
     youtube_connection = YoutubeCommentsConnection(YOUTUBE_API_KEY, video_ID)
-    sentiments_analyzer = CommentsOfVideoSentimentAnalyzer(youtube_connection)
+    cache = Cache()
+
+    previous_comments = cache.get_cached_comments(video_ID) if cache.check_if_cache_file_exist(video_ID) else []
+    if previous_comments and 'id' in previous_comments[0]:
+        sentiments_analyzer = IncrementalCommentsSentimentAnalyzer(youtube_connection, previous_comments)
+    else:
+        sentiments_analyzer = CommentsOfVideoSentimentAnalyzer(youtube_connection)
 
     comments_analyzed = sentiments_analyzer.get_comments_data()
-    cache = Cache()
-    cache.create_cache_file(comments_analyzed, video_ID)
\ No newline at end of file
+    cache.create_cache_file(comments_analyzed, video_ID)
+    AnalyticsIndex().index_video(video_ID, comments_analyzed)
\ No newline at end of file
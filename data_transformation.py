@@ -1,38 +1,172 @@
 import pandas as pd
+import numpy as np
 
-class DataTransformations:
-    def __init__(self, data) -> None:
-        if type(data) == 'DataFrame':
-            self.df = data
+TIME_BINS = {'hour': 'h', 'day': 'D', 'week': 'W'}
+
+
+def bin_start(dates: pd.Series, time_bin: str) -> pd.Series:
+    '''Returns the start of the time bin of each date (datetime64 in UTC, without timezone).'''
+    return dates.dt.to_period(TIME_BINS[time_bin]).dt.start_time.dt.as_unit('ns').rename('date')
+
+
+class SentimentAggregates:
+    '''Base class of the aggregates used by the plots. Every aggregate is derived 
+    from a table of comment counts, with one row per time bin and one column per sentiment.'''
+
+    def refresh_aggregates(self) -> None:
+        # aggregates that are not kept up to date on every change compute them here
+        pass
+
+    def set_aggregates(self, counts: pd.DataFrame) -> None:
+        '''Derives every aggregate from a table of comment counts, with one row per time bin
+        (sorted by date) and one column per sentiment.'''
+        self.counts_by_bin = counts
+
+        # Total of comments in each time bin
+        self.comments_count_by_bin = counts.sum(axis=1).reset_index(name='count')
+
+        # Count of each sentiment in each time bin, leaving out the bins without that sentiment
+        sentiments_by_bin = counts.stack().rename('count')
+        sentiments_by_bin.index.names = ['date', 'sentiment']
+        self.sentiments_by_bin = sentiments_by_bin[sentiments_by_bin > 0].reset_index()
+
+        # Total of each sentiment
+        self.sentiments_count = counts.sum(axis=0).rename_axis('sentiment').reset_index(name='count')
+        self.sentiments_count = self.sentiments_count[self.sentiments_count['count'] > 0].reset_index(drop=True)
+
+    def comments_over_time(self):
+        # Comments count by time bin, sorted by date
+        self.refresh_aggregates()
+        return self.comments_count_by_bin
+
+    def sentiment_across_time(self):
+        # Comments count by time bin, grouped by sentiment
+        self.refresh_aggregates()
+        return self.sentiments_by_bin.groupby('sentiment', observed=True)
+
+    def count_sentiments(self):
+        # Comments count by sentiment
+        self.refresh_aggregates()
+        return self.sentiments_count
+
+
+class DataTransformations(SentimentAggregates):
+    '''Aggregates of the comments data used by the plots.
+    Dates are parsed once into a datetime64 column and sentiments into a categorical one,
+    and every aggregate is computed in a single pass when the data or the time bin changes.
+    `time_bin` can be `hour`, `day` or `week`.'''
+
+    def __init__(self, data, time_bin: str = 'day') -> None:
+        if isinstance(data, pd.DataFrame):
+            self.df = data.copy()
         else:
             self.df = pd.DataFrame(data=data)
 
-    def comments_over_time(self):
-        # Transform date column to date data type
-        self.df['date'] = pd.to_datetime(self.df['date']).dt.date
+        # Transform date column to datetime data type (in UTC, without timezone) only once
+        self.df['date'] = pd.to_datetime(self.df['date'], utc=True, format='ISO8601').dt.tz_convert(None)
 
-        # Group by date and count comments in each date
-        message_counts = self.df.groupby('date').size().reset_index(name='count')
+        # Transform sentiment column to categorical data type, so groupings work over integer codes
+        if 'sentiment' in self.df.columns:
+            self.df['sentiment'] = self.df['sentiment'].astype('category')
 
-        # Sort by date
-        message_counts = message_counts.sort_values('date')
+        self.set_time_bin(time_bin)
 
-        return message_counts
+    def set_time_bin(self, time_bin: str) -> None:
+        '''Changes the time bin of the aggregates over time, and computes them again.'''
+        if time_bin not in TIME_BINS:
+            raise ValueError(f"Unknown time bin {time_bin}. It must be one of {list(TIME_BINS)}.")
 
-    def sentiment_across_time(self):
-        # Transform date column to date data type
-        self.df['date'] = pd.to_datetime(self.df['date']).dt.date
+        self.time_bin = time_bin
+        self.compute_aggregates()
+
+    def compute_aggregates(self) -> None:
+        # Start of the time bin of each comment
+        bins = bin_start(self.df['date'], self.time_bin)
 
-        # Group comments by date and sentiment
-        sentiments_across_time_table = self.df.groupby(['date', 'sentiment']).size()
+        # Count comments by time bin and sentiment, with one column per sentiment
+        if 'sentiment' in self.df.columns:
+            counts = self.df.groupby([bins, self.df['sentiment']], observed=True).size().unstack(fill_value=0)
+        else:
+            counts = bins.value_counts().to_frame('count')
+        counts = counts.sort_index()
 
-        # Add count column, that contains the sum of each sentiment by date
-        sentiments_across_time_table = sentiments_across_time_table.reset_index(name='count')
-        sentiments_across_time_table_grouped = sentiments_across_time_table.groupby('sentiment')
+        self.set_aggregates(counts)
 
-        return sentiments_across_time_table_grouped
-    
-    def count_sentiments(self):
-        # Group by sentiment and count by sentiment
-        sentiments_count = self.df.groupby('sentiment').size().reset_index(name='count')
-        return sentiments_count
\ No newline at end of file
+    def sentiment_per_thread(self):
+        # Each comment belongs to the thread of its parent, or to its own thread if it is a top level comment
+        thread_id = self.df['parent_id'].where(self.df['parent_id'].fillna('') != '', self.df['id'])
+
+        # Count each sentiment by thread, with one column per sentiment
+        sentiments_per_thread = self.df.groupby([thread_id.rename('thread_id'), 'sentiment'], observed=True).size().unstack(fill_value=0)
+        sentiments_per_thread['total'] = sentiments_per_thread.sum(axis=1)
+
+        return sentiments_per_thread.reset_index()
+
+
+class IncrementalAggregator(SentimentAggregates):
+    '''Aggregates of the comments data that are updated as new scored comments arrive.
+    Counts are kept in a NumPy array with one row per time bin and one column per sentiment,
+    so `update` only costs the size of the new batch, and the frames are the same ones
+    `DataTransformations` computes for the whole comments list.'''
+
+    def __init__(self, time_bin: str = 'day', capacity: int = 64) -> None:
+        if time_bin not in TIME_BINS:
+            raise ValueError(f"Unknown time bin {time_bin}. It must be one of {list(TIME_BINS)}.")
+
+        self.time_bin = time_bin
+        self.counts = np.zeros((max(1, capacity), 0), dtype=np.int64)
+        self.bin_rows: dict[int, int] = {}
+        self.sentiment_columns: dict[str, int] = {}
+        self.outdated = True
+
+    def update(self, comments) -> None:
+        '''Adds a batch of scored comments (a DataFrame or a list of records) to the counts.'''
+        df = comments if isinstance(comments, pd.DataFrame) else pd.DataFrame(comments)
+        if df.empty:
+            return
+
+        dates = pd.to_datetime(df['date'], utc=True, format='ISO8601').dt.tz_convert(None)
+        bins = bin_start(dates, self.time_bin).to_numpy().view(np.int64)
+
+        # row of each time bin and column of each sentiment, adding the new ones
+        unique_bins, bin_positions = np.unique(bins, return_inverse=True)
+        rows = np.array([self._bin_row(int(bin_start_time)) for bin_start_time in unique_bins])[bin_positions]
+
+        unique_sentiments, sentiment_positions = np.unique(df['sentiment'].astype(str).to_numpy(), return_inverse=True)
+        columns = np.array([self._sentiment_column(sentiment) for sentiment in unique_sentiments])[sentiment_positions]
+
+        np.add.at(self.counts, (rows, columns), 1)
+        self.outdated = True
+
+    def refresh_aggregates(self) -> None:
+        if not self.outdated:
+            return
+
+        # rows sorted by date, and columns sorted by sentiment like categorical columns are
+        bin_starts = np.array(sorted(self.bin_rows), dtype=np.int64)
+        sentiments = sorted(self.sentiment_columns)
+        counts = self.counts[[self.bin_rows[bin_start_time] for bin_start_time in bin_starts]][:, [self.sentiment_columns[sentiment] for sentiment in sentiments]]
+
+        self.set_aggregates(pd.DataFrame(
+            counts,
+            index=pd.DatetimeIndex(bin_starts.view('datetime64[ns]'), name='date'),
+            columns=pd.CategoricalIndex(sentiments, categories=sentiments, name='sentiment')
+        ))
+        self.outdated = False
+
+    def _bin_row(self, bin_start_time: int) -> int:
+        if bin_start_time not in self.bin_rows:
+            self.bin_rows[bin_start_time] = len(self.bin_rows)
+
+            # grow the counts array by doubling its rows when it is full
+            if len(self.bin_rows) > self.counts.shape[0]:
+                self.counts = np.concatenate((self.counts, np.zeros_like(self.counts)), axis=0)
+
+        return self.bin_rows[bin_start_time]
+
+    def _sentiment_column(self, sentiment: str) -> int:
+        if sentiment not in self.sentiment_columns:
+            self.sentiment_columns[sentiment] = len(self.sentiment_columns)
+            self.counts = np.concatenate((self.counts, np.zeros((self.counts.shape[0], 1), dtype=np.int64)), axis=1)
+
+        return self.sentiment_columns[sentiment]
@@ -0,0 +1,338 @@
+import os
+import json
+import hashlib
+import threading
+import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import time
+import random
+
+SAMPLE_TEXTS = [
+    "first",
+    "This video is amazing, thanks for sharing!",
+    "I did not like the ending at all",
+    "who's here in 2024",
+    "❤️❤️❤️",
+    "Terrible audio quality, could barely hear anything",
+    "Great explanation, very clear",
+    "meh",
+]
+
+BASE_DATE = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+# maximum number of replies the API includes inside a comment thread
+INLINED_REPLIES = 5
+
+
+def build_comment(video_id: str, comment_id: str, index: int, parent_id: str | None = None,
+                  unique_text: bool = False) -> dict:
+    '''Builds a fake `youtube#comment` resource, dated `index` minutes before the base date.
+    With `unique_text`, the comment id is added to the text, so no two texts are the same.'''
+
+    date = (BASE_DATE - datetime.timedelta(minutes=index)).strftime("%Y-%m-%dT%H:%M:%SZ")
+    text = SAMPLE_TEXTS[index % len(SAMPLE_TEXTS)]
+    if unique_text:
+        text = f"{text} ({comment_id})"
+
+    comment = {
+        'kind': 'youtube#comment',
+        'id': comment_id,
+        'snippet': {
+            'videoId': video_id,
+            'textDisplay': text,
+            'textOriginal': text,
+            'publishedAt': date,
+            'updatedAt': date,
+        }
+    }
+
+    if parent_id is not None:
+        comment['snippet']['parentId'] = parent_id
+
+    return comment
+
+
+def build_reply(video_id: str, thread_index: int, reply_index: int, unique_text: bool = False) -> dict:
+    thread_id = f"{video_id}-{thread_index}"
+    return build_comment(video_id, f"{thread_id}.{reply_index}", thread_index + reply_index, parent_id=thread_id,
+                         unique_text=unique_text)
+
+
+def build_comment_thread(video_id: str, index: int, replies_count: int = 0, unique_text: bool = False) -> dict:
+    '''Builds the `commentThreads.list` item number `index` of a fake video.
+    Items are dated from newest to oldest, like the API returns them.
+    Only the first replies of the thread are included, like the API does.'''
+
+    comment_id = f"{video_id}-{index}"
+
+    thread = {
+        'kind': 'youtube#commentThread',
+        'id': comment_id,
+        'snippet': {
+            'videoId': video_id,
+            'topLevelComment': build_comment(video_id, comment_id, index, unique_text=unique_text),
+            'totalReplyCount': replies_count,
+        }
+    }
+
+    if replies_count:
+        thread['replies'] = {
+            'comments': [build_reply(video_id, index, reply_index, unique_text)
+                         for reply_index in range(min(replies_count, INLINED_REPLIES))]
+        }
+
+    return thread
+
+
+def build_video(video_id: str, comments_count: int) -> dict:
+    '''Builds the `videos.list` item of a fake video.'''
+
+    return {
+        'kind': 'youtube#video',
+        'id': video_id,
+        'snippet': {
+            'publishedAt': BASE_DATE.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            'title': f"Fake video {video_id}",
+            'channelId': "UCfake",
+            'channelTitle': "Fake channel",
+            'thumbnails': {'high': {'url': f"https://i.ytimg.com/vi/{video_id}/hqdefault.jpg"}},
+        },
+        'contentDetails': {'duration': 'PT10M'},
+        'statistics': {'viewCount': '1000', 'likeCount': '100', 'commentCount': str(comments_count)},
+    }
+
+
+def record_video(YOUTUBE_API_KEY: str, video_id: str, recordings_path: str, max_pages: int | None = None) -> str:
+    '''Saves the `videos.list` item and the `commentThreads.list` pages of a real video
+    in `recordings_path`, so `FakeYoutubeServer` can replay them. Returns the file path.'''
+
+    from conections import YoutubeCommentsConnection, YoutubeVideoInfoConnection
+
+    video = YoutubeVideoInfoConnection(YOUTUBE_API_KEY, video_id).fetch_data().data['items'][0]
+    pages = []
+    for page in YoutubeCommentsConnection(YOUTUBE_API_KEY, video_id).iter_comment_pages():
+        pages.append(page)
+        if max_pages is not None and len(pages) >= max_pages:
+            break
+
+    os.makedirs(recordings_path, exist_ok=True)
+    path = os.path.join(recordings_path, video_id + '.json')
+    with open(path, "w") as file:
+        json.dump({'video': video, 'pages': pages}, file)
+
+    return path
+
+
+class FakeYoutubeServer:
+    '''Local stand-in for the YouTube Data API, serving synthetic comment pages.
+    `comments_per_video` is the number of comments of every video, `replies_per_thread`
+    the number of replies of every comment, `videos_per_playlist` the number of videos
+    of every playlist (and channel uploads), and `latency` is the number of seconds 
+    each request waits before answering.
+    With `unique_texts`, no two comments have the same text (to measure scoring without duplicates).
+    Videos saved with `record_video` in `recordings_path` are replayed instead of being generated.
+    To test error handling, `error_rate` is the share of requests that fail with a 503 error,
+    and `quota_per_key` the number of requests each API key can make before getting 
+    `quotaExceeded` 403 errors (unlimited if None).
+    Responses have an `ETag` header, and requests with a matching `If-None-Match` get an empty 304
+    response, counted in `not_modified_count`.
+    Point a connection to `url` to use it instead of the real API.'''
+
+    def __init__(self, comments_per_video: int = 1000, page_size: int = 100, replies_per_thread: int = 0,
+                 videos_per_playlist: int = 10, latency: float = 0.0, error_rate: float = 0.0,
+                 quota_per_key: int | None = None, unique_texts: bool = False, recordings_path: str | None = None,
+                 host: str = '127.0.0.1', port: int = 0) -> None:
+        self.comments_per_video = comments_per_video
+        self.replies_per_thread = replies_per_thread
+        self.videos_per_playlist = videos_per_playlist
+        self.page_size = page_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.quota_per_key = quota_per_key
+        self.unique_texts = unique_texts
+        self.recordings = {}
+        if recordings_path is not None:
+            for file_name in os.listdir(recordings_path):
+                if file_name.endswith('.json'):
+                    with open(os.path.join(recordings_path, file_name), "r") as file:
+                        self.recordings[file_name.removesuffix('.json')] = json.load(file)
+        self.requests_count = 0
+        self.not_modified_count = 0
+        self.requests_by_key = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._build_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def __enter__(self) -> 'FakeYoutubeServer':
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def comment_threads_page(self, video_id: str, page_token: str) -> dict:
+        '''Returns the `commentThreads.list` page that starts at `page_token`.'''
+
+        if video_id in self.recordings:
+            return self.recorded_comment_threads_page(video_id, page_token)
+
+        start = int(page_token) if page_token else 0
+        end = min(start + self.page_size, self.comments_per_video)
+
+        page = {
+            'kind': 'youtube#commentThreadListResponse',
+            'etag': f"{video_id}-{start}",
+            'pageInfo': {'totalResults': end - start, 'resultsPerPage': self.page_size},
+            'items': [build_comment_thread(video_id, index, self.replies_per_thread, self.unique_texts) for index in range(start, end)],
+        }
+
+        if end < self.comments_per_video:
+            page['nextPageToken'] = str(end)
+
+        return page
+
+    def recorded_comment_threads_page(self, video_id: str, page_token: str) -> dict:
+        # recorded pages are numbered, and their tokens point to the next number
+        pages = self.recordings[video_id]['pages']
+        index = int(page_token) if page_token else 0
+        page = {key: value for key, value in pages[index].items() if key != 'nextPageToken'}
+
+        if index + 1 < len(pages):
+            page['nextPageToken'] = str(index + 1)
+
+        return page
+
+    def replies_page(self, parent_id: str, page_token: str) -> dict:
+        '''Returns the `comments.list` page of replies of `parent_id` that starts at `page_token`.'''
+
+        video_id, thread_index = parent_id.rsplit('-', 1)
+        start = int(page_token) if page_token else 0
+        end = min(start + self.page_size, self.replies_per_thread)
+
+        page = {
+            'kind': 'youtube#commentListResponse',
+            'etag': f"{parent_id}-{start}",
+            'items': [build_reply(video_id, int(thread_index), reply_index, self.unique_texts) for reply_index in range(start, end)],
+        }
+
+        if end < self.replies_per_thread:
+            page['nextPageToken'] = str(end)
+
+        return page
+
+    def videos_page(self, video_ids: str) -> dict:
+        '''Returns the `videos.list` response of a comma separated list of ids.'''
+
+        return {
+            'kind': 'youtube#videoListResponse',
+            'items': [self.recordings[video_id]['video'] if video_id in self.recordings else build_video(video_id, self.comments_per_video)
+                      for video_id in video_ids.split(',') if video_id],
+        }
+
+    def playlist_items_page(self, playlist_id: str, page_token: str) -> dict:
+        '''Returns the `playlistItems.list` page that starts at `page_token`.
+        Videos of a playlist are named after it, like `<playlist_id>_<index>`.'''
+
+        start = int(page_token) if page_token else 0
+        end = min(start + 50, self.videos_per_playlist)
+
+        page = {
+            'kind': 'youtube#playlistItemListResponse',
+            'items': [{'kind': 'youtube#playlistItem', 'contentDetails': {'videoId': f"{playlist_id}_{index}"}}
+                      for index in range(start, end)],
+        }
+
+        if end < self.videos_per_playlist:
+            page['nextPageToken'] = str(end)
+
+        return page
+
+    def channels_page(self, channel_id: str) -> dict:
+        '''Returns the `channels.list` response of a channel, whose uploads playlist is `UU` + its id.'''
+
+        return {
+            'kind': 'youtube#channelListResponse',
+            'items': [{
+                'kind': 'youtube#channel',
+                'id': channel_id,
+                'contentDetails': {'relatedPlaylists': {'uploads': 'UU' + channel_id.removeprefix('UC')}},
+            }],
+        }
+
+    def _build_handler(self):
+        fake_server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                url = urlparse(self.path)
+                query = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+                with fake_server._lock:
+                    fake_server.requests_count += 1
+                    api_key = query.get('key', '')
+                    fake_server.requests_by_key[api_key] = fake_server.requests_by_key.get(api_key, 0) + 1
+                    key_requests = fake_server.requests_by_key[api_key]
+
+                if fake_server.latency:
+                    time.sleep(fake_server.latency)
+
+                if fake_server.quota_per_key is not None and key_requests > fake_server.quota_per_key:
+                    self.send_error_json(403, 'quotaExceeded', 'The request cannot be completed because you have exceeded your quota.')
+                elif random.random() < fake_server.error_rate:
+                    self.send_error_json(503, 'backendError', 'Backend Error')
+                elif url.path.endswith('/commentThreads'):
+                    self.send_json(fake_server.comment_threads_page(query.get('videoId', ''), query.get('pageToken', '')))
+                elif url.path.endswith('/videos'):
+                    self.send_json(fake_server.videos_page(query.get('id', '')))
+                elif url.path.endswith('/playlistItems'):
+                    self.send_json(fake_server.playlist_items_page(query.get('playlistId', ''), query.get('pageToken', '')))
+                elif url.path.endswith('/channels'):
+                    self.send_json(fake_server.channels_page(query.get('id', '')))
+                elif url.path.endswith('/comments'):
+                    self.send_json(fake_server.replies_page(query.get('parentId', ''), query.get('pageToken', '')))
+                else:
+                    self.send_error_json(404, 'notFound', 'Not found')
+
+            def send_error_json(self, status: int, reason: str, message: str) -> None:
+                self.send_json({'error': {'code': status, 'message': message, 'errors': [{'reason': reason, 'message': message}]}}, status=status)
+
+            def send_json(self, data: dict, status: int = 200) -> None:
+                body = json.dumps(data).encode('utf-8')
+                etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+
+                if status == 200 and self.headers.get('If-None-Match') == etag:
+                    with fake_server._lock:
+                        fake_server.not_modified_count += 1
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+
+                self.send_response(status)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Type', 'application/json; charset=UTF-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args) -> None:
+                # keep the output of the tests and benchmarks clean
+                pass
+
+        return Handler
@@ -1,167 +1,310 @@
-from tkinter import ttk, Tk
+from tkinter import ttk, Tk, Toplevel, StringVar
 from matplotlib.backends.backend_tkagg import (FigureCanvasTkAgg, NavigationToolbar2Tk)
 from matplotlib.figure import Figure
-import urllib.request
 from PIL import ImageTk, Image
 import io
-from data_transformation import DataTransformations
+from data_transformation import DataTransformations, SentimentAggregates, IncrementalAggregator
 import conections
 import threading
-from utils import Cache
+from utils import Cache, HttpCache
+from analytics import AnalyticsIndex
 import datetime
+import time
 from queue import Queue, Empty
 
+class PlotCanvas:
+    '''Figure, tkinter canvas and toolbar of a plot, created only once and updated in place.
+    Lines and bars are animated artists: when new data fits in the current axes limits,
+    only them are drawn again over a saved background (blitting), instead of the whole figure.'''
+
+    # fraction of the y-axis left over the highest value
+    headroom = 0.2
+
+    def __init__(self, frame, title: str, xlabel: str | None = None, ylabel: str | None = None) -> None:
+        # create a figure with an specific size and resolution
+        self.fig = Figure(figsize=(12, 7), dpi=100)
+        self.subplot = self.fig.add_subplot(111)
+        self.subplot.set_title(title)
+        if xlabel is not None:
+            self.subplot.set_xlabel(xlabel)
+        if ylabel is not None:
+            self.subplot.set_ylabel(ylabel)
+
+        # create a tkinter canvas and embed it into the specified position
+        self.canvas = FigureCanvasTkAgg(self.fig, master=frame)
+        self.canvas.get_tk_widget().grid(row=10, column=0)
+
+        # create the toolkit and draw it in the bottom of the frame
+        self.toolbar_subframe = ttk.Frame(master=frame)
+        self.toolbar_subframe.grid(row=20, column=0)
+        NavigationToolbar2Tk(self.canvas, self.toolbar_subframe)
+
+        self.lines = {}
+        self.bars = None
+        self.bar_labels = []
+        self.background = None
+        self.needs_full_redraw = True
+
+        # save the background each time the whole figure is drawn
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+
+    def on_draw(self, event) -> None:
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+        self.draw_artists()
+
+    def artists(self) -> list:
+        return list(self.lines.values()) + (list(self.bars) if self.bars is not None else [])
+
+    def draw_artists(self) -> None:
+        for artist in self.artists():
+            self.subplot.draw_artist(artist)
+
+    def set_line(self, label: str, x, y) -> None:
+        '''Sets the data of the line `label`, creating it the first time.'''
+        if label in self.lines:
+            self.lines[label].set_data(x, y)
+        else:
+            self.lines[label] = self.subplot.plot(x, y, label=label, animated=True)[0]
+            self.needs_full_redraw = True
+
+    def set_bars(self, labels: list[str], heights: list[int]) -> None:
+        '''Sets the heights of the bars, creating them again only if their labels changed.'''
+        if labels == self.bar_labels:
+            for bar, height in zip(self.bars, heights):
+                bar.set_height(height)
+        else:
+            if self.bars is not None:
+                self.bars.remove()
+            self.bars = self.subplot.bar(labels, heights, animated=True)
+            self.bar_labels = labels
+            self.needs_full_redraw = True
+
+    def set_legend(self) -> None:
+        if self.needs_full_redraw and self.lines:
+            self.subplot.legend(handles=list(self.lines.values()))
+
+    def update(self) -> None:
+        '''Shows the new data of the artists, drawing the whole figure only if the axes changed.'''
+        (left, right), (bottom, top) = self.subplot.get_xlim(), self.subplot.get_ylim()
+        self.subplot.relim()
+        data_limits = self.subplot.dataLim
+        data_fits = left <= data_limits.x0 and data_limits.x1 <= right and bottom <= data_limits.y0 and data_limits.y1 <= top
+
+        if self.needs_full_redraw or self.background is None or not data_fits:
+            self.subplot.autoscale_view()
+
+            # leave room over the highest value, so the next updates fit without drawing the whole figure
+            bottom, top = self.subplot.get_ylim()
+            self.subplot.set_ylim(bottom, top + (top - bottom) * self.headroom, auto=True)
+
+            self.canvas.draw_idle()
+            self.needs_full_redraw = False
+        else:
+            self.canvas.restore_region(self.background)
+            self.draw_artists()
+            self.canvas.blit(self.fig.bbox)
+
+    def clear(self) -> None:
+        '''Removes the data of the previous video, keeping the figure and the canvas.'''
+        for line in self.lines.values():
+            line.remove()
+        if self.bars is not None:
+            self.bars.remove()
+        if self.subplot.get_legend() is not None:
+            self.subplot.get_legend().remove()
+
+        self.lines = {}
+        self.bars = None
+        self.bar_labels = []
+        self.needs_full_redraw = True
+        self.canvas.draw_idle()
+
 class Plots():
-    '''This module works with comments_json structure.
-    root: Parent frame to draw the plots.'''
+    '''This module works with comments_json structure, or with already computed aggregates.
+    root: Parent frame to draw the plots.
+    Each plot creates its figure and canvas the first time it is drawn, and then
+    only updates its data, also when the data of another video is set.'''
 
     def __init__(self, root, comments_data) -> None:
         self.root = root
-        self.data = DataTransformations(comments_data)
+        self.plot_canvases = {}
+        self.set_data(comments_data)
 
-    def video_comments_over_time(self, frame) -> None:
-        # obtain data to plot 
-        comments_over_time = self.data.comments_over_time()
-
-        # create a figure with an specific size and resolution
-        fig = Figure(figsize=(12, 7), dpi=100)
+    def set_data(self, comments_data) -> None:
+        '''Changes the data of the plots, clearing the data drawn before.'''
+        if isinstance(comments_data, SentimentAggregates):
+            self.data = comments_data
+        else:
+            self.data = DataTransformations(comments_data)
 
-        # create a subplot to the figure and draw the plot
-        subplot = fig.add_subplot(111)
-        subplot.plot('date', 'count', data=comments_over_time)
-        subplot.set_title("Video comments over time")
-        subplot.xaxis.set_tick_params(rotation=45)
+        for plot_canvas in self.plot_canvases.values():
+            plot_canvas.clear()
 
-        # create a tkinter canvas and draw the plot into it
-        canvas = FigureCanvasTkAgg(fig, master=frame)
-        canvas.draw()
+    def get_plot_canvas(self, frame, title: str, xlabel: str | None = None, ylabel: str | None = None) -> PlotCanvas:
+        if title not in self.plot_canvases:
+            self.plot_canvases[title] = PlotCanvas(frame, title, xlabel, ylabel)
+            # rotate the labels of x-axis
+            self.plot_canvases[title].subplot.xaxis.set_tick_params(rotation=45)
 
-        # embed the canvas into the specified position
-        canvas.get_tk_widget().grid(row=10, column=00)
+        return self.plot_canvases[title]
 
-        # create the toolkit
-        toolbar_subframe = ttk.Frame(master=self.root)
-        toolbar_subframe.grid(row=20, column=0)
+    def video_comments_over_time(self, frame) -> None:
+        # obtain data to plot 
+        comments_over_time = self.data.comments_over_time()
 
-        # draw toolkit in the bottom of the frame
-        NavigationToolbar2Tk(canvas, toolbar_subframe)
+        # update the line of the plot
+        plot_canvas = self.get_plot_canvas(frame, "Video comments over time")
+        plot_canvas.set_line('count', comments_over_time['date'], comments_over_time['count'])
+        plot_canvas.update()
     
     def video_sentiments_over_time(self, frame):
         # obtain data
         sentiments = self.data.sentiment_across_time()
 
-        # create the figure that contains the plot
-        fig = Figure(figsize=(12, 7), dpi=100)
-        subplot = fig.add_subplot(111)
-
+        # update a line for each sentiment
+        plot_canvas = self.get_plot_canvas(frame, 'Sentiments count over time', 'Date', 'Count')
         for name, group in sentiments:
-            subplot.plot(group['date'], group['count'], label=name)
-
-        # set tag to each axis
-        subplot.set_xlabel('Date')
-        subplot.set_ylabel('Count')
-        subplot.set_title('Sentiments count over time')
-
-        # add a legend
-        subplot.legend()
+            plot_canvas.set_line(name, group['date'], group['count'])
 
-        # rotate the labels of x-axis
-        subplot.xaxis.set_tick_params(rotation=45)
-
-        # create a tkinter canvas an draw the plot into it
-        canvas = FigureCanvasTkAgg(fig, master=frame)
-        canvas.draw()
-
-        # embed the canvas into the specified position
-        canvas.get_tk_widget().grid(row=10, column=0)
-
-        # create the toolkit
-        toolbar_subframe = ttk.Frame(master=self.root)
-        toolbar_subframe.grid(row=20, column=0)
-
-        # draw toolkit in the bottom of the frame
-        NavigationToolbar2Tk(canvas, toolbar_subframe)
+        # add a legend, if there are new lines
+        plot_canvas.set_legend()
+        plot_canvas.update()
     
     def video_sentiment_count(self, frame):
         sentiments_count = self.data.count_sentiments()
 
-        fig = Figure(figsize=(12, 7), dpi=100)
-        subplot = fig.add_subplot(111)
-        subplot.bar(sentiments_count['sentiment'], sentiments_count['count'])
-
-        subplot.set_xlabel("Sentiment category")
-        subplot.set_ylabel("Count")
-        subplot.set_title("Sentiment count")
-
-        # create a tkinter canvas an draw the plot into it
-        canvas = FigureCanvasTkAgg(fig, master=frame)
-        canvas.draw()
-
-        # embed the canvas into the specified position
-        canvas.get_tk_widget().grid(row=10, column=0)
-
-        # create the toolkit
-        toolbar_subframe = ttk.Frame(master=self.root)
-        toolbar_subframe.grid(row=20, column=0)
-
-        # draw toolkit in the bottom of the frame
-        NavigationToolbar2Tk(canvas, toolbar_subframe)
+        plot_canvas = self.get_plot_canvas(frame, "Sentiment count", "Sentiment category", "Count")
+        plot_canvas.set_bars(sentiments_count['sentiment'].astype(str).tolist(), sentiments_count['count'].tolist())
+        plot_canvas.update()
 
 class PlotsDrawer(Plots):
-    '''Class to draw the Plots into a Notebook Mainframe.'''
+    '''Class to draw the Plots into a Notebook Mainframe.
+    Only the selected tab is drawn. The other ones are drawn when they are selected.'''
 
     def __init__(self, root, comments_data) -> None:
         super().__init__(root, comments_data)
+        self.tabs = {}
+        self.outdated_tabs = set()
 
     def draw_plots(self, notebook_parent_frame: ttk.Notebook) -> None:
-        video_comments_over_time_frame = ttk.Frame(notebook_parent_frame)
-        self.video_comments_over_time(video_comments_over_time_frame)
-        
-        video_sentiment_count_frame = ttk.Frame(notebook_parent_frame)
-        self.video_sentiment_count(video_sentiment_count_frame)
+        self.notebook = notebook_parent_frame
+
+        for text, draw_plot in (("Comments over time", self.video_comments_over_time),
+                                ("Sentiments count", self.video_sentiment_count),
+                                ("Sentiments over time", self.video_sentiments_over_time)):
+            frame = ttk.Frame(notebook_parent_frame)
+            notebook_parent_frame.add(frame, text=text)
+            self.tabs[str(frame)] = (frame, draw_plot)
+
+        notebook_parent_frame.bind('<<NotebookTabChanged>>', lambda event: self.draw_selected_tab())
+        self.refresh()
+
+    def refresh(self) -> None:
+        '''Marks every plot as outdated, and draws again the selected one.'''
+        self.outdated_tabs = set(self.tabs)
+        self.draw_selected_tab()
 
-        video_sentiments_over_time_frame = ttk.Frame(notebook_parent_frame)
-        self.video_sentiments_over_time(video_sentiments_over_time_frame)
+    def draw_selected_tab(self) -> None:
+        selected_tab = self.notebook.select()
+        if selected_tab not in self.outdated_tabs:
+            return
 
-        notebook_parent_frame.add(video_comments_over_time_frame, text="Comments over time")
-        notebook_parent_frame.add(video_sentiment_count_frame, text="Sentiments count")
-        notebook_parent_frame.add(video_sentiments_over_time_frame, text="Sentiments over time")
+        frame, draw_plot = self.tabs[selected_tab]
+        draw_plot(frame)
+        self.outdated_tabs.discard(selected_tab)
 
 
         
 class gui_builder:
+    '''Window that shows the analysis of a video in stages: the video info is shown as soon
+    as it arrives, and the plots are drawn from the comments scored so far, while the
+    rest of the comments are fetched and scored in a background thread.'''
+
+    # comments sent to the window at a time, and minimum seconds between redraws
+    progress_batch_size = 500
+    redraw_interval = 1.0
+    thumbnail_ttl = 7 * 24 * 60 * 60
 
     def __init__(self, API_KEY) -> None:
         self.root = Tk()
-        self.video_id_str = ttk.StringVar()
+        self.video_id_str = StringVar()
         self.queue = Queue()
         self.video_thumbnail = None
+        self.video_info_frame = None
+        self.http_cache = HttpCache()
         self.API_KEY = API_KEY
+        # every request of the window shares the same retries and quota count
+        self.scheduler = conections.ApiScheduler(API_KEY)
+        self.analytics_index = AnalyticsIndex()
+        self.aggregator = None
+        self.plots_drawer = None
+        self.progress_bar = None
+        self.scored_comments = 0
+        self.plots_outdated = False
+        self.showing_comments = False
+        self.last_redraw_time = 0.0
+        # every submit starts a new load, and the messages of older loads are dropped
+        self.load_generation = 0
+        self.load_cancelled = threading.Event()
+        self.checking_queue = False
 
     def check_queue(self) -> None:
+        finished = False
         try:
-            # trying to get info from queue
-            comments, video_info = self.queue.get_nowait()
-            self.draw_video_info_and_stats(video_info)
-            self.draw_mainframe(comments)
+            # handle every message sent by the loading thread since the last check
+            while not finished:
+                generation, stage, data = self.queue.get_nowait()
+                if generation != self.load_generation:
+                    continue
+
+                if stage == 'video_info':
+                    self.draw_video_info_and_stats(*data)
+                elif stage == 'comments':
+                    self.add_scored_comments(data)
+                elif stage == 'error':
+                    print(f"An error occurred: {data}")
+                    finished = True
+                elif stage == 'done':
+                    finished = True
+
         except Empty:
-            # if queue is empty, check after a short time
-            # Si la cola está vacía, volver a comprobar después de un corto retraso
+            pass
+
+        # redraw the plots with the comments scored so far, at most once each interval
+        if self.plots_outdated and (finished or time.monotonic() - self.last_redraw_time >= self.redraw_interval):
+            self.plots_drawer.refresh()
+            self.plots_outdated = False
+            self.last_redraw_time = time.monotonic()
+
+        if finished:
+            self.checking_queue = False
+            if self.progress_bar is not None:
+                self.progress_bar.stop()
+                self.progress_bar.grid_remove()
+        else:
+            # if loading is not finished, check after a short time
             self.root.after(100, self.check_queue)
 
-    def get_image(self, url):
-        response = urllib.request.urlopen(url)
-        image_data = response.read()
+    def get_image_bytes(self, url) -> bytes:
+        # thumbnails of a video almost never change, so they are reused for a week
+        return self.http_cache.get(url, ttl=self.thumbnail_ttl)
+
+    def get_image(self, image_data):
         image_bytes = io.BytesIO(image_data)
         img = Image.open(image_bytes)
         
         return ImageTk.PhotoImage(img)
 
-    def draw_video_info_and_stats(self, video_info):
+    def draw_video_info_and_stats(self, video_info, thumbnail_data):
+        # replace the info of the previous video
+        if self.video_info_frame is not None:
+            self.video_info_frame.destroy()
+
         video_info_frame = ttk.Frame(self.root)
         video_info_frame.grid(row=0, column=10)
+        self.video_info_frame = video_info_frame
 
-        self.video_thumbnail = self.get_image(video_info['thumbnail_url'])
+        self.video_thumbnail = self.get_image(thumbnail_data)
         video_thumbnail_label = ttk.Label(video_info_frame, image=self.video_thumbnail)
         video_thumbnail_label.grid(row=1, column=10, columnspan=30)
 
@@ -189,29 +332,87 @@ class gui_builder:
         published_label = ttk.Label(video_info_frame, text=f"Uploaded at {date}")
         published_label.grid(row=30, column=10)
 
-    def draw_mainframe(self, comments_data):
+    def draw_mainframe(self):
         plot_notebook = ttk.Notebook(self.root)
 
         # draw plots
-        PlotsDrawer(self.root, comments_data).draw_plots(plot_notebook)
+        self.plots_drawer = PlotsDrawer(self.root, self.aggregator)
+        self.plots_drawer.draw_plots(plot_notebook)
         plot_notebook.grid(row=0, column=0, padx=10)
+        self.last_redraw_time = time.monotonic()
+
+    def draw_progress_bar(self):
+        # the number of comments that will be analyzed is not known until they are all fetched
+        # (the comment count of the video includes replies and hidden comments), so the bar only shows activity
+        self.progress_bar = ttk.Progressbar(self.root, mode='indeterminate', length=400)
+        self.progress_bar.grid(row=10, column=0, padx=10, pady=10)
+        self.progress_bar.start()
+
+    def add_scored_comments(self, comments):
+        '''Adds a batch of scored comments to the plots, drawing them the first time.'''
+        self.aggregator.update(comments)
+        self.scored_comments += len(comments)
+
+        if self.plots_drawer is None:
+            self.draw_mainframe()
+        elif not self.showing_comments:
+            self.plots_drawer.refresh()
+        else:
+            self.plots_outdated = True
+        self.showing_comments = True
 
-    def load_plots_info(self):
-        conections_handler = conections.AnalysisHandle(self.API_KEY)
+    def load_plots_info(self, video_id: str, generation: int, cancelled: threading.Event):
+        '''Loads the video info and its scored comments, sending them to the window as they are ready.
+        Messages are tagged with the `generation` of the load, and the load stops early once
+        it is `cancelled` by a newer one.'''
+        try:
+            # first stage: video info and thumbnail
+            video_info_response = conections.YoutubeVideoInfoConnection(self.API_KEY, video_id, self.http_cache, self.scheduler).fetch_data()
+            video_info = conections.YoutubeVideoInfoCleaner().clean_data(video_info_response.data)
+            self.queue.put((generation, 'video_info', (video_info, self.get_image_bytes(video_info['thumbnail_url']))))
 
-        comments = None
-        video_info = conections_handler.fetch_video_info_and_stats(self.video_id_str.get())
-        
-        if Cache.check_if_cache_file_exist(self.video_id_str.get()):
-            comments = Cache.get_cache_file(self.video_id_str.get())
-        else:
-            comments = conections_handler.fetch_youtube_video_comments_with_sentiments(self.video_id_str.get())
-            Cache.create_cache_file(comments, self.video_id_str.get())
+            # second stage: comments, from the cache or scored while they are fetched
+            cache = Cache()
+            if cache.check_if_cache_file_exist(video_id):
+                cached_comments = cache.get_cache_file(video_id, ['date', 'sentiment'])
+                self.queue.put((generation, 'comments', cached_comments))
+
+                # videos cached before the analytics index existed are indexed the first time they are shown
+                if self.analytics_index.is_indexed(video_id):
+                    self.analytics_index.index_video_info(video_id, video_info)
+                else:
+                    self.analytics_index.index_video(video_id, cached_comments, video_info)
+
+            else:
+                youtube_connection = conections.YoutubeCommentsConnection(self.API_KEY, video_id, scheduler=self.scheduler)
+                sentiments_analyzer = conections.CommentsOfVideoSentimentAnalyzer(youtube_connection)
+
+                comments, batch = [], []
+                for comment in sentiments_analyzer.iter_comments_with_sentiments():
+                    # a partial video is not cached, as it would look complete
+                    if cancelled.is_set():
+                        return
 
-        self.queue.put((comments, video_info))
+                    comments.append(comment)
+                    batch.append(comment)
+
+                    if len(batch) == self.progress_batch_size:
+                        self.queue.put((generation, 'comments', batch))
+                        batch = []
+
+                if batch:
+                    self.queue.put((generation, 'comments', batch))
+
+                cache.create_cache_file(comments, video_id)
+                self.analytics_index.index_video(video_id, comments, video_info)
+
+            self.queue.put((generation, 'done', None))
+
+        except Exception as error:
+            self.queue.put((generation, 'error', error))
 
     def input_box(self):
-        window = ttk.Toplevel(self.root)
+        window = Toplevel(self.root)
         window.geometry("150x150")
 
         window.title("Type the video ID.")
@@ -219,7 +420,7 @@ class gui_builder:
         title_label = ttk.Label(window, text="Type the video ID.")
         title_label.grid(row=0, column=0, padx=10, pady=10)
 
-        self.video_id_str = ttk.StringVar(window)
+        self.video_id_str = StringVar(window)
         video_id_entry = ttk.Entry(window, textvariable=self.video_id_str)
         video_id_entry.grid(row=1, column=0, padx=10, pady=10)
 
@@ -227,11 +428,32 @@ class gui_builder:
         submit_button.grid(row=2, column=0, padx=10, pady=10)
 
     def on_submit_click(self):
-        thread = threading.Thread(target=self.load_plots_info)
+        self.aggregator = IncrementalAggregator()
+        self.scored_comments = 0
+        self.plots_outdated = False
+        self.showing_comments = False
+
+        # the plots of the previous video are reused for the new one
+        if self.plots_drawer is not None:
+            self.plots_drawer.set_data(self.aggregator)
+
+        if self.progress_bar is not None:
+            self.progress_bar.destroy()
+        self.draw_progress_bar()
+
+        # the previous load stops, and its pending messages are ignored
+        self.load_cancelled.set()
+        self.load_cancelled = threading.Event()
+        self.load_generation += 1
+
+        thread = threading.Thread(target=self.load_plots_info, daemon=True,
+                                  args=(self.video_id_str.get(), self.load_generation, self.load_cancelled))
         thread.start()
-        # Comienza a verificar la cola para ver si hay datos disponibles
-        self.root.after(100, self.check_queue)
+        # Comienza a verificar la cola para ver si hay datos disponibles, con un solo bucle a la vez
+        if not self.checking_queue:
+            self.checking_queue = True
+            self.root.after(100, self.check_queue)
 
     def start(self):
         self.input_box()
-        self.root.mainloop()
\ No newline at end of file
+        self.root.mainloop()
@@ -0,0 +1,224 @@
+import os
+import sys
+import json
+import time
+import logging
+import threading
+from collections import deque, Counter
+from contextlib import contextmanager
+from typing import Iterator
+
+
+class Summary:
+    '''Count, sum, minimum and maximum of the values observed for a metric, with the most
+    recent `window` values kept to estimate quantiles.'''
+
+    def __init__(self, window: int = 1024) -> None:
+        self.count = 0
+        self.sum = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+        self.recent = deque(maxlen=window)
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        self.recent.append(value)
+
+    def quantile(self, q: float) -> float:
+        if not self.recent:
+            return 0.0
+        values = sorted(self.recent)
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    def to_dict(self) -> dict[str, float]:
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min if self.count else 0.0,
+            'max': self.max if self.count else 0.0,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+        }
+
+
+class Metrics:
+    '''Process wide measurements of the analysis pipeline.
+    Counters add up amounts (items, bytes, cache hits), and summaries keep the distribution
+    of observed values (durations, batch sizes). Every metric can have labels, like the
+    API call type. `timer` measures a block of code and, when structured logs are enabled,
+    writes an event with its duration and details as a JSON line.
+    Metrics are exported with `snapshot` or as a Prometheus text file with `write_prometheus`.'''
+
+    namespace = 'comments_analysis'
+    logger = logging.getLogger('comments_analysis.metrics')
+
+    def __init__(self) -> None:
+        self.counters: dict[tuple[str, tuple], float] = {}
+        self.summaries: dict[tuple[str, tuple], Summary] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(name: str, labels: dict) -> tuple[str, tuple]:
+        return name, tuple(sorted(labels.items()))
+
+    def increment(self, name: str, value: float = 1, **labels) -> None:
+        '''Adds `value` to a counter.'''
+        key = self.key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        '''Adds a value to the distribution of a summary.'''
+        key = self.key(name, labels)
+        with self._lock:
+            if key not in self.summaries:
+                self.summaries[key] = Summary()
+            self.summaries[key].observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels) -> Iterator[dict]:
+        '''Measures the duration of the block in the `<name>_seconds` summary.
+        The block gets a dict where it can add details (like `items` or `bytes`) for the log event.'''
+        details = {}
+        start = time.perf_counter()
+        try:
+            yield details
+        finally:
+            seconds = time.perf_counter() - start
+            self.observe(name + '_seconds', seconds, **labels)
+
+            if self.logger.isEnabledFor(logging.INFO):
+                self.logger.info(json.dumps({'time': time.time(), 'event': name, 'seconds': seconds, **labels, **details}))
+
+    def snapshot(self) -> dict:
+        '''Returns every metric as plain data, keyed by name and labels.'''
+        with self._lock:
+            return {
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                             for (name, labels), value in sorted(self.counters.items())],
+                'summaries': [{'name': name, 'labels': dict(labels), **summary.to_dict()}
+                              for (name, labels), summary in sorted(self.summaries.items())],
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self.counters.clear()
+            self.summaries.clear()
+
+    def to_prometheus(self) -> str:
+        '''Returns the metrics in the Prometheus text exposition format.'''
+        lines = []
+        snapshot = self.snapshot()
+        declared = set()
+
+        for counter in snapshot['counters']:
+            name = f"{self.namespace}_{counter['name']}_total"
+            if name not in declared:
+                lines.append(f"# TYPE {name} counter")
+                declared.add(name)
+            lines.append(f"{name}{self.format_labels(counter['labels'])} {counter['value']}")
+
+        for summary in snapshot['summaries']:
+            name = f"{self.namespace}_{summary['name']}"
+            if name not in declared:
+                lines.append(f"# TYPE {name} summary")
+                declared.add(name)
+            for quantile, field in (('0.5', 'p50'), ('0.95', 'p95')):
+                quantile_labels = {**summary['labels'], 'quantile': quantile}
+                lines.append(f"{name}{self.format_labels(quantile_labels)} {summary[field]}")
+            lines.append(f"{name}_count{self.format_labels(summary['labels'])} {summary['count']}")
+            lines.append(f"{name}_sum{self.format_labels(summary['labels'])} {summary['sum']}")
+
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path: str) -> None:
+        '''Writes the metrics to a Prometheus text file (for the node exporter textfile collector).'''
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        temporary_path = path + '.tmp'
+        with open(temporary_path, "w") as file:
+            file.write(self.to_prometheus())
+        os.replace(temporary_path, path)
+
+    @staticmethod
+    def format_labels(labels: dict) -> str:
+        if not labels:
+            return ''
+
+        escaped_labels = []
+        for key, value in labels.items():
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            escaped_labels.append(f'{key}="{value}"')
+        return '{' + ','.join(escaped_labels) + '}'
+
+    def enable_structured_logs(self, path: str | None = None) -> None:
+        '''Writes an event per measured block as a JSON line to `path` (or to stderr).'''
+        if path:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        handler = logging.FileHandler(path) if path else logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        self.logger.addHandler(handler)
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+
+
+# metrics of the whole process
+metrics = Metrics()
+
+
+class SamplingProfiler:
+    '''Opt-in profiler that samples the call stack of every thread each `interval` seconds,
+    and writes them to `path` as folded stacks (one `frame;frame;frame count` line per stack),
+    the input of flamegraph.pl, speedscope and other flame graph tools.
+    Scoring processes of a `SentimentScoringPool` are not sampled, only this process.'''
+
+    def __init__(self, path: str = 'profile.folded', interval: float = 0.005) -> None:
+        self.path = path
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self) -> 'SamplingProfiler':
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def start(self) -> None:
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, name='sampling-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        '''Stops sampling and writes the folded stacks.'''
+        self._stop.set()
+        self._thread.join()
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path, "w") as file:
+            for stack, samples in self.stacks.most_common():
+                file.write(f"{stack} {samples}\n")
+        print(f"Wrote {sum(self.stacks.values())} profile samples to {self.path}")
+
+    def _sample(self) -> None:
+        thread_names = {}
+        while not self._stop.wait(self.interval):
+            if len(thread_names) != threading.active_count():
+                thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self._thread.ident:
+                    continue
+
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+
+                frames.append(thread_names.get(thread_id, str(thread_id)))
+                self.stacks[';'.join(reversed(frames))] += 1
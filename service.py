@@ -0,0 +1,378 @@
+import json
+import time
+import uuid
+import argparse
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from queue import Queue, Empty
+from urllib.parse import urlparse, parse_qs
+from conections import SentimentAnalyzer, ApiScheduler, ModelRegistry
+from batch_runner import BatchRunner
+from data_transformation import DataTransformations, TIME_BINS
+from analytics import AnalyticsIndex
+from instrumentation import metrics
+from utils import ReadApiKeys, SentimentMemoCache
+
+
+class ScoringBatcher:
+    '''Scores the texts of every running job with a single model, in a thread of its own.
+    Texts sent by different jobs at about the same time (within `max_wait` seconds)
+    are scored together, up to `max_batch_texts` texts, so the model runs full batches
+    and texts repeated across jobs are scored once.'''
+
+    def __init__(self, sentiment_analyzer: SentimentAnalyzer, batch_size: int = 32,
+                 max_batch_texts: int = 1024, max_wait: float = 0.02) -> None:
+        self.sentiment_analyzer = sentiment_analyzer
+        self.batch_size = batch_size
+        self.max_batch_texts = max_batch_texts
+        self.max_wait = max_wait
+        self.requests = Queue()
+        self.stopped = False
+        self._thread = None
+        # taken to check `stopped` and send a request at once, so no request comes after the stop
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._score_requests, name='scoring-batcher', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        '''Scores the requests already sent, and fails the ones sent after.'''
+        with self._lock:
+            self.stopped = True
+            self.requests.put(None)
+
+        if self._thread is not None:
+            self._thread.join()
+
+        while not self.requests.empty():
+            request = self.requests.get()
+            if request is not None:
+                request[1].set_exception(RuntimeError("The scoring batcher was stopped."))
+
+    def score(self, texts: list[str]) -> list[str]:
+        '''Returns the sentiment label of every text, once the batch they went in is scored.'''
+        if not texts:
+            return []
+
+        future = Future()
+        with self._lock:
+            if self.stopped:
+                raise RuntimeError("The scoring batcher was stopped.")
+            self.requests.put((texts, future))
+
+        return future.result()
+
+    def _score_requests(self) -> None:
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+
+            # gather the requests of other jobs that arrive shortly after this one
+            pending, texts_count = [request], len(request[0])
+            deadline = time.monotonic() + self.max_wait
+            while texts_count < self.max_batch_texts:
+                try:
+                    request = self.requests.get(timeout=max(0, deadline - time.monotonic()))
+                except Empty:
+                    break
+                if request is None:
+                    # stop after scoring the pending requests
+                    self.requests.put(None)
+                    break
+                pending.append(request)
+                texts_count += len(request[0])
+
+            metrics.observe('service_scoring_batch_requests', len(pending))
+            texts = [text for request_texts, _ in pending for text in request_texts]
+            try:
+                labels = self.sentiment_analyzer.apply_model_to_batch(texts, self.batch_size, show_progress=False)
+            except Exception as error:
+                for _, future in pending:
+                    future.set_exception(error)
+                continue
+
+            start = 0
+            for request_texts, future in pending:
+                future.set_result(labels[start:start + len(request_texts)])
+                start += len(request_texts)
+
+
+class AnalysisService(BatchRunner):
+    '''Long running analysis of YouTube videos for many clients, over a local HTTP API.
+    The model is loaded once, and every job (the analysis of a video) is fetched, cleaned
+    and stored like in `BatchRunner`, with up to `max_workers` jobs at the same time,
+    while their comments are scored together by a `ScoringBatcher`.
+    A job for a video that is already being analyzed returns the running job, and
+    a video that is already in the cache is not analyzed again unless it is refreshed.
+    A refresh is stored apart and replaces the cached video only when it succeeds,
+    so the previous results are served until then, and kept if it fails.
+    The last `max_finished_jobs` finished jobs are kept to answer their status.'''
+
+    max_finished_jobs = 1000
+
+    def __init__(self, YOUTUBE_API_KEY: str, max_workers: int = 4, requests_per_second: float = 10,
+                 api_endpoint: str | None = None, batch_size: int = 32, full_corpus: bool = False,
+                 include_replies: bool = False, memo_cache: SentimentMemoCache | None = None,
+                 scheduler: ApiScheduler | None = None, backend: str | None = None,
+                 analytics_index: AnalyticsIndex | None = None, prefilter_threshold: float | None = None,
+                 host: str = '127.0.0.1', port: int = 8765) -> None:
+        # jobs are kept in memory, and the cache store resumes their videos, so there is no job checkpoint
+        super().__init__(YOUTUBE_API_KEY, None, max_workers=max_workers, requests_per_second=requests_per_second,
+                         api_endpoint=api_endpoint, batch_size=batch_size, full_corpus=full_corpus,
+                         include_replies=include_replies, memo_cache=memo_cache, scheduler=scheduler,
+                         backend=backend, analytics_index=analytics_index, prefilter_threshold=prefilter_threshold)
+        self.batcher = ScoringBatcher(self.sentiment_analyzer, batch_size)
+        self.jobs = OrderedDict()
+        self.running_jobs = {}
+        self.executor = None
+        self._jobs_lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._build_handler())
+        self._server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def __enter__(self) -> 'AnalysisService':
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def start(self) -> None:
+        '''Loads the model and starts the scoring thread, the job workers and the HTTP server.'''
+        self.sentiment_analyzer.warm_up(self.sentiment_analyzer.backend)
+        self.batcher.start()
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='analysis-job')
+        threading.Thread(target=self._server.serve_forever, name='analysis-server', daemon=True).start()
+
+    def serve_forever(self) -> None:
+        self.start()
+        print(f"Analysis service listening on {self.url}")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        # running jobs keep their stored pages, and resume when they are requested again
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.batcher.stop()
+
+    def score_comments(self, comments: list[dict[str, str]], known_labels: dict[str, str] | None = None) -> list[dict[str, str]]:
+        texts = [comment['text'] for comment in comments]
+        sentiments = self.batcher.score(texts) if known_labels is None \
+            else SentimentAnalyzer.apply_known_labels(texts, known_labels, self.batcher.score)
+        for comment, sentiment in zip(comments, sentiments):
+            comment['sentiment'] = sentiment
+        return comments
+
+    def submit(self, video_id: str, refresh: bool = False) -> dict:
+        '''Returns the job that analyzes a video: the running one if there is one,
+        a finished one if the video is in the cache (and not `refresh`), or a new one.'''
+
+        with self._jobs_lock:
+            if video_id in self.running_jobs:
+                job = self.jobs[self.running_jobs[video_id]]
+                job['requests'] += 1
+                metrics.increment('service_jobs', result='coalesced')
+                return dict(job)
+
+            job = {'id': uuid.uuid4().hex, 'video_id': video_id, 'status': 'queued', 'source': 'youtube',
+                   'refresh': refresh, 'requests': 1, 'comments': None, 'error': None,
+                   'created_at': time.time(), 'finished_at': None}
+            self.jobs[job['id']] = job
+
+            if not refresh and self.cache.check_if_cache_file_exist(video_id):
+                job.update(status='done', source='cache', finished_at=time.time())
+                metrics.increment('service_jobs', result='cached')
+            else:
+                self.running_jobs[video_id] = job['id']
+                self.executor.submit(self.run_job, job)
+                metrics.increment('service_jobs', result='started')
+
+            self._forget_finished_jobs()
+            return dict(job)
+
+    def run_job(self, job: dict) -> None:
+        video_id = job['video_id']
+        self._update_job(job, status='running')
+        try:
+            with metrics.timer('service_job'):
+                if job['refresh']:
+                    staging_id = self.cache.store.staging_id(video_id)
+                    comments_count = self.analyze_video(video_id, staging_id)
+                    self.cache.store.replace(video_id, staging_id)
+                else:
+                    comments_count = self.analyze_video(video_id)
+                if self.analytics_index is not None:
+                    self.analytics_index.index_cached_video(self.cache, video_id, self.fetch_videos_info([video_id]).get(video_id))
+        except Exception as error:
+            print(f"Analysis of {video_id} failed: {error!r}")
+            self._update_job(job, status='failed', error=repr(error), finished_at=time.time())
+        else:
+            self._update_job(job, status='done', comments=comments_count, finished_at=time.time())
+
+    def _update_job(self, job: dict, **changes) -> None:
+        with self._jobs_lock:
+            job.update(changes)
+            # a finished video can be analyzed again by a new job
+            if job['status'] in ('done', 'failed'):
+                self.running_jobs.pop(job['video_id'], None)
+
+    def job_status(self, job_id: str) -> dict | None:
+        with self._jobs_lock:
+            job = self.jobs.get(job_id)
+            return None if job is None else dict(job)
+
+    def results(self, video_id: str, time_bin: str = 'day') -> dict | None:
+        '''Returns the sentiment counts of a cached video, in total and by `time_bin`,
+        or None if the video is not completely in the cache.'''
+
+        if not self.cache.check_if_cache_file_exist(video_id):
+            return None
+
+        transformations = DataTransformations(self.cache.get_cache_file(video_id, ['date', 'sentiment']), time_bin)
+        counts = transformations.counts_by_bin
+        return {
+            'video_id': video_id,
+            'comments': int(counts.to_numpy().sum()),
+            'sentiments': {str(sentiment): int(count) for sentiment, count in counts.sum(axis=0).items()},
+            'time_bin': time_bin,
+            'over_time': [{'date': date.isoformat(), **{str(sentiment): int(count) for sentiment, count in row.items()}}
+                          for date, row in counts.iterrows()],
+        }
+
+    def health(self) -> dict:
+        with self._jobs_lock:
+            statuses = [job['status'] for job in self.jobs.values()]
+        return {
+            'model_loaded': ModelRegistry.is_loaded(self.sentiment_analyzer.model_name, self.sentiment_analyzer.backend),
+            'jobs': {status: statuses.count(status) for status in ('queued', 'running', 'done', 'failed')},
+            'pending_scoring_requests': self.batcher.requests.qsize(),
+            'quota_usage': self.scheduler.quota_usage(),
+        }
+
+    def _forget_finished_jobs(self) -> None:
+        finished_jobs = [job_id for job_id, job in self.jobs.items() if job['status'] in ('done', 'failed')]
+        for job_id in finished_jobs[:max(0, len(finished_jobs) - self.max_finished_jobs)]:
+            del self.jobs[job_id]
+
+    def _build_handler(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            '''Routes of the API:
+              - `POST /analyses` with `{"video_id": ..., "refresh": false}` starts (or joins) a job.
+              - `GET /analyses/<job id>` returns the status of a job.
+              - `GET /videos/<video id>?time_bin=day` returns the results of a cached video.
+              - `GET /health` and `GET /metrics` (Prometheus text format) describe the service.'''
+
+            def do_GET(self) -> None:
+                url = urlparse(self.path)
+                query = {key: values[0] for key, values in parse_qs(url.query).items()}
+                parts = url.path.strip('/').split('/')
+
+                if parts == ['health']:
+                    self.send_json(service.health())
+                elif parts == ['metrics']:
+                    self.send_body(metrics.to_prometheus().encode('utf-8'), 'text/plain; version=0.0.4')
+                elif len(parts) == 2 and parts[0] == 'analyses':
+                    self.send_job(parts[1])
+                elif len(parts) == 2 and parts[0] == 'videos':
+                    self.send_results(parts[1], query.get('time_bin', 'day'))
+                else:
+                    self.send_error_json(404, "Not found")
+
+            def do_POST(self) -> None:
+                if urlparse(self.path).path.strip('/') != 'analyses':
+                    return self.send_error_json(404, "Not found")
+
+                try:
+                    body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                    video_id = body['video_id']
+                except (ValueError, KeyError, TypeError):
+                    return self.send_error_json(400, 'The body must be a JSON object with a "video_id"')
+
+                job = service.submit(video_id, bool(body.get('refresh', False)))
+                self.send_json(job, status=200 if job['status'] == 'done' else 202)
+
+            def send_job(self, job_id: str) -> None:
+                job = service.job_status(job_id)
+                if job is None:
+                    self.send_error_json(404, f"Unknown job {job_id}")
+                else:
+                    self.send_json(job)
+
+            def send_results(self, video_id: str, time_bin: str) -> None:
+                if time_bin not in TIME_BINS:
+                    return self.send_error_json(400, f"time_bin must be one of {list(TIME_BINS)}")
+
+                results = service.results(video_id, time_bin)
+                if results is None:
+                    self.send_error_json(404, f"Video {video_id} is not analyzed yet, POST it to /analyses first")
+                else:
+                    self.send_json(results)
+
+            def send_error_json(self, status: int, message: str) -> None:
+                self.send_json({'error': message}, status=status)
+
+            def send_json(self, data: dict, status: int = 200) -> None:
+                self.send_body(json.dumps(data).encode('utf-8'), 'application/json; charset=UTF-8', status)
+
+            def send_body(self, body: bytes, content_type: str, status: int = 200) -> None:
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args) -> None:
+                # requests are counted in the metrics instead
+                metrics.increment('service_http_requests', command=self.command)
+
+        return Handler
+
+
+def parse_arguments(arguments: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Serve the analysis of YouTube videos over a local HTTP API.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--workers', type=int, default=4, help="videos fetched at the same time")
+    parser.add_argument('--requests-per-second', type=float, default=10, help="limit of requests to the YouTube API")
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--backend', choices=ModelRegistry.backends, default='pytorch', help="way the sentiment model runs")
+    parser.add_argument('--full-corpus', action='store_true', help="analyze every comment, with no length or count limit")
+    parser.add_argument('--include-replies', action='store_true', help="analyze the replies of the comments too")
+    parser.add_argument('--memo-cache', action='store_true', help="reuse the sentiments of texts analyzed before")
+    parser.add_argument('--prefilter-threshold', type=float, help="label the texts the prefilter (see train_prefilter.py) is this confident about without the model")
+    parser.add_argument('--no-analytics-index', action='store_true', help="do not add the analyzed videos to the analytics index")
+    parser.add_argument('--api-endpoint', help="address of the YouTube Data API (for example, a local fake server)")
+    parser.add_argument('--api-key', action='append', help="YouTube API key, can be given several times to spread the quota (by default, the ones in .dev/keys.json)")
+    return parser.parse_args(arguments)
+
+
+if __name__ == '__main__':
+
+    arguments = parse_arguments()
+    api_keys = arguments.api_key or ReadApiKeys().youtube_api_keys()
+
+    service = AnalysisService(api_keys[0], scheduler=ApiScheduler(api_keys, arguments.requests_per_second),
+                              max_workers=arguments.workers, api_endpoint=arguments.api_endpoint,
+                              batch_size=arguments.batch_size, full_corpus=arguments.full_corpus,
+                              include_replies=arguments.include_replies, backend=arguments.backend,
+                              memo_cache=SentimentMemoCache() if arguments.memo_cache else None,
+                              analytics_index=None if arguments.no_analytics_index else AnalyticsIndex(),
+                              prefilter_threshold=arguments.prefilter_threshold,
+                              host=arguments.host, port=arguments.port)
+    service.serve_forever()
@@ -0,0 +1,44 @@
+import pandas as pd
+from utils import ColumnarStore
+
+
+def build_comments() -> list[dict[str, str]]:
+    return [
+        {'id': 'a', 'text': "first", 'date': '2024-01-01T10:00:00Z', 'sentiment': 'positive'},
+        {'id': 'b', 'text': "second", 'date': '2024-01-02T10:00:00Z', 'sentiment': None},
+        {'id': 'c', 'text': "third", 'date': '2024-01-03T10:00:00Z', 'sentiment': 'negative'},
+    ]
+
+
+def test_round_trip_keeps_missing_sentiments(tmp_path):
+    store = ColumnarStore(str(tmp_path))
+    store.write('video', build_comments())
+
+    # the read sentiments are categorical, with NaN for the missing one
+    comments = store.read('video')
+    store.write('video', comments)
+
+    written_again = store.read('video')
+    assert written_again['id'].tolist() == ['a', 'b', 'c']
+    sentiments = written_again['sentiment'].astype(object)
+    assert sentiments[[0, 2]].tolist() == ['positive', 'negative']
+    assert pd.isna(sentiments[1])
+    pd.testing.assert_series_equal(written_again['date'], comments['date'])
+
+
+def test_append_adds_new_columns_with_missing_values(tmp_path):
+    store = ColumnarStore(str(tmp_path))
+    first, *others = build_comments()
+    store.append('video', [first], checkpoint={'next_page_token': 'next'})
+    store.append('video', [{**comment, 'parent_id': 'a'} for comment in others])
+
+    comments = store.read('video')
+    assert comments['parent_id'].tolist() == ['', 'a', 'a']
+    assert store.read_checkpoint('video') is None
+
+
+def test_empty_first_append_does_not_create_the_video(tmp_path):
+    store = ColumnarStore(str(tmp_path))
+    store.append('video', [])
+
+    assert not store.exists('video')
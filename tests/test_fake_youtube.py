@@ -0,0 +1,65 @@
+import json
+import pytest
+from fake_youtube import FakeYoutubeServer
+from conections import YoutubeCommentsConnection, ApiScheduler, QuotaExceededError
+from utils import HttpCache
+
+
+@pytest.fixture
+def server():
+    with FakeYoutubeServer(comments_per_video=250, page_size=100, replies_per_thread=7) as server:
+        yield server
+
+
+def test_comment_pages_are_fetched_in_order(server):
+    connection = YoutubeCommentsConnection('key', 'video', api_endpoint=server.url)
+    pages = connection.fetch_all_youtube_video_comments().data
+
+    assert [len(page['items']) for page in pages] == [100, 100, 50]
+    assert 'nextPageToken' not in pages[-1]
+    thread_ids = [thread['id'] for page in pages for thread in page['items']]
+    assert len(set(thread_ids)) == 250
+    assert server.requests_count == 3
+
+
+def test_replies_are_completed_beyond_the_inlined_ones(server):
+    connection = YoutubeCommentsConnection('key', 'video', api_endpoint=server.url)
+    first_page = next(connection.iter_comment_pages(include_replies=True))
+
+    assert all(len(thread['replies']['comments']) == 7 for thread in first_page['items'])
+
+
+def test_exhausted_keys_are_replaced_by_the_next_one():
+    with FakeYoutubeServer(comments_per_video=250, page_size=100, quota_per_key=5) as server:
+        # the first key already used all its quota
+        server.requests_by_key['first'] = 5
+        scheduler = ApiScheduler(['first', 'second'])
+        connection = YoutubeCommentsConnection('first', 'video', api_endpoint=server.url, scheduler=scheduler)
+        pages = connection.fetch_all_youtube_video_comments().data
+
+        assert len(pages) == 3
+        assert scheduler.exhausted_keys == {'first'}
+        # the request that got the quota error was sent again with the second key
+        assert server.requests_by_key == {'first': 6, 'second': 3}
+
+
+def test_quota_errors_are_raised_when_every_key_is_exhausted():
+    with FakeYoutubeServer(quota_per_key=0) as server:
+        connection = YoutubeCommentsConnection('key', 'video', api_endpoint=server.url)
+
+        with pytest.raises(QuotaExceededError):
+            connection.fetch_data()
+        assert server.requests_count == 1
+
+
+def test_unchanged_responses_are_revalidated_with_etags(server, tmp_path):
+    http_cache = HttpCache(str(tmp_path))
+    url = f"{server.url}youtube/v3/videos?part=snippet%2Cstatistics&id=video&key=key"
+
+    first_body = http_cache.get(url)
+    second_body = http_cache.get(url)
+
+    assert second_body == first_body
+    assert json.loads(second_body)['items'][0]['id'] == 'video'
+    assert server.requests_count == 2
+    assert server.not_modified_count == 1
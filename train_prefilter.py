@@ -0,0 +1,74 @@
+import argparse
+import numpy as np
+from conections import SentimentAnalyzer, SentimentPrefilter, TwoTierSentimentAnalyzer, ModelRegistry
+from utils import Cache, SentimentMemoCache
+
+
+def read_cached_labels(cache: Cache, memo_cache: SentimentMemoCache, model_revision: str = SentimentAnalyzer.model_revision,
+                       max_texts: int | None = None) -> tuple[list[str], list[str]]:
+    '''Returns the texts of the cached comments and the label the model gave them.
+    The cached comments may have been labeled by the prefilter, so only the texts
+    with a label of the model in `memo_cache` are returned, with that label.
+    Every distinct text is returned once.'''
+
+    labels_by_text = {}
+    for video_id in cache.store.video_ids():
+        texts = [text for text in dict.fromkeys(cache.store.read(video_id, ['text'])['text']) if text not in labels_by_text]
+        keys = [memo_cache.key(text, SentimentAnalyzer.model_name, model_revision) for text in texts]
+        sources = memo_cache.read_sources(keys)
+        for text, key in zip(texts, keys):
+            label, source = sources.get(key, (None, None))
+            if source == 'model' and label in SentimentPrefilter.labels:
+                labels_by_text[text] = label
+
+        if max_texts is not None and len(labels_by_text) >= max_texts:
+            break
+
+    texts = list(labels_by_text)[:max_texts]
+    return texts, [labels_by_text[text] for text in texts]
+
+
+def print_report(report: dict) -> None:
+    print(f"Prefilter trained with {report['trained_texts']} texts, checked with {report['texts']} others.")
+    print(f"{'threshold':>10} {'coverage':>9} {'labeled agreement':>18} {'agreement':>10}")
+    for threshold in report['thresholds']:
+        print(f"{threshold['threshold']:>10.2f} {threshold['coverage']:>9.1%} "
+              f"{threshold['labeled_agreement']:>18.1%} {threshold['agreement']:>10.1%}")
+    print(f"Recommended threshold: {report['recommended_threshold']}")
+
+
+def parse_arguments(arguments: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Train the sentiment prefilter with the labels of the cached comments.")
+    parser.add_argument('--max-texts', type=int, help="most distinct texts to read from the cache")
+    parser.add_argument('--memo-cache', default='.cache/sentiments.sqlite',
+                        help="sentiment memo with the labels the model gave to the cached texts")
+    parser.add_argument('--backend', choices=ModelRegistry.backends, default='pytorch', help="backend the model labels were memoized with")
+    parser.add_argument('--check-share', type=float, default=0.1, help="share of the texts left out of training to check the agreement")
+    parser.add_argument('--check-with-model', action='store_true', help="label the checked texts with the model again, instead of using the cached labels")
+    parser.add_argument('--min-agreement', type=float, default=0.98, help="agreement with the full model the recommended threshold must reach")
+    parser.add_argument('--output', default=SentimentPrefilter.default_path(SentimentAnalyzer.model_name))
+    return parser.parse_args(arguments)
+
+
+if __name__ == '__main__':
+
+    arguments = parse_arguments()
+    model_revision = SentimentAnalyzer(backend=arguments.backend).memo_revision
+    texts, labels = read_cached_labels(Cache(), SentimentMemoCache(arguments.memo_cache), model_revision, arguments.max_texts)
+    if not texts:
+        raise SystemExit("There are no cached comments labeled by the model to train the prefilter "
+                         "(analyze videos with --memo-cache to keep their labels).")
+
+    checked = np.random.default_rng(0).random(len(texts)) < arguments.check_share
+    prefilter = SentimentPrefilter().fit([text for text, is_checked in zip(texts, checked) if not is_checked],
+                                         [label for label, is_checked in zip(labels, checked) if not is_checked])
+
+    checked_texts = [text for text, is_checked in zip(texts, checked) if is_checked]
+    checked_labels = None if arguments.check_with_model else [label for label, is_checked in zip(labels, checked) if is_checked]
+    report = TwoTierSentimentAnalyzer(prefilter).check_prefilter_agreement(
+        checked_texts, checked_labels, min_agreement=arguments.min_agreement)
+    print_report(report)
+
+    # the saved prefilter learns from every text, including the checked ones
+    prefilter.fit(texts, labels).save(arguments.output)
+    print(f"Saved the prefilter in {arguments.output}")
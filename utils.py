@@ -1,28 +1,523 @@
 import pandas as pd
+import numpy as np
 import os
 import os.path
 import json
+import shutil
+import sqlite3
+import hashlib
+import threading
+import time
+import unicodedata
+import re
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from collections import OrderedDict
+import requests
+from requests.adapters import HTTPAdapter
+from instrumentation import metrics
+
+class ColumnarStore:
+    '''Compact column oriented storage for the analyzed comments of each video.
+    Every video is a directory with one binary file per column and a `meta.json`:
+      - `date` is stored as int64 nanoseconds since epoch (UTC).
+      - `sentiment` is stored as int8 codes of the labels dictionary in `meta.json`.
+      - any other column is stored as UTF-8 strings, with an int64 file of end offsets.
+    Columns are read through memory maps, can be projected, and new rows are appended
+    at the end of the files. `meta.json` is written last, so a broken append is ignored.
+    An append can record a `checkpoint` in `meta.json` together with its rows, so a
+    partially stored video knows where to resume.'''
+
+    schema_version = 1
+    staging_suffix = '.staging'
+    replaced_suffix = '.replaced'
+    timestamp_columns = ('date',)
+    category_columns = ('sentiment',)
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def video_path(self, video_id: str) -> str:
+        return os.path.join(self.path, video_id)
+
+    def meta_path(self, video_id: str) -> str:
+        return os.path.join(self.video_path(video_id), 'meta.json')
+
+    def exists(self, video_id: str) -> bool:
+        '''Returns True if the video is stored with the current schema version.'''
+        meta = self.read_meta(video_id)
+        return meta is not None and meta['schema_version'] == self.schema_version
+
+    def read_meta(self, video_id: str) -> dict | None:
+        try:
+            with open(self.meta_path(video_id), "r") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+    def write_meta(self, video_id: str, meta: dict) -> None:
+        # replace the file atomically, so readers never see a partial meta
+        temporary_path = self.meta_path(video_id) + '.tmp'
+        with open(temporary_path, "w") as file:
+            json.dump(meta, file)
+        os.replace(temporary_path, self.meta_path(video_id))
+
+    def video_ids(self) -> list[str]:
+        '''Returns the ids of the completely stored videos.'''
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(name for name in os.listdir(self.path)
+                      if not name.endswith((self.staging_suffix, self.replaced_suffix))
+                      and os.path.isdir(self.video_path(name)) and self.exists(name) and self.read_checkpoint(name) is None)
+
+    def staging_id(self, video_id: str) -> str:
+        '''Returns the id under which a new version of a video is stored until it replaces the current one.'''
+        return video_id + self.staging_suffix
+
+    def replace(self, video_id: str, staging_id: str) -> None:
+        '''Puts the video stored as `staging_id` in place of `video_id`.
+        The current version stays readable until the directories are renamed,
+        and is removed after.'''
+        replaced_path = self.video_path(video_id) + self.replaced_suffix
+        shutil.rmtree(replaced_path, ignore_errors=True)
+        # a directory can not be renamed over another one, so the current one is moved aside first
+        if os.path.exists(self.video_path(video_id)):
+            os.rename(self.video_path(video_id), replaced_path)
+        os.rename(self.video_path(staging_id), self.video_path(video_id))
+        shutil.rmtree(replaced_path, ignore_errors=True)
+
+    def delete(self, video_id: str) -> None:
+        shutil.rmtree(self.video_path(video_id), ignore_errors=True)
+
+    def write(self, video_id: str, data) -> None:
+        '''Stores `data` (a DataFrame or a list of records) replacing the previous content.'''
+        self.delete(video_id)
+        self.append(video_id, data)
+
+    def append(self, video_id: str, data, checkpoint: dict | None = None) -> None:
+        '''Appends the rows of `data` to the stored video, creating it if needed.
+        Columns that are new to the video are added, empty for the rows stored before.
+        `checkpoint` is stored with the new rows, and an append without it marks the video as complete.'''
+        df = data if isinstance(data, pd.DataFrame) else pd.DataFrame(data)
+        meta = self.read_meta(video_id) if self.exists(video_id) else None
+
+        if len(df.columns) == 0:
+            if len(df):
+                raise ValueError(f"The {len(df)} rows appended to {video_id} have no columns.")
+            if meta is None:
+                # nothing to store yet, and a video without columns could not be read
+                return
+
+        if meta is None:
+            self.delete(video_id)
+            os.makedirs(self.video_path(video_id), exist_ok=True)
+            meta = {'schema_version': self.schema_version, 'rows': 0, 'columns': {}, 'labels': {}}
+
+        for column in df.columns:
+            if column not in meta['columns']:
+                self._add_column(video_id, meta, column)
+
+        for column, kind in meta['columns'].items():
+            values = df[column] if column in df.columns else pd.Series([None] * len(df), index=df.index)
+            self._append_column(video_id, meta, column, kind, values)
+
+        meta['rows'] += len(df)
+        if checkpoint is not None:
+            meta['checkpoint'] = checkpoint
+        else:
+            meta.pop('checkpoint', None)
+        self.write_meta(video_id, meta)
+
+    def read_checkpoint(self, video_id: str) -> dict | None:
+        '''Returns the checkpoint of a partially stored video, or None if it is complete or not stored.'''
+        meta = self.read_meta(video_id) if self.exists(video_id) else None
+        return None if meta is None else meta.get('checkpoint')
+
+    def read(self, video_id: str, columns: list[str] | None = None) -> pd.DataFrame:
+        '''Reads the stored video as a DataFrame. Only `columns` are read if given.'''
+        meta = self.read_meta(video_id)
+        rows = meta['rows']
+        columns = list(meta['columns']) if columns is None else columns
+
+        data = {}
+        for column in columns:
+            kind = meta['columns'][column]
+            if kind == 'timestamp':
+                values = self._map_array(video_id, column, np.int64, rows)
+                data[column] = pd.to_datetime(np.asarray(values).view('datetime64[ns]'), utc=True)
+            elif kind == 'category':
+                codes = self._map_array(video_id, column, np.int8, rows)
+                data[column] = pd.Categorical.from_codes(np.asarray(codes), categories=meta['labels'][column])
+            else:
+                data[column] = self._read_strings(video_id, column, rows)
+
+        return pd.DataFrame(data)
+
+    def _column_path(self, video_id: str, column: str, suffix: str = '.bin') -> str:
+        return os.path.join(self.video_path(video_id), column + suffix)
+
+    def _add_column(self, video_id: str, meta: dict, column: str) -> None:
+        if column in self.timestamp_columns:
+            kind = 'timestamp'
+        elif column in self.category_columns:
+            kind = 'category'
+            meta['labels'][column] = []
+        else:
+            kind = 'string'
+        meta['columns'][column] = kind
+
+        # the rows stored before the column existed get missing values
+        stored_rows = meta['rows']
+        meta['rows'] = 0
+        self._append_column(video_id, meta, column, kind, pd.Series([None] * stored_rows, dtype=object))
+        meta['rows'] = stored_rows
+
+    def _append_column(self, video_id: str, meta: dict, column: str, kind: str, values: pd.Series) -> None:
+        rows = meta['rows']
+
+        if kind == 'timestamp':
+            timestamps = pd.to_datetime(values, utc=True, format='ISO8601')
+            self._append_array(self._column_path(video_id, column), timestamps.dt.as_unit('ns').to_numpy(np.int64), rows)
+
+        elif kind == 'category':
+            # categorical values (like the ones read from the store) are mapped as plain labels
+            values = values.astype(object)
+            labels = meta['labels'][column]
+            for label in values.dropna().unique():
+                if label not in labels:
+                    labels.append(label)
+
+            # missing values are stored with the code -1
+            codes = values.map({label: code for code, label in enumerate(labels)}).fillna(-1)
+            self._append_array(self._column_path(video_id, column), codes.to_numpy(np.int8), rows)
+
+        else:
+            encoded_values = [b'' if value is None or value != value else str(value).encode('utf-8') for value in values]
+            offsets_path = self._column_path(video_id, column, '.offsets')
+            start = int(np.fromfile(offsets_path, dtype=np.int64, count=1, offset=(rows - 1) * 8)[0]) if rows else 0
+
+            offsets = start + np.cumsum([len(value) for value in encoded_values], dtype=np.int64)
+            self._append_bytes(self._column_path(video_id, column), b''.join(encoded_values), start)
+            self._append_array(offsets_path, offsets, rows)
+
+    def _append_array(self, path: str, values: np.ndarray, rows: int) -> None:
+        self._append_bytes(path, values.tobytes(), rows * values.itemsize)
+
+    def _append_bytes(self, path: str, data: bytes, size: int) -> None:
+        # drop any bytes left behind by an append that did not finish
+        with open(path, "ab") as file:
+            file.truncate(size)
+            file.write(data)
+        metrics.increment('cache_bytes_written', len(data))
+
+    def _map_array(self, video_id: str, column: str, dtype, rows: int, suffix: str = '.bin') -> np.ndarray:
+        if rows == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(self._column_path(video_id, column, suffix), dtype=dtype, mode='r', shape=(rows,))
+
+    def _read_strings(self, video_id: str, column: str, rows: int) -> list[str]:
+        if rows == 0:
+            return []
+
+        offsets = self._map_array(video_id, column, np.int64, rows, '.offsets').tolist()
+        with open(self._column_path(video_id, column), "rb") as file:
+            blob = file.read(offsets[-1])
+
+        return [blob[start:end].decode('utf-8') for start, end in zip([0] + offsets[:-1], offsets)]
 
 class Cache:
     cache_path = '.cache/'
 
+    def __init__(self) -> None:
+        self.store = ColumnarStore(self.cache_path)
+
+    def legacy_path(self, filename: str) -> str:
+        return r''.join((self.cache_path, filename, '.json'))
+
     def create_cache_file(self, data, filename: str) -> None:
-        path = r''.join((self.cache_path, filename, '.json'))
-        pd.DataFrame(data).to_json(path)
-        print(f"Created cache file in {path}")
+        with metrics.timer('cache_write') as details:
+            self.store.write(filename, data)
+            details['items'] = len(data)
+        print(f"Created cache file in {self.store.video_path(filename)}")
+
+    def append_to_cache_file(self, data, filename: str) -> None:
+        '''Adds new comments to the cached ones of a video.'''
+        with metrics.timer('cache_append') as details:
+            self.store.append(filename, data)
+            details['items'] = len(data)
 
     def check_if_cache_file_exist(self, filename: str) -> None:
-        path = r''.join((self.cache_path, filename, '.json'))
-        return os.path.exists(path)
+        # videos partially stored by a batch run are not complete cache files yet
+        if self.store.exists(filename):
+            return self.store.read_checkpoint(filename) is None
+        return os.path.exists(self.legacy_path(filename))
+
+    def get_cache_file(self, video_id: str, columns: list[str] | None = None) -> None:
+        '''Returns the cached comments of a video as a DataFrame.
+        If `columns` is given, only those columns are read.'''
+        if self.store.exists(video_id):
+            with metrics.timer('cache_read'):
+                return self.store.read(video_id, columns)
 
-    def get_cache_file(self, video_id: str) -> None:
-        path = r''.join((self. cache_path, video_id, '.json'))
-        return pd.read_json(path)
+        # cache files written before the columnar store
+        comments = pd.read_json(self.legacy_path(video_id))
+        return comments if columns is None else comments[columns]
+
+    def get_cached_comments(self, video_id: str) -> list[dict[str, str]]:
+        '''Returns the cached comments of a video as a list of records,
+        with the dates in the same format the YouTube API uses.'''
+        comments = self.get_cache_file(video_id)
+        comments['date'] = pd.to_datetime(comments['date'], utc=True).dt.strftime("%Y-%m-%dT%H:%M:%SZ")
+        if 'sentiment' in comments.columns:
+            comments['sentiment'] = comments['sentiment'].astype(object)
+        return comments.to_dict('records')
+
+class SentimentMemoCache:
+    '''Persistent memo of the sentiment of already analyzed texts, shared by every video.
+    Entries are keyed by a hash of the normalized text, the model name and the model revision.
+    The most recent entries are kept in an in-memory LRU of `memory_size` entries, in front 
+    of a SQLite file that keeps at most `max_disk_entries` entries (the least recently used 
+    ones are evicted first). `hits` and `misses` count the lookups of the texts.
+    Several processes (like the scoring pool ones) can use the same file: writers wait up to
+    `busy_timeout` seconds for each other instead of failing with "database is locked".
+    Every entry keeps the `source` of its label, and lookups only return the labels of the model,
+    so the labels of the model can be told apart from others (like the ones of a prefilter).'''
+
+    def __init__(self, path: str = '.cache/sentiments.sqlite', memory_size: int = 100000,
+                 max_disk_entries: int = 5000000, busy_timeout: float = 30) -> None:
+        self.path = path
+        self.memory_size = memory_size
+        self.max_disk_entries = max_disk_entries
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=busy_timeout, check_same_thread=False)
+        self.connection.execute(f"PRAGMA busy_timeout={int(busy_timeout * 1000)}")
+        # with WAL, readers do not block the writer of another process, nor the other way around
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS sentiments (key BLOB PRIMARY KEY, label TEXT NOT NULL, last_used REAL NOT NULL, "
+            "source TEXT NOT NULL DEFAULT 'model')")
+        # memos created before sources were kept only have labels of the model
+        if 'source' not in [row[1] for row in self.connection.execute("PRAGMA table_info(sentiments)")]:
+            self.connection.execute("ALTER TABLE sentiments ADD COLUMN source TEXT NOT NULL DEFAULT 'model'")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS sentiments_last_used ON sentiments (last_used)")
+        self.connection.commit()
+        self.disk_entries = self.connection.execute("SELECT COUNT(*) FROM sentiments").fetchone()[0]
+
+    @staticmethod
+    def normalize_text(text: str) -> str:
+        # the model is cased, so only unicode forms and whitespace are normalized
+        return re.sub(r'\s+', ' ', unicodedata.normalize('NFC', text)).strip()
+
+    def key(self, text: str, model_name: str, model_revision: str) -> bytes:
+        content = '\0'.join((model_name, model_revision, self.normalize_text(text)))
+        return hashlib.blake2b(content.encode('utf-8'), digest_size=16).digest()
+
+    def get_many(self, keys: list[bytes]) -> dict[bytes, str]:
+        '''Returns the labels of the `keys` that are memoized.'''
+        labels = {}
+        with self._lock:
+            missing_keys = []
+            for key in set(keys):
+                if key in self.memory:
+                    self.memory.move_to_end(key)
+                    labels[key] = self.memory[key]
+                else:
+                    missing_keys.append(key)
+
+            # look up in the disk the keys that are not in memory, in chunks under SQLite variables limit
+            for start in range(0, len(missing_keys), 500):
+                chunk = missing_keys[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self.connection.execute(
+                    f"SELECT key, label FROM sentiments WHERE source = 'model' AND key IN ({placeholders})", chunk).fetchall()
+                for key, label in rows:
+                    labels[key] = label
+                    self._remember(key, label)
+
+            if missing_keys:
+                now = time.time()
+                self.connection.executemany("UPDATE sentiments SET last_used = ? WHERE key = ?",
+                                            [(now, key) for key in missing_keys if key in labels])
+                self.connection.commit()
+
+            found = sum(1 for key in keys if key in labels)
+            self.hits += found
+            self.misses += len(keys) - found
+
+        return labels
+
+    def put_many(self, labels: dict[bytes, str], source: str = 'model') -> None:
+        '''Memoizes the label of each key, given by `source`.
+        Labels of other sources never replace the ones of the model.'''
+        if not labels:
+            return
+
+        with self._lock:
+            if source == 'model':
+                for key, label in labels.items():
+                    self._remember(key, label)
+
+            now = time.time()
+            self.connection.executemany(
+                "INSERT INTO sentiments (key, label, last_used, source) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET label = excluded.label, last_used = excluded.last_used, source = excluded.source "
+                "WHERE sentiments.source != 'model' OR excluded.source = 'model'",
+                [(key, label, now, source) for key, label in labels.items()])
+            self.disk_entries += len(labels)
+            self._evict_disk_entries()
+            self.connection.commit()
+
+    def read_sources(self, keys: list[bytes]) -> dict[bytes, tuple[str, str]]:
+        '''Returns the label and its source of the `keys` that are memoized,
+        without counting them as lookups or as recently used.'''
+        sources = {}
+        with self._lock:
+            unique_keys = list(set(keys))
+            for start in range(0, len(unique_keys), 500):
+                chunk = unique_keys[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                for key, label, source in self.connection.execute(
+                        f"SELECT key, label, source FROM sentiments WHERE key IN ({placeholders})", chunk):
+                    sources[key] = (label, source)
+
+        return sources
+
+    def stats(self) -> dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'memory_entries': len(self.memory),
+        }
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def _remember(self, key: bytes, label: str) -> None:
+        self.memory[key] = label
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def _evict_disk_entries(self) -> None:
+        # replaced keys are counted as new ones, so the real count is checked before evicting
+        if self.disk_entries <= self.max_disk_entries:
+            return
+
+        self.disk_entries = self.connection.execute("SELECT COUNT(*) FROM sentiments").fetchone()[0]
+        if self.disk_entries > self.max_disk_entries:
+            # evict a tenth more than needed, so eviction does not run on every insert
+            evicted_entries = self.disk_entries - int(self.max_disk_entries * 0.9)
+            self.connection.execute(
+                "DELETE FROM sentiments WHERE key IN (SELECT key FROM sentiments ORDER BY last_used LIMIT ?)",
+                (evicted_entries,))
+            self.disk_entries -= evicted_entries
+
+class HttpCache:
+    '''Disk cache for HTTP GET responses, shared by the whole process.
+    Requests go through a pooled keep-alive session. Each response is stored with its
+    `ETag` and `Last-Modified` headers: while it is younger than the `ttl` given to `get`,
+    it is returned without any request, and after that it is revalidated with a
+    conditional request, so unchanged responses are not downloaded again.
+    Entries do not depend on the `key` query parameter, so every API key shares them.'''
+
+    cache_path = '.cache/http/'
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16))
+    session.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+    def __init__(self, cache_path: str | None = None) -> None:
+        self.cache_path = cache_path or self.cache_path
+        os.makedirs(self.cache_path, exist_ok=True)
+
+    def entry_path(self, url: str) -> str:
+        # the API key does not change the response, so it is left out of the entry,
+        # and urls are hashed, so nothing of the query string is written to disk
+        parts = urlsplit(url)
+        query = urlencode([(name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True) if name != 'key'])
+        url = urlunsplit(parts._replace(query=query))
+        return os.path.join(self.cache_path, hashlib.sha256(url.encode('utf-8')).hexdigest())
+
+    def get_fresh(self, url: str, ttl: float) -> bytes | None:
+        '''Returns the cached body of `url` if it is younger than `ttl` seconds, without any request.'''
+        path = self.entry_path(url)
+        meta = self.read_meta(path)
+        if meta is None or time.time() - meta['fetched_at'] >= ttl:
+            return None
+
+        metrics.increment('http_cache_requests', result='fresh')
+        with open(path + '.body', "rb") as file:
+            return file.read()
+
+    def get(self, url: str, ttl: float = 0) -> bytes:
+        '''Returns the body of `url`, from the cache if it is younger than `ttl` seconds
+        or if the server says it did not change.'''
+        body = self.get_fresh(url, ttl)
+        if body is not None:
+            return body
+
+        path = self.entry_path(url)
+        meta = self.read_meta(path)
+
+        # revalidate the cached response, if there is one
+        headers = {}
+        if meta is not None and meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta is not None and meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+        with metrics.timer('http_request'):
+            response = self.session.get(url, headers=headers)
+
+        if response.status_code == 304 and meta is not None:
+            metrics.increment('http_cache_requests', result='revalidated')
+            meta['fetched_at'] = time.time()
+            self.write_meta(path, meta)
+            with open(path + '.body', "rb") as file:
+                return file.read()
+
+        response.raise_for_status()
+        metrics.increment('http_cache_requests', result='miss')
+        metrics.increment('http_bytes_downloaded', len(response.content))
+
+        with open(path + '.body', "wb") as file:
+            file.write(response.content)
+        self.write_meta(path, {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'fetched_at': time.time(),
+        })
+
+        return response.content
+
+    def read_meta(self, path: str) -> dict | None:
+        try:
+            with open(path + '.json', "r") as file:
+                return json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def write_meta(self, path: str, meta: dict) -> None:
+        with open(path + '.json', "w") as file:
+            json.dump(meta, file)
 
 class ReadApiKeys:
     dev_path = '.dev/'
 
-    def youtube_api_key(self) -> str:
+    def read_keys(self) -> dict:
         path = r''.join((self.dev_path, "keys.json"))
         with open(path, "r") as file:
-            return json.load(file)["YOUTUBE_API_KEY"]
\ No newline at end of file
+            return json.load(file)
+
+    def youtube_api_key(self) -> str:
+        return self.read_keys()["YOUTUBE_API_KEY"]
+
+    def youtube_api_keys(self) -> list[str]:
+        '''Returns the list of keys in "YOUTUBE_API_KEYS", or else the single "YOUTUBE_API_KEY".'''
+        keys = self.read_keys()
+        return keys.get("YOUTUBE_API_KEYS") or [keys["YOUTUBE_API_KEY"]]